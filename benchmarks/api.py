@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Load test the challenge REST API of a running Girder server with the plugin
+enabled, reporting latency percentiles and MongoDB operations per request.
+Challenges, phases and users are seeded through the API first; a share of
+the challenges is private and readable by a random subset of the users:
+
+    python benchmarks/api.py --url http://localhost:8080/api/v1 \\
+        --challenges 50 --phases 5 --users 100 --concurrency 8
+
+The typeahead scenario searches prefixes of challenge names as they are
+typed; its p99 should stay under 20 ms with about 100k challenges and
+phases, e.g. --challenges 20000 --phases 4.
+
+Use a throwaway database: the seeded data is left in place. The first user
+of a fresh database becomes its administrator, so --admin-login and
+--admin-password are created when they do not exist yet.
+"""
+
+import argparse
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+
+import pymongo
+import requests
+from bson.objectid import ObjectId
+
+# Largest number of challenges and phases accepted by POST /challenge/bulk
+MAX_BULK_SIZE = 1000
+OPCOUNTERS = ('insert', 'query', 'update', 'delete', 'getmore', 'command')
+
+
+class Client(object):
+    """
+    A minimal Girder REST client holding one authentication token.
+    """
+    def __init__(self, url, token=None):
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+        if token:
+            self.session.headers['Girder-Token'] = token
+
+    def request(self, method, path, **kwargs):
+        response = self.session.request(
+            method, self.url + '/' + path.lstrip('/'), **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    def login(self, login, password):
+        data = self.session.get(self.url + '/user/authentication',
+                                auth=(login, password))
+        data.raise_for_status()
+        token = data.json()['authToken']['token']
+        self.session.headers['Girder-Token'] = token
+        return token
+
+
+def createUser(url, login, password):
+    client = Client(url)
+    try:
+        client.login(login, password)
+    except requests.HTTPError:
+        client.request('POST', 'user', params={
+            'login': login, 'password': password,
+            'email': '%s@example.com' % login, 'firstName': login,
+            'lastName': 'Benchmark'})
+        client.login(login, password)
+    return client
+
+
+def seed(args, admin, rng):
+    """
+    Create the users, challenges and phases of the benchmark.
+
+    :returns: The user clients, challenge IDs and phase IDs.
+    """
+    users = [createUser(args.url, 'bench%05d' % i, 'benchmark%05d' % i)
+             for i in range(args.users)]
+    userIds = [u.request('GET', 'user/me')['_id'] for u in users]
+
+    specs = [{
+        'name': 'Benchmark challenge %05d' % i,
+        'public': rng.random() >= args.private,
+        'phases': [{
+            'name': 'Phase %d' % j, 'active': True, 'public': True
+        } for j in range(args.phases)]
+    } for i in range(args.challenges)]
+    perRequest = max(1, MAX_BULK_SIZE // (args.phases + 1))
+    challenges = []
+    for start in range(0, len(specs), perRequest):
+        challenges += admin.request('POST', 'challenge/bulk', data={
+            'challenges': json.dumps(specs[start:start + perRequest])})
+
+    for challenge, spec in zip(challenges, specs):
+        if spec['public']:
+            continue
+        readers = rng.sample(userIds, max(1, len(userIds) // 10))
+        admin.request('PUT', 'challenge/%s/access' % challenge['_id'], data={
+            'public': 'false',
+            'access': json.dumps({'users': [
+                {'id': id, 'level': 0} for id in readers], 'groups': []})
+        })
+
+    phaseIds = [p['_id'] for c in challenges for p in c['phases']]
+    return users, [c['_id'] for c in challenges], phaseIds
+
+
+def opcount(mongo):
+    counters = mongo.admin.command('serverStatus')['opcounters']
+    return sum(counters[name] for name in OPCOUNTERS)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(name, calls, concurrency, mongo):
+    """
+    Make every call with the given number of concurrent threads, and
+    summarize their latency and the MongoDB operations they caused. Calls
+    refused with a 4xx status, such as reads of private challenges by users
+    without access, are expected with mixed access; they are counted as
+    denied and their latency is reported apart from that of successful
+    calls. Failed calls are only counted.
+
+    :param calls: Functions each making one request.
+    :type calls: list
+    """
+    calls = iter(calls)
+    lock = threading.Lock()
+    latencies = []
+    deniedLatencies = []
+    errors = [0]
+
+    def worker():
+        while True:
+            with lock:
+                call = next(calls, None)
+            if call is None:
+                return
+            start = time.time()
+            try:
+                call()
+            except requests.HTTPError as e:
+                with lock:
+                    if 400 <= e.response.status_code < 500:
+                        deniedLatencies.append(time.time() - start)
+                    else:
+                        errors[0] += 1
+                continue
+            except (requests.RequestException, RuntimeError):
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.append(time.time() - start)
+
+    before = opcount(mongo)
+    start = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    # Includes the operations of the server's own background work, such as
+    # the scoring queue, the serverStatus command itself and, for deletions,
+    # the queries polling their progress
+    ops = opcount(mongo) - before - 1
+
+    requestCount = len(latencies) + len(deniedLatencies) + errors[0]
+    return {
+        'scenario': name,
+        'requests': requestCount,
+        'errors': errors[0],
+        'denied': len(deniedLatencies),
+        'concurrency': concurrency,
+        'seconds': elapsed,
+        'requestsPerSecond': requestCount / elapsed if elapsed else None,
+        'p50Ms': 1000 * percentile(latencies, 0.5) if latencies else None,
+        'p99Ms': 1000 * percentile(latencies, 0.99) if latencies else None,
+        'deniedP50Ms': 1000 * percentile(deniedLatencies, 0.5)
+        if deniedLatencies else None,
+        'mongoOpsPerRequest': float(ops) / requestCount
+        if requestCount else None
+    }
+
+
+def waitForProgress(db, id, timeout=300, interval=0.05):
+    """
+    Wait until the background task tracked by a progress notification is
+    over.
+
+    :raises RuntimeError: If the task failed or did not end in time.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        notification = db.notification.find_one(
+            {'_id': ObjectId(id)}, projection=['data.state'])
+        state = (notification or {}).get('data', {}).get('state')
+        if state == 'success':
+            return
+        if state == 'error':
+            raise RuntimeError('Background task %s failed.' % id)
+        time.sleep(interval)
+    raise RuntimeError('Background task %s did not end in time.' % id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--url', default='http://localhost:8080/api/v1')
+    parser.add_argument('--mongo', default='mongodb://localhost:27017')
+    parser.add_argument('--database', default='girder',
+                        help='the database of the Girder server')
+    parser.add_argument('--admin-login', default='benchadmin')
+    parser.add_argument('--admin-password', default='benchadmin')
+    parser.add_argument('--challenges', type=int, default=50)
+    parser.add_argument('--phases', type=int, default=5,
+                        help='phases per challenge')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--private', type=float, default=0.3,
+                        help='share of private challenges')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='requests per scenario')
+    parser.add_argument('--deletes', type=int, default=20,
+                        help='challenges to create and delete')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    mongo = pymongo.MongoClient(args.mongo)
+    admin = createUser(args.url, args.admin_login, args.admin_password)
+    users, challengeIds, phaseIds = seed(args, admin, rng)
+
+    def clients():
+        return itertools.cycle([admin, None] + users)
+
+    anonymous = Client(args.url)
+
+    def listChallenges(client):
+        return lambda: (client or anonymous).request(
+            'GET', 'challenge', params={'limit': 50})
+
+    def listPhases(client, challengeId):
+        return lambda: (client or anonymous).request(
+            'GET', 'challenge_phase', params={'challengeId': challengeId})
+
+    def typeahead(client, prefix):
+        return lambda: (client or anonymous).request(
+            'GET', 'resource/search', params={
+                'q': prefix, 'mode': 'prefix', 'limit': 10,
+                'types': json.dumps(['challenge_challenge',
+                                     'challenge_phase'])})
+
+    def prefixes():
+        # Every prefix of a seeded name, as typed past its first characters
+        name = 'Benchmark challenge %05d' % rng.randrange(args.challenges)
+        return [name[:n] for n in range(3, len(name) + 1)]
+
+    def join(client, phaseId):
+        return lambda: client.request(
+            'POST', 'challenge_phase/%s/participant' % phaseId)
+
+    def createAndDelete(i):
+        # The deletion runs in the background, so time it until its progress
+        # notification says it is over rather than until DELETE returns.
+        def call():
+            created = admin.request('POST', 'challenge/bulk', data={
+                'challenges': json.dumps([{
+                    'name': 'Benchmark deletion %05d-%d' % (i, args.seed),
+                    'phases': [{'name': 'Phase %d' % j}
+                               for j in range(args.phases)]
+                }])})
+            deleted = admin.request(
+                'DELETE', 'challenge/%s' % created[0]['_id'])
+            waitForProgress(mongo[args.database], deleted['jobId'])
+        return call
+
+    scenarios = [
+        ('GET /challenge', [
+            listChallenges(c) for c, _ in zip(clients(), range(args.requests))
+        ]),
+        ('GET /challenge_phase', [
+            listPhases(c, rng.choice(challengeIds))
+            for c, _ in zip(clients(), range(args.requests))
+        ]),
+        ('GET /resource/search?mode=prefix', [
+            typeahead(c, prefix) for c, prefix in zip(
+                clients(), itertools.islice(itertools.chain.from_iterable(
+                    prefixes() for _ in itertools.count()), args.requests))
+        ]),
+        ('POST /challenge_phase/:id/participant', [
+            join(rng.choice(users), rng.choice(phaseIds))
+            for _ in range(args.requests)
+        ]),
+        ('POST /challenge/bulk + DELETE /challenge/:id until deleted', [
+            createAndDelete(i) for i in range(args.deletes)
+        ])
+    ]
+
+    results = [run(name, calls, args.concurrency, mongo)
+               for name, calls in scenarios]
+
+    json.dump({
+        'benchmark': 'api',
+        'config': {
+            'challenges': args.challenges,
+            'phasesPerChallenge': args.phases,
+            'users': args.users,
+            'private': args.private,
+            'concurrency': args.concurrency,
+            'seed': args.seed
+        },
+        'results': results
+    }, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Time each built-in metric on synthetic memory-mapped volumes, 512^3 by
+default. This does not need a Girder server or database:
+
+    python benchmarks/metrics.py --metrics dice jaccard --repeat 3
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server'))
+
+import metrics  # noqa: E402
+
+
+def memmap(directory, name, shape, dtype, fill):
+    """
+    Create a memory-mapped volume, filling it one slab at a time so that the
+    whole volume never has to fit in memory.
+    """
+    array = numpy.lib.format.open_memmap(
+        os.path.join(directory, name + '.npy'), mode='w+', dtype=dtype,
+        shape=shape)
+    for z in range(shape[0]):
+        array[z] = fill(shape[1:])
+    array.flush()
+    return numpy.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--size', type=int, default=512,
+                        help='edge length of the cubic volumes')
+    parser.add_argument('--metrics', nargs='+', default=sorted(metrics.METRICS),
+                        choices=sorted(metrics.METRICS))
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = numpy.random.RandomState(args.seed)
+    shape = (args.size,) * 3
+    directory = tempfile.mkdtemp()
+    try:
+        truth = memmap(directory, 'truth', shape, numpy.uint8,
+                       lambda s: rng.random_sample(s) < 0.3)
+        mask = memmap(directory, 'mask', shape, numpy.uint8,
+                      lambda s: rng.random_sample(s) < 0.3)
+        scores = memmap(directory, 'scores', shape, numpy.float32,
+                        lambda s: rng.random_sample(s))
+        inputs = {'auc': (scores, truth)}
+
+        results = []
+        for name in args.metrics:
+            submitted, groundTruth = inputs.get(name, (mask, truth))
+            timings = []
+            for _ in range(args.repeat):
+                start = time.time()
+                value = metrics.METRICS[name].func(submitted, groundTruth)
+                timings.append(time.time() - start)
+            results.append({
+                'metric': name,
+                'size': args.size,
+                'value': value,
+                'seconds': min(timings),
+                'voxelsPerSecond': numpy.prod(shape) / min(timings)
+            })
+    finally:
+        shutil.rmtree(directory)
+
+    json.dump({'benchmark': 'metrics', 'results': results}, sys.stdout,
+              indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
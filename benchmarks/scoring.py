@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Measure the throughput of the scoring engine on synthetic ground truth, in
+submissions per second. This does not need a Girder server or database:
+
+    python benchmarks/scoring.py --submissions 200 --processes 4
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server'))
+
+import metrics  # noqa: E402
+import scoring  # noqa: E402
+
+
+def synthesize(args):
+    rng = numpy.random.RandomState(args.seed)
+    shape = (args.size,) * 3
+    groundTruth = {
+        'case%03d.npy' % i: rng.random_sample(shape) < 0.3
+        for i in range(args.files)
+    }
+
+    def tasks():
+        for key in range(args.submissions):
+            for name, truth in groundTruth.items():
+                # Flip a small fraction of the ground truth voxels
+                yield key, name, truth ^ (rng.random_sample(shape) < 0.05)
+
+    return groundTruth, tasks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--submissions', type=int, default=100)
+    parser.add_argument('--files', type=int, default=2,
+                        help='ground truth files per phase')
+    parser.add_argument('--size', type=int, default=64,
+                        help='edge length of the cubic volumes')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    groundTruth, tasks = synthesize(args)
+    engine = scoring.ScoringEngine(metrics.dice, processes=args.processes)
+
+    start = time.time()
+    results = scoring.aggregate(engine.score(groundTruth, tasks()),
+                                groundTruth)
+    elapsed = time.time() - start
+
+    json.dump({
+        'benchmark': 'scoring',
+        'submissions': len(results),
+        'files': args.files,
+        'size': args.size,
+        'processes': engine.processes,
+        'seconds': elapsed,
+        'submissionsPerSecond': len(results) / elapsed
+    }, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,18 @@
 add_python_style_test(python_static_analysis_challenge
                       "${PROJECT_SOURCE_DIR}/plugins/challenge/server")
+add_python_style_test(python_static_analysis_challenge_tests
+                      "${PROJECT_SOURCE_DIR}/plugins/challenge/plugin_tests")
+
+add_python_test(access PLUGIN challenge)
+add_python_test(cache PLUGIN challenge)
+add_python_test(challenge PLUGIN challenge)
+add_python_test(feed PLUGIN challenge)
+add_python_test(instrumentation PLUGIN challenge)
+add_python_test(job PLUGIN challenge)
+add_python_test(leaderboard PLUGIN challenge)
+add_python_test(metrics PLUGIN challenge)
+add_python_test(pagination PLUGIN challenge)
+add_python_test(participant PLUGIN challenge)
+add_python_test(provision PLUGIN challenge)
+add_python_test(search PLUGIN challenge)
+add_python_test(submission PLUGIN challenge)
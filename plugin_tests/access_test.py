@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+from girder.constants import AccessType
+from girder.utility.config import getConfig
+
+from tests import base
+
+
+def setUpModule():
+    # No job worker, which would race the tests on the database
+    getConfig().setdefault('challenge', {})['job_workers'] = 0
+    base.enabledPlugins.append('challenge')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+class AccessTestCase(base.TestCase):
+    def setUp(self):
+        base.TestCase.setUp(self)
+        from girder.plugins.challenge import utility
+        self.utility = utility
+
+        self.admin, self.user, self.member = [
+            self.model('user').createUser(
+                login=login, password='password', firstName=login,
+                lastName='Test', email='%s@example.com' % login)
+            for login in ('admin', 'user', 'member')]
+        group = self.model('group').createGroup('Readers', self.admin)
+        self.model('group').addUser(group, self.member, AccessType.READ)
+        self.member = self.model('user').load(self.member['_id'], force=True)
+
+        model = self.model('challenge', 'challenge')
+        model.createChallenge('Public', self.admin)
+        model.createChallenge('Private', self.admin, public=False)
+        for name, level in (('User read', AccessType.READ),
+                            ('User write', AccessType.WRITE),
+                            ('User admin', AccessType.ADMIN)):
+            challenge = model.createChallenge(name, self.admin, public=False)
+            model.setUserAccess(challenge, self.user, level, save=True)
+        challenge = model.createChallenge('Group read', self.admin,
+                                          public=False)
+        model.setGroupAccess(challenge, group, AccessType.READ, save=True)
+
+    def names(self, user, level):
+        return {c['name'] for c in self.model('challenge', 'challenge').find(
+            self.utility.accessQuery(user, level), limit=0)}
+
+    def assertListing(self, user, names):
+        resp = self.request(path='/challenge', user=user,
+                            params={'limit': 0})
+        self.assertStatusOk(resp)
+        self.assertEqual({c['name'] for c in resp.json}, names)
+
+        resp = self.request(path='/challenge/count', user=user)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['nChallenges'], len(names))
+
+    def testAnonymous(self):
+        self.assertListing(None, {'Public'})
+        self.assertEqual(self.names(None, AccessType.WRITE), set())
+
+    def testUserLevels(self):
+        self.assertListing(self.user, {'Public', 'User read', 'User write',
+                                       'User admin'})
+        self.assertEqual(self.names(self.user, AccessType.WRITE),
+                         {'User write', 'User admin'})
+        self.assertEqual(self.names(self.user, AccessType.ADMIN),
+                         {'User admin'})
+
+    def testGroupLevels(self):
+        self.assertListing(self.member, {'Public', 'Group read'})
+        self.assertEqual(self.names(self.member, AccessType.WRITE), set())
+
+    def testAdmin(self):
+        everything = {'Public', 'Private', 'User read', 'User write',
+                      'User admin', 'Group read'}
+        self.assertListing(self.admin, everything)
+        self.assertEqual(self.names(self.admin, AccessType.ADMIN), everything)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import os
+import shutil
+import tempfile
+
+from girder.constants import AccessType
+from girder.utility.config import getConfig
+
+from tests import base
+
+
+def setUpModule():
+    # No job worker, which would race the tests on the database
+    getConfig().setdefault('challenge', {})['job_workers'] = 0
+    base.enabledPlugins.append('challenge')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+def load(file):
+    return b'x' * file['size']
+
+
+class CacheTestCase(base.TestCase):
+    def setUp(self):
+        base.TestCase.setUp(self)
+        from girder.plugins.challenge import cache
+        self.cacheModule = cache
+
+    def testTtl(self):
+        cache = self.cacheModule.ResponseCache(maxEntries=10, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=-1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # Expired entries are dropped when read
+        self.assertNotIn('b', cache._entries)
+
+        cache = self.cacheModule.ResponseCache(maxEntries=10, ttl=-1)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', 1, ttl=60)
+        self.assertEqual(cache.get('a'), 1)
+
+    def testEviction(self):
+        cache = self.cacheModule.ResponseCache(maxEntries=2, ttl=60)
+        cache.set('a', 1, tags=['x'])
+        cache.set('b', 2)
+        # Reading an entry makes it the most recently used
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+        cache.set('d', 4)
+        self.assertIsNone(cache.get('a'))
+        # Tags of evicted entries are forgotten
+        self.assertNotIn('x', cache._tags)
+
+    def testInvalidate(self):
+        cache = self.cacheModule.ResponseCache(maxEntries=10, ttl=60)
+        cache.set('a', 1, tags=['x', 'y'])
+        cache.set('b', 2, tags=['y'])
+        cache.set('c', 3, tags=['z'])
+
+        cache.invalidate('x')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+        self.assertNotIn('a', cache._tags['y'])
+
+        cache.invalidate('y', 'unknown')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+        # Replacing an entry replaces its tags
+        cache.set('c', 4, tags=['w'])
+        cache.invalidate('z')
+        self.assertEqual(cache.get('c'), 4)
+        cache.invalidate('w')
+        self.assertIsNone(cache.get('c'))
+
+    def testInvalidateDocument(self):
+        cache = self.cacheModule.getResponseCache()
+        docTag = self.cacheModule.docTag('challenge', 'id1')
+        listTag = self.cacheModule.listTag('challenge', 'parent')
+        cache.set('doc', 1, tags=[docTag])
+        cache.set('list', 2, tags=[listTag])
+        cache.set('other', 3, tags=[self.cacheModule.docTag(
+            'challenge', 'id2')])
+
+        self.cacheModule.invalidateDocument('challenge', 'id1')
+        self.assertIsNone(cache.get('doc'))
+        self.assertEqual(cache.get('list'), 2)
+
+        self.cacheModule.invalidateDocument('challenge', 'id1', 'parent')
+        self.assertIsNone(cache.get('list'))
+        self.assertEqual(cache.get('other'), 3)
+
+    def testAccessCache(self):
+        cache = self.cacheModule.getAccessCache()
+        self.assertIsNot(cache, self.cacheModule.getResponseCache())
+        docTag = self.cacheModule.docTag('challenge', 'id1')
+        accessTag = self.cacheModule.accessTag('challenge', 'id1')
+        cache.set('level', 2, tags=[docTag, accessTag])
+        self.cacheModule.invalidateAccess('challenge', 'id1')
+        self.assertIsNone(cache.get('level'))
+
+        cache.set('level', 2, tags=[docTag, accessTag])
+        self.cacheModule.invalidateDocument('challenge', 'id1')
+        self.assertIsNone(cache.get('level'))
+
+    def testEtag(self):
+        doc = {'_id': 'id1', 'public': True, 'access': {'users': []}}
+        etag = self.cacheModule.computeEtag({'name': 'a'}, doc)
+        self.assertEqual(etag, self.cacheModule.computeEtag(
+            {'name': 'a'}, dict(doc)))
+        # Revoking access changes the tag even if the body does not change
+        self.assertNotEqual(etag, self.cacheModule.computeEtag(
+            {'name': 'a'}, dict(doc, public=False)))
+        self.assertNotEqual(etag, self.cacheModule.computeEtag(
+            {'name': 'a'}, [dict(doc, access={'users': [1]})]))
+
+    def testGroundTruthCache(self):
+        from girder.plugins.challenge import groundtruth
+        cache = groundtruth.GroundTruthCache(
+            maxMemory=10, maxDisk=0, directory=None)
+        files = [{'_id': i, 'size': 4, 'sha512': str(i)} for i in range(3)]
+        self.assertEqual(cache.get(files[0], load), b'xxxx')
+        self.assertEqual(cache.get(files[0], load), b'xxxx')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # Concurrent misses on the same file each put it; its size is
+        # counted once
+        cache._putMemory(cache.key(files[0]), b'xxxx')
+        self.assertEqual(cache._memorySize, 4)
+
+        cache.get(files[1], load)
+        self.assertEqual(cache.evictions, 0)
+        cache.get(files[2], load)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache._memorySize, 8)
+
+    def testGroundTruthLink(self):
+        from girder.plugins.challenge import groundtruth
+        directory = tempfile.mkdtemp()
+        try:
+            cache = groundtruth.GroundTruthCache(
+                maxMemory=0, maxDisk=100, directory=os.path.join(
+                    directory, 'cache'))
+            file = {'_id': 1, 'size': 4, 'sha512': '1'}
+            path = os.path.join(directory, 'linked.bin')
+            self.assertTrue(cache.link(file, load, path))
+            self.assertEqual(cache.misses, 1)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'xxxx')
+
+            # A second run links the same copy without loading the file
+            other = os.path.join(directory, 'other.bin')
+            self.assertTrue(cache.link(file, None, other))
+            self.assertEqual((cache.misses, cache.diskHits), (1, 1))
+
+            # The links outlive the cache entry
+            cache.invalidate(1)
+            self.assertTrue(os.path.exists(path))
+
+            # Files the disk level cannot hold are not linked
+            big = {'_id': 2, 'size': 200, 'sha512': '2'}
+            self.assertFalse(cache.link(big, load, os.path.join(
+                directory, 'big.bin')))
+        finally:
+            shutil.rmtree(directory)
+
+    def testListingAclKey(self):
+        admin, user, other = [self.model('user').createUser(
+            login=login, password='password', firstName=login,
+            lastName='Test', email='%s@example.com' % login)
+            for login in ('admin', 'user', 'other')]
+        challenge = self.model('challenge', 'challenge').createChallenge(
+            'Challenge', admin)
+        phaseModel = self.model('phase', 'challenge')
+        phaseModel.createPhase('Public', challenge, admin)
+        private = phaseModel.createPhase('Private', challenge, admin,
+                                         public=False)
+        private = phaseModel.setUserAccess(private, user, AccessType.READ,
+                                           save=True)
+
+        def key(u):
+            return self.cacheModule.listingAclKey(
+                phaseModel, {'challengeId': challenge['_id']},
+                challenge['_id'], u)
+
+        # Users without grants of their own share the anonymous listings
+        self.assertEqual(key(other), key(None))
+        self.assertEqual(key(user), self.cacheModule.aclKey(user))
+        self.assertEqual(key(admin), 'admin')
+
+        params = {'challengeId': challenge['_id']}
+        anonymous = self.request(path='/challenge_phase', params=params)
+        resp = self.request(path='/challenge_phase', user=other,
+                            params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json, anonymous.json)
+        resp = self.request(path='/challenge_phase', user=user,
+                            params=params)
+        self.assertEqual([p['name'] for p in resp.json],
+                         ['Private', 'Public'])
+
+        # A new grant is seen at once
+        phaseModel.setUserAccess(private, other, AccessType.READ, save=True)
+        self.assertEqual(key(other), self.cacheModule.aclKey(other))
+        resp = self.request(path='/challenge_phase', user=other,
+                            params=params)
+        self.assertEqual(len(resp.json), 2)
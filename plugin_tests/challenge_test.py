@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import datetime
+import email.utils
+import json
+import time
+
+from bson.objectid import ObjectId
+from girder.models.notification import ProgressState
+from girder.utility.config import getConfig
+
+from tests import base
+
+
+def setUpModule():
+    # No job worker, which would race the tests on the database
+    getConfig().setdefault('challenge', {})['job_workers'] = 0
+    base.enabledPlugins.append('challenge')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+class ChallengeTestCase(base.TestCase):
+    def setUp(self):
+        base.TestCase.setUp(self)
+        self.admin = self.model('user').createUser(
+            login='admin', password='password', firstName='Admin',
+            lastName='Admin', email='admin@example.com')
+        self.challengeModel = self.model('challenge', 'challenge')
+
+    def testDuplicateName(self):
+        resp = self.request(path='/challenge', method='POST', user=self.admin,
+                            params={'name': 'My Challenge'})
+        self.assertStatusOk(resp)
+        challengeId = resp.json['_id']
+
+        # Names that only differ in case or spacing are taken, and the
+        # collection made for the rejected challenge is removed
+        resp = self.request(path='/challenge', method='POST', user=self.admin,
+                            params={'name': 'my  CHALLENGE'})
+        self.assertStatus(resp, 400)
+        self.assertEqual(resp.json['field'], 'name')
+        self.assertEqual(self.model('collection').find().count(), 1)
+
+        resp = self.request(path='/challenge', method='POST', user=self.admin,
+                            params={'name': 'Other'})
+        self.assertStatusOk(resp)
+        resp = self.request(path='/challenge/%s' % resp.json['_id'],
+                            method='PUT', user=self.admin,
+                            params={'name': 'MY CHALLENGE'})
+        self.assertStatus(resp, 400)
+        self.assertEqual(resp.json['field'], 'name')
+        self.assertEqual(self.challengeModel.load(
+            challengeId, force=True)['name'], 'My Challenge')
+
+    def testBackfillLowerNames(self):
+        from girder.plugins.challenge.utility import (backfillLowerNames,
+                                                      normalizeName)
+        self.challengeModel.createChallenge('Taken', self.admin)
+        # Challenges saved before lowerName was introduced
+        self.challengeModel.collection.insert_many([
+            {'name': name} for name in ('Old', 'old', ' OLD ', 'taken')])
+
+        backfillLowerNames(self.challengeModel)
+        docs = list(self.challengeModel.find(limit=0))
+        self.assertEqual(sorted(doc['lowerName'] for doc in docs),
+                         ['old', 'old (2)', 'old (3)', 'taken', 'taken (2)'])
+        for doc in docs:
+            self.assertEqual(doc['lowerName'], normalizeName(doc['name']))
+        self.assertEqual(self.challengeModel.findOne(
+            {'lowerName': 'taken'})['name'], 'Taken')
+
+        # Running it again changes nothing
+        backfillLowerNames(self.challengeModel)
+        self.assertEqual(
+            sorted(doc['name'] for doc in self.challengeModel.find(limit=0)),
+            sorted(doc['name'] for doc in docs))
+
+    def testIncludePhases(self):
+        user = self.model('user').createUser(
+            login='user', password='password', firstName='User',
+            lastName='User', email='user@example.com')
+        phaseModel = self.model('phase', 'challenge')
+        challenge = self.challengeModel.createChallenge('A', self.admin)
+        public = phaseModel.createPhase('Public', challenge, self.admin)
+        private = phaseModel.createPhase(
+            'Private', challenge, self.admin, public=False)
+        # The newest change is to a phase the user cannot see
+        updated = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+        phaseModel.collection.update_one(
+            {'_id': public['_id']}, {'$set': {'updated': updated}})
+        phaseModel.collection.update_one(
+            {'_id': private['_id']}, {'$set': {
+                'updated': updated + datetime.timedelta(days=1)}})
+
+        path = '/challenge/%s' % challenge['_id']
+        resp = self.request(path=path, user=user,
+                            params={'include': 'phases'})
+        self.assertStatusOk(resp)
+        self.assertEqual([p['name'] for p in resp.json['phases']],
+                         ['Public'])
+        lastModified = resp.headers['Last-Modified']
+        self.assertEqual(email.utils.parsedate(lastModified)[:6],
+                         updated.utctimetuple()[:6])
+
+        resp = self.request(path=path, user=user, params={
+            'include': 'phases'}, additionalHeaders=[
+            ('If-Modified-Since', lastModified)], isJson=False)
+        self.assertStatus(resp, 304)
+        resp = self.request(path=path, user=user, params={
+            'include': 'phases'}, additionalHeaders=[
+            ('If-None-Match', resp.headers['ETag'])], isJson=False)
+        self.assertStatus(resp, 304)
+
+        resp = self.request(path=path, user=user,
+                            params={'include': 'users'})
+        self.assertStatus(resp, 400)
+
+    def testLoadPhasesByIds(self):
+        from girder.plugins.challenge.rest.phase import MAX_IDS
+        user = self.model('user').createUser(
+            login='user', password='password', firstName='User',
+            lastName='User', email='user@example.com')
+        phaseModel = self.model('phase', 'challenge')
+        challenge = self.challengeModel.createChallenge('A', self.admin)
+        private = phaseModel.createPhase(
+            'Private', challenge, self.admin, public=False)
+        public = phaseModel.createPhase('Public', challenge, self.admin)
+        ids = [str(id) for id in (
+            private['_id'], ObjectId(), public['_id'])]
+
+        # Phases that do not exist or cannot be read are left out, and the
+        # others keep the requested order
+        resp = self.request(path='/challenge_phase', user=user,
+                            params={'ids': json.dumps(ids)})
+        self.assertStatusOk(resp)
+        self.assertEqual([p['_id'] for p in resp.json], [ids[2]])
+        resp = self.request(path='/challenge_phase',
+                            params={'ids': json.dumps(ids)})
+        self.assertStatusOk(resp)
+        self.assertEqual([p['_id'] for p in resp.json], [ids[2]])
+        resp = self.request(path='/challenge_phase', user=self.admin,
+                            params={'ids': json.dumps(ids)})
+        self.assertStatusOk(resp)
+        self.assertEqual([p['_id'] for p in resp.json], [ids[0], ids[2]])
+
+        resp = self.request(path='/challenge_phase', user=self.admin,
+                            params={'ids': json.dumps(ids * MAX_IDS)})
+        self.assertStatus(resp, 400)
+        for bad in ('nope', '{}', '["nope"]'):
+            resp = self.request(path='/challenge_phase', user=self.admin,
+                                params={'ids': bad})
+            self.assertStatus(resp, 400)
+
+    def testBackgroundDelete(self):
+        phaseModel = self.model('phase', 'challenge')
+        submissionModel = self.model('submission', 'challenge')
+        challenge = self.challengeModel.createChallenge('A', self.admin)
+        phases = [phaseModel.createPhase(name, challenge, self.admin)
+                  for name in ('P1', 'P2')]
+        submissions = submissionModel.createSubmissions(
+            phases[0], self.admin, [{'title': 'S1'}, {'title': 'S2'}])
+        submissionModel.createSubmissions(
+            phases[1], self.admin, [{'title': 'S3'}])
+        self.model('leaderboard', 'challenge').updateScores(phases[0], [{
+            '_id': submissions[0]['_id'], 'creatorId': self.admin['_id'],
+            'score': 0.5}])
+        other = self.challengeModel.createChallenge('B', self.admin)
+        phaseModel.createPhase('P1', other, self.admin)
+
+        # The challenge, its phases and their submissions
+        self.assertEqual(self.challengeModel.subtreeCount(challenge), 6)
+        self.assertEqual(phaseModel.subtreeCount(phases[0]), 3)
+
+        resp = self.request(path='/challenge/%s' % challenge['_id'],
+                            method='DELETE', user=self.admin)
+        self.assertStatusOk(resp)
+        notificationModel = self.model('notification')
+        deadline = time.time() + 10
+        while True:
+            progress = notificationModel.load(resp.json['jobId'])['data']
+            if progress['state'] in (ProgressState.SUCCESS,
+                                     ProgressState.ERROR):
+                break
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.05)
+        self.assertEqual(progress['state'], ProgressState.SUCCESS)
+        self.assertEqual((progress['current'], progress['total']), (6, 6))
+
+        self.assertIsNone(self.challengeModel.load(
+            challenge['_id'], force=True))
+        for modelName in ('phase', 'submission', 'job', 'leaderboard'):
+            self.assertEqual(self.model(modelName, 'challenge').find(
+                {'challengeId': challenge['_id']}).count(), 0, modelName)
+        # Other challenges are left alone
+        self.assertEqual(phaseModel.find(
+            {'challengeId': other['_id']}).count(), 1)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import cherrypy
+import json
+
+from girder.constants import AccessType
+from girder.utility.config import getConfig
+
+from tests import base
+
+
+def setUpModule():
+    # No job worker, which would race the tests on the database
+    getConfig().setdefault('challenge', {})['job_workers'] = 0
+    base.enabledPlugins.append('challenge')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+def nextEvent(stream):
+    """
+    Return the next event of a stream other than a keepalive, as a
+    (type, data) pair.
+    """
+    while True:
+        event = next(stream).decode('utf8')
+        if not event.startswith(':'):
+            break
+    fields = dict(line.split(': ', 1) for line in event.strip().split('\n'))
+    return fields.get('event'), json.loads(fields.get('data', 'null'))
+
+
+class FeedTestCase(base.TestCase):
+    def setUp(self):
+        base.TestCase.setUp(self)
+        from girder.plugins.challenge import feed
+        self.feed = feed
+        self.admin, self.user = [
+            self.model('user').createUser(
+                login=login, password='password', firstName=login,
+                lastName='Test', email='%s@example.com' % login)
+            for login in ('admin', 'user')]
+        self.streams = []
+
+    def tearDown(self):
+        # Release the subscriptions of the streams
+        for stream in self.streams:
+            stream.close()
+        base.TestCase.tearDown(self)
+
+    def stream(self, user, **kwargs):
+        stream = self.feed.eventStream(
+            'user:%s' % user['_id'], user, heartbeat=0.01, **kwargs)
+        self.streams.append(stream)
+        # Subscribe
+        self.assertEqual(next(stream), b'retry: 5000\n\n')
+        return stream
+
+    def testSubscriptions(self):
+        feed = self.feed.ChangeFeed(maxSubscribers=2, maxPerClient=1)
+        feed.publish('challenge', 'update', {'_id': 1})
+        first = feed.subscribe('a')
+        self.assertIsNotNone(first)
+        self.assertFalse(feed.canSubscribe('a'))
+        self.assertIsNone(feed.subscribe('a'))
+        second = feed.subscribe('b')
+        self.assertIsNone(feed.subscribe('c'))
+
+        feed.publish('challenge', 'update', {'_id': 2})
+        for subscription in (first, second):
+            change = subscription.get(0)
+            self.assertEqual((change.kind, change.action, change.doc),
+                             ('challenge', 'update', {'_id': 2}))
+            self.assertIsNone(subscription.get(0))
+
+        feed.unsubscribe(second)
+        self.assertTrue(feed.canSubscribe('c'))
+
+    def testPublish(self):
+        stream = self.stream(self.user)
+        challenge = self.model('challenge', 'challenge').createChallenge(
+            'Public', self.admin)
+        event, data = nextEvent(stream)
+        self.assertEqual(event, 'challenge')
+        self.assertEqual(data['action'], 'create')
+        self.assertEqual(data['doc']['_id'], str(challenge['_id']))
+        self.assertEqual(data['doc']['name'], 'Public')
+
+        self.model('challenge', 'challenge').remove(challenge)
+        event, data = nextEvent(stream)
+        self.assertEqual((event, data), ('challenge', {
+            'action': 'remove', 'doc': {'_id': str(challenge['_id'])}}))
+
+    def testAccessFiltering(self):
+        challengeModel = self.model('challenge', 'challenge')
+        stream = self.stream(self.user)
+        private = challengeModel.createChallenge(
+            'Private', self.admin, public=False)
+        group = self.model('group').createGroup('Readers', self.admin)
+        private = challengeModel.setGroupAccess(
+            private, group, AccessType.READ, save=True)
+        public = challengeModel.createChallenge('Public', self.admin)
+        # The changes to the private challenge are skipped
+        event, data = nextEvent(stream)
+        self.assertEqual(data['doc']['_id'], str(public['_id']))
+
+        # Access gained after subscribing applies to later changes
+        self.model('group').addUser(group, self.user, level=AccessType.READ)
+        challengeModel.save(private)
+        event, data = nextEvent(stream)
+        self.assertEqual((event, data['action'], data['doc']['_id']),
+                         ('challenge', 'update', str(private['_id'])))
+
+    def testOverflow(self):
+        feed = self.feed.getFeed()
+        maxEvents = feed.maxEvents
+        feed.maxEvents = 2
+        try:
+            stream = self.stream(self.user)
+        finally:
+            feed.maxEvents = maxEvents
+        challenge = self.model('challenge', 'challenge').createChallenge(
+            'Public', self.admin)
+        for _ in range(2):
+            feed.publish('challenge', 'update', challenge)
+        self.assertEqual(nextEvent(stream), ('overflow', {}))
+        with self.assertRaises(StopIteration):
+            next(stream)
+        self.assertTrue(feed.canSubscribe('user:%s' % self.user['_id']))
+
+    def testBusy(self):
+        feed = self.feed.getFeed()
+        maxPerClient = feed.maxPerClient
+        feed.maxPerClient = 1
+        try:
+            self.stream(self.user)
+            busy = self.feed.eventStream(
+                'user:%s' % self.user['_id'], self.user)
+            self.assertEqual(nextEvent(busy), ('busy', {}))
+        finally:
+            feed.maxPerClient = maxPerClient
+
+    def testThreadPool(self):
+        threadPool = cherrypy.server.thread_pool
+        cherrypy.server.thread_pool = 10
+        try:
+            size = self.feed.sizeThreadPool()
+            self.assertEqual(size, self.feed.getFeed().maxSubscribers + 10)
+            self.assertEqual(cherrypy.server.thread_pool, size)
+        finally:
+            cherrypy.server.thread_pool = threadPool
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+
+from girder.utility.config import getConfig
+
+from tests import base
+
+
+def setUpModule():
+    # No job worker, which would race the tests on the database
+    getConfig().setdefault('challenge', {})['job_workers'] = 0
+    base.enabledPlugins.append('challenge')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+class InstrumentationTestCase(base.TestCase):
+    def setUp(self):
+        base.TestCase.setUp(self)
+        from girder.plugins.challenge import instrumentation
+        self.instrumentation = instrumentation
+        self.admin = self.model('user').createUser(
+            login='admin', password='password', firstName='Admin',
+            lastName='Admin', email='admin@example.com')
+        self.model('challenge', 'challenge').createChallenge(
+            'Challenge', self.admin)
+        instrumentation.configure(True)
+
+    def tearDown(self):
+        self.instrumentation.configure(False)
+        base.TestCase.tearDown(self)
+
+    def samples(self):
+        resp = self.request(path='/challenge/metrics', user=self.admin,
+                            isJson=False)
+        self.assertStatusOk(resp)
+        body = self.getBody(resp)
+        self.assertIn('# TYPE challenge_route_seconds histogram', body)
+        self.assertIn('# TYPE challenge_model_mongo_commands histogram', body)
+        samples = {}
+        for line in body.splitlines():
+            if line and not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return samples
+
+    def testCommandCounts(self):
+        resp = self.request(path='/challenge', user=self.admin)
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json), 1)
+
+        samples = self.samples()
+        model = '{name="challenge.list"}'
+        route = '{name="challenge.listChallenges"}'
+        self.assertEqual(samples['challenge_model_seconds_count' + model], 1)
+        self.assertEqual(samples[
+            'challenge_model_seconds_bucket{name="challenge.list",le="+Inf"}'],
+            1)
+        # The page is read within the timed call
+        self.assertGreater(
+            samples['challenge_model_mongo_commands_sum' + model], 0)
+        self.assertGreater(
+            samples['challenge_route_mongo_commands_sum' + route], 0)
+        self.assertGreater(samples['challenge_route_seconds_sum' + route], 0)
+
+    def testDisabled(self):
+        self.instrumentation.configure(False)
+        counter = self.instrumentation._counter
+        before = counter.count()
+        self.model('challenge', 'challenge').findOne()
+        self.assertEqual(counter.count(), before)
+
+        self.instrumentation.configure(True)
+        self.model('challenge', 'challenge').findOne()
+        self.assertEqual(counter.count(), before + 1)
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import datetime
+
+from bson.objectid import ObjectId
+from girder.utility.config import getConfig
+
+from tests import base
+
+
+def setUpModule():
+    # Keep the job worker of the server from leasing the jobs under test
+    getConfig().setdefault('challenge', {})['job_workers'] = 0
+    base.enabledPlugins.append('challenge')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+def makePhase(**kwargs):
+    phase = {'_id': ObjectId(), 'challengeId': ObjectId(), 'active': True}
+    phase.update(kwargs)
+    return phase
+
+
+class JobTestCase(base.TestCase):
+    def setUp(self):
+        base.TestCase.setUp(self)
+        self.jobModel = self.model('job', 'challenge')
+        self.settings = (self.jobModel.leaseSeconds, self.jobModel.maxAttempts,
+                         self.jobModel.retryDelay,
+                         self.jobModel.phaseConcurrency,
+                         self.jobModel.enqueueDelay)
+
+    def tearDown(self):
+        (self.jobModel.leaseSeconds, self.jobModel.maxAttempts,
+         self.jobModel.retryDelay, self.jobModel.phaseConcurrency,
+         self.jobModel.enqueueDelay) = self.settings
+        base.TestCase.tearDown(self)
+
+    def testEnqueue(self):
+        phase = makePhase()
+        job = self.jobModel.enqueue('score', phase)
+        self.assertEqual(job['state'], 'queued')
+        self.assertEqual(job['phaseId'], phase['_id'])
+        self.assertEqual(job['challengeId'], phase['challengeId'])
+
+        # Identical queued jobs are merged, different parameters are not
+        self.assertEqual(self.jobModel.enqueue('score', phase)['_id'],
+                         job['_id'])
+        self.assertNotEqual(self.jobModel.enqueue(
+            'score', phase, {'rescore': True})['_id'], job['_id'])
+
+        # Jobs on whole challenges are only merged within a challenge
+        first = self.jobModel.enqueue('provision', {'_id': ObjectId()})
+        self.assertIsNone(first['phaseId'])
+        self.assertNotEqual(self.jobModel.enqueue(
+            'provision', {'_id': ObjectId()})['_id'], first['_id'])
+
+    def testEnqueueSoon(self):
+        self.jobModel.enqueueDelay = 60
+        phase, other = makePhase(), makePhase()
+        for _ in range(3):
+            self.jobModel.enqueueSoon('score', phase)
+        self.jobModel.enqueueSoon('score', other)
+        self.assertEqual(self.jobModel.find().count(), 0)
+
+        # Calls made meanwhile queue one job per phase
+        self.jobModel.flushPending()
+        self.assertEqual(sorted(job['phaseId'] for job in self.jobModel.find(
+            {'type': 'score'})), sorted([phase['_id'], other['_id']]))
+        self.jobModel.flushPending()
+        self.assertEqual(self.jobModel.find().count(), 2)
+
+        self.jobModel.enqueueDelay = 0
+        self.jobModel.enqueueSoon('rescore', phase)
+        self.assertEqual(self.jobModel.find({'type': 'rescore'}).count(), 1)
+
+    def testLeaseOrder(self):
+        inactive = makePhase(active=False)
+        late = makePhase(deadline=datetime.datetime(2030, 1, 1))
+        early = makePhase(deadline=datetime.datetime(2020, 1, 1))
+        urgent = makePhase(active=False)
+        for phase in (inactive, late, early):
+            self.jobModel.enqueue('score', phase)
+        self.jobModel.enqueue('provision', urgent)
+
+        order = []
+        while True:
+            job = self.jobModel.lease('worker')
+            if job is None:
+                break
+            self.assertEqual(job['state'], 'running')
+            self.assertEqual(job['attempts'], 1)
+            order.append(job['phaseId'])
+        self.assertEqual(order, [urgent['_id'], early['_id'], late['_id'],
+                                 inactive['_id']])
+
+    def testLeaseExpiry(self):
+        self.jobModel.retryDelay = 0
+        self.jobModel.enqueue('score', makePhase())
+        job = self.jobModel.lease('worker1')
+        self.assertTrue(self.jobModel.renewLease(job))
+        self.assertEqual(self.jobModel.reclaim(), 0)
+
+        self.jobModel.collection.update_one({'_id': job['_id']}, {'$set': {
+            'leaseExpires': datetime.datetime.utcnow() -
+            datetime.timedelta(seconds=1)}})
+        self.assertEqual(self.jobModel.reclaim(), 1)
+
+        # The first worker lost its lease; another one takes the job over
+        self.assertFalse(self.jobModel.renewLease(job))
+        retried = self.jobModel.lease('worker2')
+        self.assertEqual(retried['_id'], job['_id'])
+        self.assertEqual(retried['attempts'], 2)
+        self.assertIn('expired', retried['error'])
+
+        # The late completion of the first worker is ignored
+        self.jobModel.complete(job)
+        self.assertEqual(
+            self.jobModel.load(job['_id'])['state'], 'running')
+        self.jobModel.complete(retried)
+        self.assertEqual(
+            self.jobModel.load(job['_id'])['state'], 'done')
+
+    def testRetry(self):
+        self.jobModel.maxAttempts = 2
+        self.jobModel.retryDelay = 60
+        self.jobModel.enqueue('score', makePhase())
+
+        job = self.jobModel.lease('worker')
+        self.jobModel.fail(job, 'first failure')
+        job = self.jobModel.load(job['_id'])
+        self.assertEqual(job['state'], 'queued')
+        self.assertEqual(job['error'], 'first failure')
+        self.assertGreater(job['notBefore'], datetime.datetime.utcnow())
+        self.assertNotIn('slot', job)
+
+        # Not retried before its delay is over
+        self.assertIsNone(self.jobModel.lease('worker'))
+        self.jobModel.collection.update_one(
+            {'_id': job['_id']},
+            {'$set': {'notBefore': datetime.datetime.utcnow()}})
+
+        job = self.jobModel.lease('worker')
+        self.assertEqual(job['attempts'], 2)
+        self.jobModel.fail(job, 'second failure')
+        job = self.jobModel.load(job['_id'])
+        self.assertEqual(job['state'], 'error')
+        self.assertEqual(job['error'], 'second failure')
+        self.assertIsNone(self.jobModel.lease('worker'))
+
+    def testPhaseConcurrency(self):
+        phase = makePhase(deadline=datetime.datetime(2020, 1, 1))
+        other = makePhase(deadline=datetime.datetime(2030, 1, 1))
+        self.jobModel.enqueue('score', phase, {'n': 1})
+        self.jobModel.enqueue('score', phase, {'n': 2})
+        self.jobModel.enqueue('score', other)
+
+        # The second job of the phase waits, the other phase's job does not
+        first = self.jobModel.lease('worker1')
+        self.assertEqual(first['phaseId'], phase['_id'])
+        self.assertEqual(first['slot'], 0)
+        job = self.jobModel.lease('worker2')
+        self.assertEqual(job['phaseId'], other['_id'])
+        self.assertIsNone(self.jobModel.lease('worker3'))
+
+        waiting = self.jobModel.findOne({'state': 'queued'})
+        self.assertEqual(waiting['attempts'], 0)
+        self.assertNotIn('workerId', waiting)
+
+        self.jobModel.complete(first)
+        second = self.jobModel.lease('worker3')
+        self.assertEqual(second['phaseId'], phase['_id'])
+        self.assertNotEqual(second['_id'], first['_id'])
+
+        # A higher limit lets jobs of a phase run side by side
+        self.jobModel.phaseConcurrency = 2
+        self.jobModel.enqueue('score', phase, {'n': 3})
+        third = self.jobModel.lease('worker4')
+        self.assertEqual(third['phaseId'], phase['_id'])
+        self.assertEqual(third['slot'], 1)
+
+    def testRescoreChangedMetrics(self):
+        from girder.plugins.challenge.constants import PluginSettings
+        from girder.plugins.challenge.metrics import METRICS
+        phaseModel = self.model('phase', 'challenge')
+        settingModel = self.model('setting')
+        settingModel.unset(PluginSettings.METRIC_VERSIONS)
+
+        stale, current = makePhase(metric='dice'), makePhase(metric=None)
+        for phase in (stale, current):
+            phase['groundTruthFolderId'] = ObjectId()
+        phaseModel.collection.insert_many([stale, current])
+        version = METRICS['dice'].version
+        self.model('submission', 'challenge').collection.insert_many([{
+            'phaseId': phase['_id'],
+            'scored': datetime.datetime.utcnow(),
+            'scoreDetail': {'metric': 'dice', 'metricVersion': v}
+        } for phase, v in ((stale, version - 1), (current, version))])
+
+        # The first load records the versions without rescoring anything
+        phaseModel.rescoreChangedMetrics()
+        self.assertEqual(
+            settingModel.get(PluginSettings.METRIC_VERSIONS)['dice'], version)
+        self.assertEqual(self.jobModel.find().count(), 0)
+
+        # Only phases scored with another version are rescored
+        settingModel.set(PluginSettings.METRIC_VERSIONS, {'dice': version - 1})
+        phaseModel.rescoreChangedMetrics()
+        self.assertEqual([job['phaseId'] for job in self.jobModel.find()],
+                         [stale['_id']])
+        self.assertEqual(
+            settingModel.get(PluginSettings.METRIC_VERSIONS)['dice'], version)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import datetime
+
+from bson.objectid import ObjectId
+from girder.utility.config import getConfig
+
+from tests import base
+
+
+def setUpModule():
+    # No job worker, which would race the tests on the database
+    getConfig().setdefault('challenge', {})['job_workers'] = 0
+    base.enabledPlugins.append('challenge')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+class LeaderboardTestCase(base.TestCase):
+    def setUp(self):
+        base.TestCase.setUp(self)
+        self.users = [
+            self.model('user').createUser(
+                login=login, password='password', firstName=login,
+                lastName='Test', email='%s@example.com' % login)
+            for login in ('admin', 'first', 'second', 'third', 'fourth')]
+        self.admin = self.users.pop(0)
+        challenge = self.model('challenge', 'challenge').createChallenge(
+            'Challenge', self.admin)
+        self.phase = self.model('phase', 'challenge').createPhase(
+            'Phase', challenge, self.admin, active=True)
+        self.leaderboardModel = self.model('leaderboard', 'challenge')
+        self.submissionModel = self.model('submission', 'challenge')
+
+    def scored(self, user, score):
+        """
+        Store a scored submission by a user, without queueing it for scoring.
+        """
+        submission = {
+            'phaseId': self.phase['_id'],
+            'challengeId': self.phase['challengeId'],
+            'creatorId': user['_id'],
+            'created': datetime.datetime.utcnow(),
+            'score': score,
+            'scored': datetime.datetime.utcnow()
+        }
+        submission['_id'] = self.submissionModel.collection.insert_one(
+            submission).inserted_id
+        return submission
+
+    def entries(self):
+        return {e['userId']: (e['score'], e['submissionId'])
+                for e in self.leaderboardModel.list(self.phase, limit=0)}
+
+    def testUpdateScores(self):
+        user = self.users[0]
+        first, worse, better, tie = [{
+            '_id': ObjectId(), 'creatorId': user['_id'], 'score': score
+        } for score in (0.5, 0.3, 0.8, 0.8)]
+        self.leaderboardModel.updateScores(self.phase, [first])
+        self.assertEqual(self.entries(), {user['_id']: (0.5, first['_id'])})
+
+        # Only a strictly better score replaces the entry
+        self.leaderboardModel.updateScores(self.phase, [worse])
+        self.assertEqual(self.entries(), {user['_id']: (0.5, first['_id'])})
+        self.leaderboardModel.updateScores(self.phase, [better])
+        self.assertEqual(self.entries(), {user['_id']: (0.8, better['_id'])})
+        self.leaderboardModel.updateScores(self.phase, [tie])
+        self.assertEqual(self.entries(), {user['_id']: (0.8, better['_id'])})
+
+        # Unscored submissions are ignored
+        self.leaderboardModel.updateScores(self.phase, [{
+            '_id': ObjectId(), 'creatorId': self.users[1]['_id'],
+            'score': None}])
+        self.assertEqual(len(self.entries()), 1)
+
+        # Lower is better for some metrics
+        self.phase['metric'] = 'hausdorff'
+        self.leaderboardModel.updateScores(self.phase, [worse])
+        self.assertEqual(self.entries(), {user['_id']: (0.3, worse['_id'])})
+
+    def testRefreshUsers(self):
+        user = self.users[0]
+        best, other = self.scored(user, 0.9), self.scored(user, 0.4)
+        self.leaderboardModel.updateScores(self.phase, [best, other])
+        self.assertEqual(self.entries(), {user['_id']: (0.9, best['_id'])})
+
+        # Removing the best submission falls back to the next best one, and
+        # removing the last one removes the entry
+        self.submissionModel.remove(best)
+        self.assertEqual(self.entries(), {user['_id']: (0.4, other['_id'])})
+        self.submissionModel.remove(other)
+        self.assertEqual(self.entries(), {})
+
+    def testRebuild(self):
+        first, second = self.users[:2]
+        self.scored(first, 0.2)
+        best = self.scored(first, 0.6)
+        self.scored(second, None)
+        self.leaderboardModel.updateScores(self.phase, [{
+            '_id': ObjectId(), 'creatorId': second['_id'], 'score': 1.0}])
+
+        self.leaderboardModel.rebuild(self.phase)
+        self.assertEqual(self.entries(), {first['_id']: (0.6, best['_id'])})
+
+    def testRanks(self):
+        for user, score in zip(self.users, (0.5, 0.7, 0.9, 0.7)):
+            self.leaderboardModel.updateScores(self.phase, [
+                self.scored(user, score)])
+
+        entries = self.leaderboardModel.list(self.phase)
+        self.assertEqual([(e['score'], e['rank']) for e in entries],
+                         [(0.9, 1), (0.7, 2), (0.7, 2), (0.5, 4)])
+        # Pages starting within ties rank the same way
+        entries = self.leaderboardModel.list(self.phase, limit=2, offset=2)
+        self.assertEqual([(e['score'], e['rank']) for e in entries],
+                         [(0.7, 2), (0.5, 4)])
+
+        ranks = [self.leaderboardModel.getRank(self.phase, user)['rank']
+                 for user in self.users]
+        self.assertEqual(ranks, [4, 2, 1, 2])
+        self.assertIsNone(self.leaderboardModel.getRank(
+            self.phase, self.admin))
+
+        resp = self.request(
+            path='/challenge_phase/%s/leaderboard' % self.phase['_id'],
+            user=self.admin, params={'offset': 1})
+        self.assertStatusOk(resp)
+        self.assertEqual([e['rank'] for e in resp.json], [2, 2, 4])
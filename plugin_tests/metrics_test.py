@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import os
+import shutil
+import tempfile
+
+import numpy
+import six
+from girder.utility.config import getConfig
+
+from tests import base
+
+
+def setUpModule():
+    # No job worker, which would race the tests on the database
+    getConfig().setdefault('challenge', {})['job_workers'] = 0
+    base.enabledPlugins.append('challenge')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+class MetricsTestCase(base.TestCase):
+    def setUp(self):
+        base.TestCase.setUp(self)
+        from girder.plugins.challenge import metrics
+        self.metrics = metrics
+
+    def testDice(self):
+        a = numpy.array([[1, 1, 0, 0]])
+        b = numpy.array([[0, 1, 1, 0]])
+        self.assertAlmostEqual(self.metrics.dice(a, a), 1.0)
+        self.assertAlmostEqual(self.metrics.dice(a, b), 0.5)
+        self.assertAlmostEqual(self.metrics.dice(a, 1 - a), 0.0)
+        empty = numpy.zeros((1, 4))
+        self.assertEqual(self.metrics.dice(empty, empty), 1.0)
+        self.assertEqual(self.metrics.dice(empty, a), 0.0)
+        self.assertEqual(self.metrics.jaccard(empty, empty), 1.0)
+        self.assertAlmostEqual(self.metrics.jaccard(a, b), 1.0 / 3)
+
+        with self.assertRaises(ValueError):
+            self.metrics.dice(a, numpy.zeros((2, 4)))
+
+    def testHausdorff(self):
+        a = numpy.array([[1, 0, 0, 0]])
+        b = numpy.array([[0, 0, 0, 1]])
+        self.assertEqual(self.metrics.hausdorff(a, a), 0.0)
+        self.assertEqual(self.metrics.hausdorff(a, b), 3.0)
+
+        # Empty masks: both empty is a perfect match, one empty is undefined
+        empty = numpy.zeros((1, 4))
+        self.assertEqual(self.metrics.hausdorff(empty, empty), 0.0)
+        self.assertIsNone(self.metrics.hausdorff(empty, a))
+        self.assertIsNone(self.metrics.hausdorff(a, empty))
+
+    def testAuc(self):
+        labels = numpy.array([0, 0, 1, 1])
+        self.assertEqual(self.metrics.auc(
+            numpy.array([0.1, 0.2, 0.3, 0.4]), labels), 1.0)
+        self.assertEqual(self.metrics.auc(
+            numpy.array([0.4, 0.3, 0.2, 0.1]), labels), 0.0)
+
+        # Tied scores count as half a correctly ordered pair
+        self.assertEqual(self.metrics.auc(
+            numpy.array([0.1, 0.4, 0.4, 0.8]), labels), 0.875)
+        self.assertEqual(self.metrics.auc(numpy.full(4, 0.5), labels), 0.5)
+
+        with self.assertRaises(ValueError):
+            self.metrics.auc(numpy.array([0.1, 0.2]), numpy.array([1, 1]))
+
+    def testAccuracy(self):
+        self.assertEqual(self.metrics.accuracy(
+            numpy.array([1, 2, 3, 4]), numpy.array([1, 2, 0, 4])), 0.75)
+        with self.assertRaises(ValueError):
+            self.metrics.accuracy(numpy.array([]), numpy.array([]))
+
+    def testUndefinedScore(self):
+        from girder.plugins.challenge import scoring
+
+        def metric(submitted, groundTruth):
+            return None
+
+        engine = scoring.ScoringEngine(metric, processes=1)
+        results = list(engine.score({'a.npy': numpy.zeros(2)},
+                                    [('s', 'a.npy', numpy.zeros(2))]))
+        self.assertEqual(len(results), 1)
+        key, name, value, error = results[0]
+        self.assertIsNone(value)
+        self.assertIsNotNone(error)
+
+        scores = scoring.aggregate(results, ['a.npy'])
+        self.assertIsNone(scores['s']['score'])
+
+    def testPooledScoring(self):
+        from girder.plugins.challenge import scoring
+        truth = numpy.ones((4, 4), dtype=numpy.uint8)
+        data = six.BytesIO()
+        numpy.save(data, truth)
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'submitted')
+            with open(path, 'wb') as f:
+                f.write(data.getvalue())
+            tasks = [
+                (0, 'a.npy', scoring.EncodedFile(path, None, None)),
+                (0, 'b.npy', scoring.EncodedFile(
+                    None, data.getvalue(), None)),
+                # A file that cannot be decoded only fails its own pair
+                (1, 'a.npy', scoring.EncodedFile(None, b'garbage', None)),
+                (1, 'b.npy', truth)
+            ] * 5
+
+            engine = scoring.ScoringEngine(
+                self.metrics.dice, processes=2, chunksize=2, inFlight=2)
+            results = list(engine.score(
+                {'a.npy': truth, 'b.npy': truth}, iter(tasks)))
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(len(results), len(tasks))
+        scores = scoring.aggregate(results, ['a.npy', 'b.npy'])
+        self.assertEqual(scores[0]['score'], 1.0)
+        self.assertIsNone(scores[1]['score'])
+        self.assertEqual(set(e['name'] for e in scores[1]['errors']),
+                         {'a.npy'})
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import datetime
+
+from bson.objectid import ObjectId
+from bson.tz_util import utc
+from girder.api.rest import RestException
+from girder.constants import SortDir
+from girder.utility.config import getConfig
+
+from tests import base
+
+
+def setUpModule():
+    # No job worker, which would race the tests on the database
+    getConfig().setdefault('challenge', {})['job_workers'] = 0
+    base.enabledPlugins.append('challenge')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+class PaginationTestCase(base.TestCase):
+    def setUp(self):
+        base.TestCase.setUp(self)
+        from girder.plugins.challenge import utility
+        self.utility = utility
+
+        self.admin = self.model('user').createUser(
+            login='admin', password='password', firstName='Admin',
+            lastName='Admin', email='admin@example.com')
+
+    def testCursorRoundTrip(self):
+        id = ObjectId()
+        # Cursors decode dates as timezone-aware
+        created = datetime.datetime(2016, 1, 2, 3, 4, 5, tzinfo=utc)
+        for sort, value in (([('name', SortDir.ASCENDING)], 'Name'),
+                            ([('created', SortDir.DESCENDING)], created),
+                            (None, id)):
+            field = self.utility.keysetSort(sort)[0][0]
+            cursor = self.utility.encodeCursor(
+                {'_id': id, field: value}, sort)
+            self.assertEqual(self.utility.decodeCursor(cursor), (value, id))
+
+        for cursor in ('', 'garbage', 'bm90IGpzb24='):
+            with self.assertRaises(ValueError):
+                self.utility.decodeCursor(cursor)
+
+    def testKeysetQuery(self):
+        id = ObjectId()
+        sort = self.utility.keysetSort([('name', SortDir.ASCENDING)])
+        self.assertEqual(sort, [('name', SortDir.ASCENDING),
+                                ('_id', SortDir.ASCENDING)])
+        self.assertEqual(self.utility.keysetQuery(sort, ('b', id)), {'$or': [
+            {'name': {'$gt': 'b'}},
+            {'name': 'b', '_id': {'$gt': id}}
+        ]})
+
+        sort = self.utility.keysetSort([('created', SortDir.DESCENDING)])
+        self.assertEqual(sort[-1], ('_id', SortDir.DESCENDING))
+        self.assertEqual(self.utility.keysetQuery(sort, (None, id)), {'$or': [
+            {'created': None, '_id': {'$lt': id}}
+        ]})
+
+        sort = self.utility.keysetSort(None)
+        self.assertEqual(sort, [('_id', SortDir.ASCENDING)])
+        self.assertEqual(self.utility.keysetQuery(sort, (id, id)),
+                         {'_id': {'$gt': id}})
+
+    def testListingPages(self):
+        model = self.model('challenge', 'challenge')
+        names = ['Challenge %d' % i for i in range(5)]
+        for name in reversed(names):
+            model.createChallenge(name, self.admin)
+
+        seen = []
+        params = {'limit': 2}
+        while True:
+            resp = self.request(path='/challenge', user=self.admin,
+                                params=params)
+            self.assertStatusOk(resp)
+            seen += [c['name'] for c in resp.json]
+            after = resp.headers.get('Girder-Next-After')
+            if after is None:
+                break
+            # The cursor takes precedence over the offset
+            params = {'limit': 2, 'after': after, 'offset': 100}
+        self.assertEqual(seen, names)
+
+        resp = self.request(path='/challenge', user=self.admin,
+                            params={'after': 'garbage'})
+        self.assertStatus(resp, 400)
+
+    def testNullSortValues(self):
+        challenge = self.model('challenge', 'challenge').createChallenge(
+            'Deadlines', self.admin)
+        phaseModel = self.model('phase', 'challenge')
+        for i in range(6):
+            # Every other phase has no deadline
+            deadline = datetime.datetime(2020, 1, 6 - i) if i % 2 else None
+            phaseModel.createPhase('Phase %d' % i, challenge, self.admin,
+                                   deadline=deadline)
+        # Legacy phases may lack the field altogether
+        phaseModel.collection.update_one(
+            {'challengeId': challenge['_id'], 'name': 'Phase 0'},
+            {'$unset': {'deadline': ''}})
+
+        for sortdir in (1, -1):
+            params = {'challengeId': challenge['_id'], 'sort': 'deadline',
+                      'sortdir': sortdir}
+            resp = self.request(path='/challenge_phase', user=self.admin,
+                                params=dict(params, limit=0))
+            self.assertStatusOk(resp)
+            expected = [p['_id'] for p in resp.json]
+            self.assertEqual(len(expected), 6)
+
+            seen = []
+            after = None
+            while True:
+                page = dict(params, limit=2)
+                if after is not None:
+                    page['after'] = after
+                resp = self.request(path='/challenge_phase', user=self.admin,
+                                    params=page)
+                self.assertStatusOk(resp)
+                seen += [p['_id'] for p in resp.json]
+                after = resp.headers.get('Girder-Next-After')
+                if after is None:
+                    break
+            self.assertEqual(seen, expected)
+
+    def testFields(self):
+        self.assertEqual(self.utility.listFields(
+            {'fields': 'name, access.users,access,meta.a.b'}, ()),
+            ['name', 'access', 'meta'])
+        with self.assertRaises(RestException):
+            self.utility.listFields({'fields': '$where'}, ())
+
+        self.model('challenge', 'challenge').createChallenge(
+            'Challenge', self.admin)
+        resp = self.request(path='/challenge', user=self.admin,
+                            params={'fields': 'name,access.users'})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json[0]['name'], 'Challenge')
+        self.assertNotIn('description', resp.json[0])
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import datetime
+
+from girder.utility.config import getConfig
+
+from tests import base
+
+PAST = datetime.datetime(2000, 1, 1)
+
+
+def setUpModule():
+    # No job worker, which would race the tests on the database
+    getConfig().setdefault('challenge', {})['job_workers'] = 0
+    base.enabledPlugins.append('challenge')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+class ParticipantTestCase(base.TestCase):
+    def setUp(self):
+        base.TestCase.setUp(self)
+        self.admin, self.user1, self.user2 = [
+            self.model('user').createUser(
+                login=login, password='password', firstName=login,
+                lastName='Test', email='%s@example.com' % login)
+            for login in ('admin', 'user1', 'user2')]
+        challenge = self.model('challenge', 'challenge').createChallenge(
+            'Challenge', self.admin)
+        self.phase = self.model('phase', 'challenge').createPhase(
+            'Phase', challenge, self.admin)
+        self.initial = self.count = self.phase['participantCount']
+        self.resetUpdated()
+
+    def resetUpdated(self):
+        self.model('phase', 'challenge').collection.update_one(
+            {'_id': self.phase['_id']}, {'$set': {'updated': PAST}})
+
+    def assertParticipants(self, added):
+        phase = self.model('phase', 'challenge').load(
+            self.phase['_id'], force=True)
+        self.assertEqual(phase['participantCount'], self.initial + added)
+        # Count changes must move the date Last-Modified is derived from
+        if phase['participantCount'] != self.count:
+            self.assertGreater(phase['updated'], PAST)
+            self.count = phase['participantCount']
+            self.resetUpdated()
+        self.assertEqual(phase['participantCount'], self.model(
+            'phase', 'challenge').countMembers(
+            [phase['participantGroupId']])[phase['participantGroupId']])
+
+    def testGroupEndpoints(self):
+        groupPath = '/group/%s' % self.phase['participantGroupId']
+        resp = self.request(
+            path='/challenge_phase/%s/participant' % self.phase['_id'],
+            method='POST', user=self.user1)
+        self.assertStatusOk(resp)
+        self.assertParticipants(1)
+
+        # Joining through an invitation
+        resp = self.request(path=groupPath + '/invitation', method='POST',
+                            user=self.admin,
+                            params={'userId': self.user2['_id']})
+        self.assertStatusOk(resp)
+        self.assertParticipants(1)
+        user2 = self.model('user').load(self.user2['_id'], force=True)
+        resp = self.request(path=groupPath + '/member', method='POST',
+                            user=user2)
+        self.assertStatusOk(resp)
+        self.assertParticipants(2)
+
+        # Leaving, then being added back directly
+        user2 = self.model('user').load(self.user2['_id'], force=True)
+        resp = self.request(path=groupPath + '/member', method='DELETE',
+                            user=user2)
+        self.assertStatusOk(resp)
+        self.assertParticipants(1)
+        resp = self.request(path=groupPath + '/invitation', method='POST',
+                            user=self.admin, params={
+                                'userId': self.user2['_id'], 'force': True})
+        self.assertStatusOk(resp)
+        self.assertParticipants(2)
+
+        # Being removed by a group administrator
+        resp = self.request(path=groupPath + '/member', method='DELETE',
+                            user=self.admin,
+                            params={'userId': self.user1['_id']})
+        self.assertStatusOk(resp)
+        self.assertParticipants(1)
+
+        # Deleted users are no longer counted
+        resp = self.request(path='/user/%s' % self.user2['_id'],
+                            method='DELETE', user=self.admin)
+        self.assertStatusOk(resp)
+        self.assertParticipants(0)
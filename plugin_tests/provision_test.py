@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import datetime
+import json
+
+from girder.constants import AccessType
+from girder.utility.config import getConfig
+
+from tests import base
+
+
+def setUpModule():
+    # Provision deferred documents in the tests rather than in a job worker
+    getConfig().setdefault('challenge', {})['job_workers'] = 0
+    base.enabledPlugins.append('challenge')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+class ProvisionTestCase(base.TestCase):
+    def setUp(self):
+        base.TestCase.setUp(self)
+        self.admin = self.model('user').createUser(
+            login='admin', password='password', firstName='Admin',
+            lastName='Admin', email='admin@example.com')
+
+    def bulk(self, specs):
+        return self.request(path='/challenge/bulk', method='POST',
+                            user=self.admin,
+                            params={'challenges': json.dumps(specs)})
+
+    def testBulk(self):
+        specs = [{'name': 'A', 'public': True, 'phases': [
+            {'name': 'P1'}, {'name': 'P2', 'public': True}]}, {'name': 'B'}]
+        resp = self.bulk(specs)
+        self.assertStatusOk(resp)
+        self.assertEqual([c['wasCreated'] for c in resp.json], [True, True])
+        phase = self.model('phase', 'challenge').load(
+            resp.json[0]['phases'][1]['_id'], force=True)
+
+        collection = self.model('collection').findOne({'name': 'A'})
+        self.assertTrue(collection['public'])
+        self.assertEqual(collection['lowerName'], 'a')
+        self.assertIn({'id': self.admin['_id'], 'level': AccessType.ADMIN},
+                      collection['access']['users'])
+
+        folder = self.model('folder').load(phase['folderId'], force=True)
+        self.assertEqual((folder['name'], folder['parentId'],
+                          folder['baseParentId']),
+                         ('P2', collection['_id'], collection['_id']))
+        self.assertTrue(folder['public'])
+        groundTruth = self.model('folder').load(
+            phase['groundTruthFolderId'], force=True)
+        self.assertEqual((groundTruth['parentId'], groundTruth['baseParentId'],
+                          groundTruth['parentCollection']),
+                         (folder['_id'], collection['_id'], 'folder'))
+        self.assertFalse(groundTruth['public'])
+
+        # The creator is an administrator member of the participant groups
+        group = self.model('group').load(phase['participantGroupId'],
+                                         force=True)
+        self.assertEqual(group['lowerName'], 'a p2 participants')
+        admin = self.model('user').load(self.admin['_id'], force=True)
+        self.assertIn(group['_id'], admin['groups'])
+        self.assertIn({'id': self.admin['_id'], 'level': AccessType.ADMIN},
+                      group['access']['users'])
+        self.assertEqual(phase['participantCount'], 1)
+
+        # Provisioning again creates nothing
+        resp = self.bulk(specs)
+        self.assertStatusOk(resp)
+        self.assertEqual([c['wasCreated'] for c in resp.json], [False, False])
+        self.assertEqual(self.model('collection').find(
+            {'name': 'A'}).count(), 1)
+        self.assertEqual(self.model('folder').find(
+            {'parentId': collection['_id']}).count(), 2)
+        self.assertEqual(self.model('group').find(
+            {'lowerName': 'a p2 participants'}).count(), 1)
+
+    def testInvalidSpecs(self):
+        for specs in ([{'name': 'C', 'description': 5}],
+                      [{'name': 'C', 'phases': [
+                          {'name': 'P', 'instructions': ['a']}]}]):
+            resp = self.bulk(specs)
+            self.assertStatus(resp, 400)
+        self.assertIsNone(self.model('collection').findOne({'name': 'C'}))
+
+    def testDeferred(self):
+        challengeModel = self.model('challenge', 'challenge')
+        phaseModel = self.model('phase', 'challenge')
+        challenge = challengeModel.createChallenge(
+            'D', self.admin, defer=True)
+        phase = phaseModel.createPhase(
+            'P', challenge, self.admin, defer=True)
+        self.assertEqual((challenge['state'], phase['state']),
+                         ('provisioning', 'provisioning'))
+        self.assertIsNone(phase['folderId'])
+
+        # Provisioning changes the documents, so it must move the date
+        # Last-Modified is derived from
+        past = datetime.datetime(2000, 1, 1)
+        challengeModel.collection.update_one(
+            {'_id': challenge['_id']}, {'$set': {'updated': past}})
+        phaseModel.collection.update_one(
+            {'_id': phase['_id']}, {'$set': {'updated': past}})
+        phase = phaseModel.provision(
+            phaseModel.load(phase['_id'], force=True), self.admin)
+        challenge = challengeModel.load(challenge['_id'], force=True)
+        self.assertEqual((challenge['state'], phase['state']),
+                         ('ready', 'ready'))
+        self.assertIsNotNone(phase['folderId'])
+        self.assertGreater(challenge['updated'], past)
+        self.assertGreater(phase['updated'], past)
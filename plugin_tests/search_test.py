@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import json
+
+from girder.utility.config import getConfig
+
+from tests import base
+
+
+def setUpModule():
+    # No job worker, which would race the tests on the database
+    getConfig().setdefault('challenge', {})['job_workers'] = 0
+    base.enabledPlugins.append('challenge')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+class SearchTestCase(base.TestCase):
+    def setUp(self):
+        base.TestCase.setUp(self)
+        self.admin, self.user = [
+            self.model('user').createUser(
+                login=login, password='password', firstName=login,
+                lastName='Test', email='%s@example.com' % login)
+            for login in ('admin', 'user')]
+        challengeModel = self.model('challenge', 'challenge')
+        challenge = challengeModel.createChallenge('Lung Nodules', self.admin)
+        challengeModel.createChallenge('Lung Private', self.admin,
+                                       public=False)
+        challengeModel.createChallenge('Liver', self.admin)
+        self.model('phase', 'challenge').createPhase(
+            'Lung Final', challenge, self.admin)
+
+    def search(self, user, **params):
+        params.setdefault('types', json.dumps(
+            ['challenge_challenge', 'challenge_phase']))
+        return self.request(path='/resource/search', user=user,
+                            params=dict(params, mode='prefix'))
+
+    def testPrefixSearch(self):
+        resp = self.search(self.user, q='lung')
+        self.assertStatusOk(resp)
+        self.assertEqual(
+            [c['name'] for c in resp.json['challenge_challenge']],
+            ['Lung Nodules'])
+        self.assertEqual([p['name'] for p in resp.json['challenge_phase']],
+                         ['Lung Final'])
+
+        resp = self.search(self.admin, q='LUNG', limit=1)
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json['challenge_challenge']), 1)
+
+        for params in ({'limit': 'abc'}, {'offset': 'abc'}, {'limit': -1}):
+            resp = self.search(self.user, q='lung', **params)
+            self.assertStatus(resp, 400)
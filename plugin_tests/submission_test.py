@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import csv
+import gzip
+import hashlib
+import json
+
+import numpy
+import six
+from girder.utility.config import getConfig
+
+from tests import base
+
+
+def setUpModule():
+    # Score in the tests rather than in the server's job worker, and queue
+    # jobs before each test ends
+    getConfig().setdefault('challenge', {}).update(
+        job_workers=0, job_enqueue_delay=0)
+    base.enabledPlugins.append('challenge')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+class SubmissionTestCase(base.TestCase):
+    def setUp(self):
+        base.TestCase.setUp(self)
+        self.admin, self.user = [
+            self.model('user').createUser(
+                login=login, password='password', firstName=login,
+                lastName='Test', email='%s@example.com' % login)
+            for login in ('admin', 'user')]
+        challenge = self.model('challenge', 'challenge').createChallenge(
+            'Challenge', self.admin)
+        self.phase = self.model('phase', 'challenge').createPhase(
+            'Phase', challenge, self.admin, active=True)
+        self.model('phase', 'challenge').addParticipant(self.phase, self.user)
+
+    def npy(self, array):
+        data = six.BytesIO()
+        numpy.save(data, array)
+        return data.getvalue()
+
+    def upload(self, name, data, **params):
+        params.setdefault('size', len(data))
+        params.update({'phaseId': self.phase['_id'], 'name': name})
+        return self.request(
+            path='/challenge_submission/upload', method='POST',
+            user=self.user, params=params, body=data,
+            type='application/octet-stream')
+
+    def batch(self, submissions):
+        return self.request(
+            path='/challenge_submission/batch', method='POST', user=self.user,
+            params={'phaseId': self.phase['_id'],
+                    'submissions': json.dumps(submissions)})
+
+    def testBatchMetadata(self):
+        for meta in ({'$set': 1}, {'a.b': 1}, {'a': {'$gt': 1}},
+                     {'a': [{'b.c': 1}]}):
+            resp = self.batch([{'title': 'Good', 'meta': {'a': 1}},
+                               {'title': 'Bad', 'meta': meta}])
+            self.assertStatus(resp, 400)
+            self.assertEqual(resp.json['field'], 'meta')
+        submissionModel = self.model('submission', 'challenge')
+        self.assertEqual(submissionModel.find(
+            {'phaseId': self.phase['_id']}).count(), 0)
+
+        resp = self.batch([{'title': 'First', 'meta': {'a': {'b': [1]}}},
+                           {'title': 'Second'}])
+        self.assertStatusOk(resp)
+        self.assertEqual(submissionModel.find(
+            {'phaseId': self.phase['_id']}).count(), 2)
+
+    def putFile(self, folderId, name, data, user):
+        folder = self.model('folder').load(folderId, force=True)
+        return self.model('upload').uploadFromFile(
+            six.BytesIO(data), len(data), name, parentType='folder',
+            parent=folder, user=user)
+
+    def testAddFileRescores(self):
+        for name in ('a.npy', 'b.npy'):
+            self.putFile(self.phase['groundTruthFolderId'], name, self.npy(
+                numpy.ones((2, 2), dtype=numpy.uint8)), self.admin)
+
+        resp = self.upload('a.npy', self.npy(numpy.ones((2, 2), numpy.uint8)))
+        self.assertStatusOk(resp)
+        submissionId = resp.json['_id']
+        submissionModel = self.model('submission', 'challenge')
+        submissionModel.scorePhase(self.phase, processes=1)
+        submission = submissionModel.load(submissionId, force=True)
+        self.assertIn('scored', submission)
+        self.assertIsNone(submission['score'])
+        self.assertEqual(submission['scoreDetail']['errors'],
+                         [{'name': 'b.npy', 'error': 'Missing file.'}])
+
+        # Adding the missing file makes the submission unscored again
+        resp = self.upload('b.npy', self.npy(numpy.ones((2, 2), numpy.uint8)),
+                           submissionId=submissionId)
+        self.assertStatusOk(resp)
+        submission = submissionModel.load(submissionId, force=True)
+        self.assertNotIn('scored', submission)
+        self.assertEqual(len(submission['meta']['files']), 2)
+
+        submissionModel.scorePhase(self.phase, processes=1)
+        submission = submissionModel.load(submissionId, force=True)
+        self.assertEqual(submission['score'], 1.0)
+        self.assertEqual(submission['scoreDetail']['errors'], [])
+
+    def testMalformedFile(self):
+        self.putFile(self.phase['groundTruthFolderId'], 'a.npy', self.npy(
+            numpy.ones((2, 2), dtype=numpy.uint8)), self.admin)
+        resp = self.upload('a.npy', self.npy(numpy.ones((2, 2), numpy.uint8)))
+        self.assertStatusOk(resp)
+        good = resp.json['_id']
+
+        # A file put in a submission folder without going through the
+        # validated upload route
+        submissionModel = self.model('submission', 'challenge')
+        folder = submissionModel.createFolder(self.phase, self.user)
+        self.putFile(folder['_id'], 'a.npy', b'not an array', self.user)
+        bad = submissionModel.createSubmission(
+            self.phase, self.user, folderId=folder['_id'])
+
+        submissionModel.scorePhase(self.phase, processes=2)
+        self.assertEqual(submissionModel.load(good, force=True)['score'], 1.0)
+        bad = submissionModel.load(bad['_id'], force=True)
+        self.assertIn('scored', bad)
+        self.assertIsNone(bad['score'])
+        self.assertEqual([e['name'] for e in bad['scoreDetail']['errors']],
+                         ['a.npy'])
+
+    def testFolderAccess(self):
+        submissionModel = self.model('submission', 'challenge')
+        other = self.model('user').createUser(
+            login='other', password='password', firstName='other',
+            lastName='Test', email='other@example.com')
+        self.model('phase', 'challenge').addParticipant(self.phase, other)
+        # Readable by everyone, but not the user's to submit
+        public = submissionModel.createFolder(self.phase, other)
+        self.model('folder').setPublic(public, True, save=True)
+        own = submissionModel.createFolder(self.phase, self.user)
+
+        params = {'phaseId': self.phase['_id'], 'folderId': public['_id']}
+        resp = self.request(path='/challenge_submission', method='POST',
+                            user=self.user, params=params)
+        self.assertStatus(resp, 403)
+        resp = self.batch([{'folderId': str(own['_id'])},
+                           {'folderId': str(public['_id'])}])
+        self.assertStatus(resp, 403)
+        self.assertEqual(submissionModel.find(
+            {'phaseId': self.phase['_id']}).count(), 0)
+
+        params['folderId'] = own['_id']
+        resp = self.request(path='/challenge_submission', method='POST',
+                            user=self.user, params=params)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['folderId'], str(own['_id']))
+        self.assertEqual(self.model('job', 'challenge').find(
+            {'type': 'score', 'phaseId': self.phase['_id']}).count(), 1)
+
+    def testRescoreStale(self):
+        # Ground truth put right after the phase was created is noticed
+        jobModel = self.model('job', 'challenge')
+        for name in ('a.npy', 'b.npy'):
+            self.putFile(self.phase['groundTruthFolderId'], name, self.npy(
+                numpy.ones((2, 2), dtype=numpy.uint8)), self.admin)
+        self.assertEqual(jobModel.find(
+            {'type': 'rescore', 'phaseId': self.phase['_id']}).count(), 1)
+
+        submissionModel = self.model('submission', 'challenge')
+        resp = self.upload('a.npy', self.npy(numpy.ones((2, 2), numpy.uint8)))
+        self.assertStatusOk(resp)
+        submissionId = resp.json['_id']
+        resp = self.upload('b.npy', self.npy(numpy.ones((2, 2), numpy.uint8)),
+                           submissionId=submissionId)
+        self.assertStatusOk(resp)
+        submissionModel.scorePhase(self.phase, processes=1)
+        self.assertEqual(submissionModel.rescoreStale(self.phase), {})
+
+        # Only the submissions scored against the old ground truth are
+        # selected, and scored again on the changed file
+        itemModel = self.model('item')
+        itemModel.remove(itemModel.findOne({
+            'folderId': self.phase['groundTruthFolderId'], 'name': 'b.npy'}))
+        self.putFile(self.phase['groundTruthFolderId'], 'b.npy', self.npy(
+            numpy.zeros((2, 2), dtype=numpy.uint8)), self.admin)
+        results = submissionModel.rescoreStale(self.phase, processes=1)
+        self.assertEqual([str(id) for id in results], [submissionId])
+        submission = submissionModel.load(submissionId, force=True)
+        self.assertEqual(sorted(f['name'] for f in
+                                submission['scoreDetail']['files']),
+                         ['a.npy', 'b.npy'])
+        self.assertEqual(submission['score'], 0.5)
+        self.assertEqual(submissionModel.rescoreStale(self.phase), {})
+
+    def testUploadValidation(self):
+        self.putFile(self.phase['groundTruthFolderId'], 'a.npy', self.npy(
+            numpy.ones((2, 2), dtype=numpy.uint8)), self.admin)
+        data = self.npy(numpy.ones((2, 2), numpy.uint8))
+        for body, params in (
+                # Wrong shape
+                (self.npy(numpy.ones((3, 3), numpy.uint8)), {}),
+                # Truncated array, and announced size not reached
+                (data[:-1], {}),
+                (data, {'size': len(data) + 10}),
+                # Truncated header
+                (data[:8], {})):
+            resp = self.upload('a.npy', body, **params)
+            self.assertStatus(resp, 400)
+            self.assertEqual(resp.json['field'], 'file')
+
+        # Nothing is left behind by rejected uploads
+        self.assertEqual(self.model('submission', 'challenge').find(
+            {'phaseId': self.phase['_id']}).count(), 0)
+        self.assertEqual([f['_id'] for f in self.model('folder').find(
+            {'parentId': self.phase['folderId']})],
+            [self.phase['groundTruthFolderId']])
+        self.assertEqual(self.model('upload').find().count(), 0)
+
+        resp = self.upload('a.npy', data)
+        self.assertStatusOk(resp)
+        entry = resp.json['meta']['files'][0]
+        checksum = hashlib.sha512(data).hexdigest()
+        self.assertEqual(entry['sha512'], checksum)
+        file = self.model('file').load(entry['fileId'], force=True)
+        self.assertEqual(file['sha512'], checksum)
+        self.assertEqual(file['npyHeader']['shape'], [2, 2])
+
+    def testStoreFileCleanup(self):
+        submissionModel = self.model('submission', 'challenge')
+        folder = submissionModel.createFolder(self.phase, self.user)
+
+        def chunks():
+            yield b'abc'
+            raise IOError('Connection lost')
+
+        with self.assertRaises(IOError):
+            submissionModel.storeFile(
+                self.phase, self.user, folder, 'a.txt', 6, chunks())
+        self.assertEqual(self.model('item').find(
+            {'folderId': folder['_id']}).count(), 0)
+        self.assertEqual(self.model('upload').find().count(), 0)
+
+    def testExport(self):
+        resp = self.batch([
+            {'title': 'Quoted, "title"', 'meta': {'secret': 'hidden'}},
+            {'title': 'Second'}])
+        self.assertStatusOk(resp)
+        submissionModel = self.model('submission', 'challenge')
+        submissionModel.collection.update_one(
+            {'title': 'Second'}, {'$set': {'score': 0.5, 'scoreDetail': {
+                'files': [{'name': 'a.npy', 'value': 0.5}]}}})
+        path = '/challenge_phase/%s/export' % self.phase['_id']
+
+        resp = self.request(path=path, user=self.user)
+        self.assertStatus(resp, 403)
+        resp = self.request(path=path, user=self.admin,
+                            params={'format': 'xml'})
+        self.assertStatus(resp, 400)
+
+        resp = self.request(path=path, user=self.admin, isJson=False)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.headers['Content-Type'], 'text/csv')
+        body = self.getBody(resp)
+        rows = list(csv.reader(six.StringIO(body)))
+        self.assertEqual(rows[0], ['_id', 'creatorId', 'title', 'created',
+                                   'folderId', 'score', 'scored'])
+        # Both submissions were created at once, in no particular order
+        rows[1:] = sorted(rows[1:], key=lambda row: row[2])
+        self.assertEqual([(row[2], row[5]) for row in rows[1:]],
+                         [('Quoted, "title"', ''), ('Second', '0.5')])
+        self.assertEqual(rows[1][1], str(self.user['_id']))
+        # Neither the metadata nor the score details are exported as CSV
+        self.assertNotIn('hidden', body)
+        self.assertNotIn('a.npy', body)
+
+        resp = self.request(path=path, user=self.admin, isJson=False,
+                            params={'format': 'csv', 'gzip': 'true'})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.headers['Content-Type'], 'application/gzip')
+        self.assertEqual(resp.headers['Content-Disposition'],
+                         'attachment; filename="Phase.csv.gz"')
+        data = gzip.GzipFile(fileobj=six.BytesIO(
+            self.getBody(resp, text=False))).read()
+        self.assertEqual(data.decode('utf8'), body)
+
+        resp = self.request(path=path, user=self.admin, isJson=False,
+                            params={'format': 'ndjson'})
+        self.assertStatusOk(resp)
+        lines = sorted((json.loads(line) for line in
+                        self.getBody(resp).splitlines()),
+                       key=lambda line: line['title'])
+        self.assertEqual([line['title'] for line in lines],
+                         ['Quoted, "title"', 'Second'])
+        for line in lines:
+            self.assertEqual(set(line), {
+                '_id', 'creatorId', 'title', 'created', 'folderId', 'score',
+                'scored', 'scoreDetail'})
+        self.assertEqual(lines[1]['scoreDetail']['files'][0]['value'], 0.5)
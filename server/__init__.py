@@ -17,24 +17,102 @@
 #  limitations under the License.
 ###############################################################################
 
-from .rest import challenge, phase
+from . import instrumentation
+from .constants import PluginSettings
+from .feed import sizeThreadPool
+from .groundtruth import invalidateFile, rescoreOnFileChange
+from .rest import challenge, phase, submission
+from .utility import backfillLowerNames, runMigration
+from .worker import startWorker
 from girder import events
 from girder.api import rest
+from girder.api.rest import RestException
+from girder.models.model_base import ValidationException
+from girder.utility.config import getConfig
 from girder.utility.model_importer import ModelImporter
 
 
+def _intParam(params, name, default):
+    try:
+        value = int(params.get(name, default))
+    except ValueError:
+        raise RestException('The %s parameter must be an integer.' % name)
+    if value < 0:
+        raise RestException('The %s parameter must not be negative.' % name)
+    return value
+
+
+def validateSearch(event):
+    # Girder parses these without a check of its own before searchModels runs
+    params = event.info['params']
+    _intParam(params, 'limit', 50)
+    _intParam(params, 'offset', 0)
+
+
 def searchModels(event):
+    params = event.info['params']
+    user = rest.getCurrentUser()
+    mode = params.get('mode', 'text')
+    limit = _intParam(params, 'limit', 50)
+    offset = _intParam(params, 'offset', 0)
 
-    if 'challenge_challenge' in event.info['params']['types']:
-        user = rest.getCurrentUser()
-        event.info['returnVal']['challenge_challenge'] = [
-            ModelImporter.model('challenge', 'challenge').filter(c) for c in
-            ModelImporter.model('challenge', 'challenge').textSearch(
-                event.info['params']['q'], user=user)
+    for resultType, modelName in (('challenge_challenge', 'challenge'),
+                                  ('challenge_phase', 'phase')):
+        if resultType not in params['types']:
+            continue
+        model = ModelImporter.model(modelName, 'challenge')
+        search = model.prefixSearch if mode == 'prefix' else model.textSearch
+        event.info['returnVal'][resultType] = [
+            model.filter(doc, user) for doc in
+            search(params['q'], user=user, limit=limit, offset=offset)
         ]
 
 
+def validateSettings(event):
+    key, val = event.info['key'], event.info['value']
+
+    if key == PluginSettings.METRIC_VERSIONS:
+        if not isinstance(val, dict):
+            raise ValidationException(
+                'Metric versions must be a mapping of metric names to '
+                'versions.', 'value')
+    elif key == PluginSettings.MIGRATIONS:
+        if not isinstance(val, (list, tuple)):
+            raise ValidationException('Migrations must be a list.', 'value')
+    else:
+        return
+    event.preventDefault().stopPropagation()
+
+
 def load(info):
+    conf = getConfig().get('challenge', {})
+    instrumentation.configure(bool(conf.get('instrumentation', False)))
+    sizeThreadPool()
+
+    events.bind('model.setting.validate', 'challenge', validateSettings)
+    phaseModel = ModelImporter.model('phase', 'challenge')
+    for modelName in ('challenge', 'phase'):
+        runMigration('%s.lowerName' % modelName, backfillLowerNames,
+                     ModelImporter.model(modelName, 'challenge'))
+    runMigration('phase.participantCount',
+                 phaseModel.backfillParticipantCounts)
+
+    events.bind('rest.get.resource/search.before', 'challenge',
+                validateSearch)
     events.bind('rest.get.resource/search.after', 'challenge', searchModels)
+    events.bind('model.user.save', 'challenge',
+                phaseModel.countMembershipChanges)
+    events.bind('model.user.remove', 'challenge', phaseModel.countRemovedUser)
+    events.bind('model.group.remove', 'challenge',
+                phaseModel.countRemovedGroup)
+    events.bind('model.file.save.after', 'challenge', invalidateFile)
+    events.bind('model.file.remove', 'challenge', invalidateFile)
+    events.bind('model.file.save.after', 'challenge_rescore',
+                rescoreOnFileChange)
+    events.bind('model.file.remove', 'challenge_rescore', rescoreOnFileChange)
     info['apiRoot'].challenge = challenge.Challenge()
     info['apiRoot'].challenge_phase = phase.Phase()
+    info['apiRoot'].challenge_submission = submission.Submission()
+
+    phaseModel.rescoreChangedMetrics()
+    startWorker()
@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import calendar
+import collections
+import email.utils
+import hashlib
+import json
+import threading
+import time
+
+import cherrypy
+from bson.errors import InvalidId
+from girder.api.rest import RestException
+from girder.constants import AccessType
+from girder.utility.config import getConfig
+
+
+class ResponseCache(object):
+    """
+    An in-process cache with a time to live and a maximum number of entries,
+    evicted least recently used first. Each entry may carry tags; all entries
+    with a tag can be dropped at once with ``invalidate``.
+
+    :param maxEntries: The maximum number of entries to keep.
+    :type maxEntries: int
+    :param ttl: The number of seconds an entry stays valid.
+    :type ttl: float
+    """
+    def __init__(self, maxEntries, ttl):
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.hits = self.misses = 0
+
+        self._lock = threading.Lock()
+        # key -> (expiry time, value, tags), least recently used first
+        self._entries = collections.OrderedDict()
+        # tag -> set of keys
+        self._tags = collections.defaultdict(set)
+
+    def _drop(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def get(self, key):
+        """
+        Return the value cached under a key, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries[key] = self._entries.pop(key)
+            return entry[1]
+
+    def set(self, key, value, tags=(), ttl=None):
+        """
+        Cache a value under a key.
+
+        :param tags: Tags through which the entry can be invalidated.
+        :type tags: iterable of str
+        :param ttl: The number of seconds this entry stays valid, if not the
+        default of the cache.
+        :type ttl: float or None
+        """
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            tags = tuple(tags)
+            self._entries[key] = (
+                time.time() + (self.ttl if ttl is None else ttl), value, tags)
+            for tag in tags:
+                self._tags[tag].add(key)
+            while len(self._entries) > self.maxEntries:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, *tags):
+        """
+        Drop every entry carrying any of the given tags.
+        """
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._drop(key)
+
+
+_cache = None
+_accessCache = None
+_cacheLock = threading.Lock()
+
+
+def getResponseCache():
+    """
+    Return the process-wide response cache, creating it from the
+    ``[challenge]`` section of the Girder configuration on first use.
+
+    Entries are dropped as soon as this process saves or removes the
+    documents they derive from, but changes made by other Girder processes
+    are only seen once the entries expire: documents and listings, including
+    the access lists they carry, may be up to ``response_cache_ttl`` seconds
+    (30 by default) out of date.
+    """
+    global _cache
+    with _cacheLock:
+        if _cache is None:
+            conf = getConfig().get('challenge', {})
+            _cache = ResponseCache(
+                maxEntries=int(conf.get('response_cache_size', 10000)),
+                ttl=float(conf.get('response_cache_ttl', 30)))
+        return _cache
+
+
+def getAccessCache():
+    """
+    Return the process-wide cache of access levels, creating it from the
+    ``[challenge]`` section of the Girder configuration on first use. It is
+    kept apart from the response cache so that large responses cannot evict
+    the access levels, nor the reverse.
+
+    As with the response cache, changes made by other processes are only
+    seen once entries expire, after ``access_cache_ttl`` seconds (5 by
+    default). Access levels are computed from documents that may come from
+    the response cache, so an access change made by another process takes
+    effect here within ``response_cache_ttl`` seconds at worst.
+    """
+    global _accessCache
+    with _cacheLock:
+        if _accessCache is None:
+            conf = getConfig().get('challenge', {})
+            _accessCache = ResponseCache(
+                maxEntries=int(conf.get('access_cache_size', 10000)),
+                ttl=float(conf.get('access_cache_ttl', 5)))
+        return _accessCache
+
+
+def docTag(modelName, id):
+    """
+    The tag of cache entries derived from one document.
+    """
+    return '%s:%s' % (modelName, id)
+
+
+def listTag(modelName, parentId):
+    """
+    The tag of cached listings of the children of a document.
+    """
+    return '%s:list:%s' % (modelName, parentId)
+
+
+def accessTag(modelName, id):
+    """
+    The tag of cached access levels of users on one document.
+    """
+    return '%s:access:%s' % (modelName, id)
+
+
+def invalidateDocument(modelName, id, parentId=None):
+    """
+    Drop the cache entries of a document that was saved or removed, and the
+    cached listings it may appear in.
+    """
+    getResponseCache().invalidate(docTag(modelName, id))
+    getAccessCache().invalidate(docTag(modelName, id))
+    if parentId is not None:
+        invalidateListing(modelName, parentId)
+    _dropRequestAccess(modelName, id)
+
+
+def invalidateListing(modelName, parentId):
+    """
+    Drop the cached listings of the children of a document, and what is
+    cached about the access of users to them.
+    """
+    getResponseCache().invalidate(listTag(modelName, parentId))
+    getAccessCache().invalidate(listTag(modelName, parentId))
+
+
+def invalidateAccess(modelName, id):
+    """
+    Drop the cached access levels of users on a document whose access list
+    or public flag changed, even if it was not saved yet.
+    """
+    getAccessCache().invalidate(accessTag(modelName, id))
+    _dropRequestAccess(modelName, id)
+
+
+def aclKey(user):
+    """
+    A key identifying everything that access decisions depend on for a user,
+    so that cached listings are only shared between equivalent users.
+    """
+    if user is None:
+        return 'anonymous'
+    if user.get('admin', False):
+        return 'admin'
+    return (str(user['_id']),) + tuple(
+        sorted(str(g) for g in user.get('groups', [])))
+
+
+def listingAclKey(model, query, parentId, user):
+    """
+    A key identifying what a user can see of a listing of the children of a
+    document, so that cached listings are shared between users who see the
+    same thing. Users who were granted no access of their own to any of the
+    children, directly or through a group, only see public children at the
+    read level, as anonymous users do, and share their listings. Whether a
+    user was granted access is found with one indexed query and kept in the
+    access cache until the children change.
+
+    :param model: The model of the children.
+    :param query: The query matching the children.
+    :type query: dict
+    :param parentId: The ID of the document the children belong to.
+    :param user: The user listing the children, or None.
+    :type user: dict or None
+    """
+    key = aclKey(user)
+    if user is None or user.get('admin', False):
+        return key
+
+    cache = getAccessCache()
+    cacheKey = ('granted', model.name, str(parentId), key)
+    granted = cache.get(cacheKey)
+    if granted is None:
+        grants = [{'access.users.id': user['_id']}]
+        if user.get('groups'):
+            grants.append({'access.groups.id': {'$in': user['groups']}})
+        granted = model.findOne(
+            dict(query, **{'$or': grants}), fields=['_id']) is not None
+        cache.set(cacheKey, granted, tags=[listTag(model.name, parentId)])
+    return key if granted else aclKey(None)
+
+
+def _requestAccessLevels():
+    """
+    The access levels computed during the current request, or None outside
+    of a request, e.g. on job worker threads.
+    """
+    request = cherrypy.request
+    if getattr(request, 'app', None) is None:
+        return None
+    levels = getattr(request, 'challengeAccessLevels', None)
+    if levels is None:
+        levels = request.challengeAccessLevels = {}
+    return levels
+
+
+def _dropRequestAccess(modelName, id):
+    levels = _requestAccessLevels()
+    if levels is not None:
+        levels.pop((modelName, str(id)), None)
+
+
+def clearRequestAccess():
+    """
+    Forget the access levels computed so far in this request, e.g. between
+    the events of a long-lived stream.
+    """
+    levels = _requestAccessLevels()
+    if levels is not None:
+        levels.clear()
+
+
+def cachedAccessLevel(model, doc, user, compute):
+    """
+    Get the access level of a user on a document, calling ``compute`` only
+    if it was not already computed during this request or, for users with
+    the same groups, in the last ``access_cache_ttl`` seconds; see
+    ``getAccessCache`` for how stale that may be across processes. Entries are
+    dropped when the document is saved or its access changes; joining a
+    phase changes the groups of the user, and so the key of its entries.
+
+    :param model: The model of the document.
+    :param doc: The document, which must have been saved.
+    :type doc: dict
+    :param compute: Computes the access level when it is not cached.
+    :type compute: callable
+    """
+    if '_id' not in doc:
+        return compute()
+    docKey = (model.name, str(doc['_id']))
+    userKey = aclKey(user)
+    levels = _requestAccessLevels()
+    if levels is not None:
+        level = levels.get(docKey, {}).get(userKey)
+        if level is not None:
+            return level
+
+    cache = getAccessCache()
+    key = docKey + (userKey,)
+    level = cache.get(key)
+    if level is None:
+        level = compute()
+        cache.set(key, level, tags=[docTag(*docKey), accessTag(*docKey)])
+    if levels is not None:
+        levels.setdefault(docKey, {})[userKey] = level
+    return level
+
+
+def loadDocument(model, id, user, level=AccessType.READ):
+    """
+    Load a document through the response cache and check that the user has
+    the given access level on it. The returned document is shared between
+    requests and must not be modified.
+    """
+    cache = getResponseCache()
+    key = ('doc', model.name, str(id))
+    doc = cache.get(key)
+    if doc is None:
+        try:
+            doc = model.load(id, force=True)
+        except InvalidId:
+            doc = None
+        if doc is None:
+            raise RestException('Invalid %s id (%s).' % (model.name, id))
+        cache.set(key, doc, tags=[docTag(model.name, doc['_id'])])
+
+    model.requireAccess(doc, user, level)
+    return doc
+
+
+def computeEtag(value, doc=None):
+    """
+    Compute the entity tag of a response.
+
+    :param value: The response body.
+    :param doc: The document, or list of documents, the response was built
+    from. Their access lists and public flags are part of the tag even when
+    the response leaves them out, so that a client's copy is not validated
+    again after access to it changed.
+    """
+    if doc is not None:
+        docs = doc if isinstance(doc, list) else [doc]
+        value = [value, [(d.get('public'), d.get('access')) for d in docs]]
+    return '"%s"' % hashlib.md5(json.dumps(
+        value, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+
+def conditionalResponse(etag, lastModified=None):
+    """
+    Set the ETag and Last-Modified headers of the response, and answer with
+    304 Not Modified if the client's copy is still current.
+
+    :param etag: The entity tag of the response.
+    :type etag: str
+    :param lastModified: When the underlying data last changed.
+    :type lastModified: datetime.datetime or None
+    """
+    headers = cherrypy.request.headers
+    cherrypy.response.headers['ETag'] = etag
+    modified = None
+    if lastModified is not None:
+        modified = calendar.timegm(lastModified.utctimetuple())
+        cherrypy.response.headers['Last-Modified'] = email.utils.formatdate(
+            modified, usegmt=True)
+
+    if 'If-None-Match' in headers:
+        match = headers['If-None-Match']
+        if match.strip() == '*' or etag in [
+                e.strip() for e in match.split(',')]:
+            raise cherrypy.HTTPRedirect([], 304)
+    elif modified is not None and 'If-Modified-Since' in headers:
+        since = email.utils.parsedate_tz(headers['If-Modified-Since'])
+        if since is not None and modified <= email.utils.mktime_tz(since):
+            raise cherrypy.HTTPRedirect([], 304)
+
+
+def filteredDocument(model, doc, user):
+    """
+    Filter a document for a user, reusing the filtered copy cached for the
+    user's access level. The filtered copy is shared and must not be
+    modified.
+
+    :returns: The filtered document and its entity tag.
+    """
+    level = model.getAccessLevel(doc, user)
+    cache = getResponseCache()
+    key = ('filtered', model.name, str(doc['_id']), level)
+    cached = cache.get(key)
+    if cached is None:
+        filtered = model.filter(doc, user)
+        cached = (filtered, computeEtag(filtered, doc))
+        cache.set(key, cached, tags=[docTag(model.name, doc['_id'])])
+    return cached
+
+
+def filteredResponse(model, doc, user):
+    """
+    Filter a document for a user through the cache, and answer with 304 Not
+    Modified when the client's copy is current.
+    """
+    filtered, etag = filteredDocument(model, doc, user)
+    conditionalResponse(etag, doc.get('updated') or doc.get('created'))
+    return filtered
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+
+class PluginSettings(object):
+    """
+    Keys of the settings the plugin keeps for itself. They are not meant to
+    be edited by administrators.
+    """
+    # The version of each metric when the plugin was last loaded
+    METRIC_VERSIONS = 'challenge.metric_versions'
+    # The names of the data migrations that already ran
+    MIGRATIONS = 'challenge.migrations'
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+A feed of the changes to challenges, phases and leaderboards, pushed to
+clients as server-sent events so that they need not poll. The models publish
+every save and removal to a single dispatcher per process, which fans each
+change out to the queues of the subscribed streams. Only the changes made by
+this server process are seen.
+
+Each open stream holds a server thread, which mostly waits on its queue, so
+``sizeThreadPool`` grows the server thread pool to make room for the
+configured number of streams on top of the threads serving other requests.
+"""
+
+import cherrypy
+import collections
+import itertools
+import json
+import threading
+
+from girder import logger
+from girder.constants import AccessType
+from girder.utility.config import getConfig
+from girder.utility.model_importer import ModelImporter
+
+from .cache import clearRequestAccess
+from .utility import exportValue
+
+# A change to a document. ``kind`` is 'challenge', 'phase' or 'leaderboard';
+# ``doc`` is the challenge or phase whose access applies to the change.
+Change = collections.namedtuple('Change', ('id', 'kind', 'action', 'doc'))
+
+# The model whose access list applies to each kind of change
+KIND_MODELS = {
+    'challenge': 'challenge',
+    'phase': 'phase',
+    'leaderboard': 'phase'
+}
+
+
+class Subscription(object):
+    """
+    The queue of changes waiting to be sent to one stream. When the stream
+    falls more than ``maxEvents`` changes behind, the queue overflows and
+    the stream is ended, so that a slow client cannot hold on to memory.
+
+    :param client: The key of the user or address that opened the stream.
+    :type client: str
+    """
+    def __init__(self, client, maxEvents):
+        self.client = client
+        self.maxEvents = maxEvents
+        self.overflowed = False
+        self._changes = collections.deque()
+        self._cond = threading.Condition()
+
+    def push(self, change):
+        with self._cond:
+            if len(self._changes) >= self.maxEvents:
+                self.overflowed = True
+            else:
+                self._changes.append(change)
+            self._cond.notify()
+
+    def get(self, timeout):
+        """
+        Wait for the next change.
+
+        :param timeout: The number of seconds to wait.
+        :type timeout: float
+        :returns: The change, or None if there was none in time or the queue
+        overflowed.
+        """
+        with self._cond:
+            if not self._changes and not self.overflowed:
+                self._cond.wait(timeout)
+            if self.overflowed or not self._changes:
+                return None
+            return self._changes.popleft()
+
+
+class ChangeFeed(object):
+    """
+    Fans the published changes out to every subscription.
+
+    :param maxSubscribers: The maximum number of streams at once. Each open
+    stream holds a server thread for its whole life; see
+    ``sizeThreadPool``.
+    :type maxSubscribers: int
+    :param maxPerClient: The maximum number of streams of one user, or of
+    one address for anonymous clients.
+    :type maxPerClient: int
+    :param maxEvents: The maximum number of changes queued for a stream.
+    :type maxEvents: int
+    """
+    def __init__(self, maxSubscribers=100, maxPerClient=2, maxEvents=1000):
+        self.maxSubscribers = maxSubscribers
+        self.maxPerClient = maxPerClient
+        self.maxEvents = maxEvents
+        self._subscriptions = set()
+        self._clients = collections.Counter()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def _full(self, client):
+        return (len(self._subscriptions) >= self.maxSubscribers or
+                self._clients[client] >= self.maxPerClient)
+
+    def canSubscribe(self, client):
+        """
+        Whether a client could open a stream now. Nothing is reserved, so a
+        later ``subscribe`` may still fail.
+        """
+        with self._lock:
+            return not self._full(client)
+
+    def subscribe(self, client):
+        """
+        :param client: The key of the user or address opening the stream.
+        :type client: str
+        :returns: A new subscription, or None if there are too many already.
+        """
+        with self._lock:
+            if self._full(client):
+                return None
+            subscription = Subscription(client, self.maxEvents)
+            self._subscriptions.add(subscription)
+            self._clients[client] += 1
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+                self._clients[subscription.client] -= 1
+                if not self._clients[subscription.client]:
+                    del self._clients[subscription.client]
+
+    def publish(self, kind, action, doc):
+        """
+        Send a change to every subscription. This costs nothing when there
+        are none.
+
+        :param kind: 'challenge', 'phase' or 'leaderboard'.
+        :type kind: str
+        :param action: 'create', 'update' or 'remove'.
+        :type action: str
+        :param doc: The challenge or phase that changed, or the phase whose
+        leaderboard changed.
+        :type doc: dict
+        """
+        if not self._subscriptions:
+            return
+        with self._lock:
+            change = Change(next(self._ids), kind, action, dict(doc))
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.push(change)
+
+
+_feed = None
+_feedLock = threading.Lock()
+
+
+def getFeed():
+    """
+    Return the process-wide change feed, creating it from the ``[challenge]``
+    section of the Girder configuration on first use. By default at most 100
+    streams may be open at once.
+    """
+    global _feed
+    with _feedLock:
+        if _feed is None:
+            conf = getConfig().get('challenge', {})
+            _feed = ChangeFeed(
+                maxSubscribers=int(conf.get('feed_max_subscribers', 100)),
+                maxPerClient=int(conf.get('feed_max_per_client', 2)),
+                maxEvents=int(conf.get('feed_queue_size', 1000)))
+        return _feed
+
+
+def sizeThreadPool():
+    """
+    Grow the server thread pool, before the server starts, so that it holds
+    a thread for each stream the feed allows plus ``feed_reserved_threads``
+    (10 by default) for the other requests. Otherwise open streams would
+    take every thread and the server would stop answering.
+
+    :returns: The size of the thread pool.
+    :rtype: int
+    """
+    conf = getConfig().get('challenge', {})
+    needed = getFeed().maxSubscribers + int(conf.get(
+        'feed_reserved_threads', 10))
+    if cherrypy.server.thread_pool < needed:
+        logger.info('Growing the server thread pool from %d to %d threads '
+                    'for the change feed', cherrypy.server.thread_pool,
+                    needed)
+        cherrypy.server.thread_pool = needed
+    if 0 < cherrypy.server.thread_pool_max < needed:
+        cherrypy.server.thread_pool_max = needed
+    return cherrypy.server.thread_pool
+
+
+def publish(kind, action, doc):
+    getFeed().publish(kind, action, doc)
+
+
+def _challengeId(change):
+    if change.kind == 'challenge':
+        return change.doc['_id']
+    return change.doc['challengeId']
+
+
+def _payload(change, user):
+    model = ModelImporter.model(KIND_MODELS[change.kind], 'challenge')
+    if not model.hasAccess(change.doc, user, AccessType.READ):
+        return None
+    if change.kind == 'leaderboard':
+        return {'phaseId': change.doc['_id'],
+                'challengeId': change.doc['challengeId']}
+    if change.action == 'remove':
+        doc = {'_id': change.doc['_id']}
+        if change.kind == 'phase':
+            doc['challengeId'] = change.doc['challengeId']
+        return doc
+    return model.filter(change.doc, user)
+
+
+def eventStream(client, user, challengeId=None, heartbeat=15):
+    """
+    Subscribe to the feed and encode the changes that the user may read as
+    server-sent events, until the client disconnects or the subscription
+    overflows. The event type is the kind of change; its data is a JSON
+    object with the action and the filtered document, or the IDs of the
+    phase and challenge for leaderboard changes. The subscription is only
+    taken once the stream is read, and always released when it ends; if
+    there are too many streams by then, a "busy" event ends it at once. The
+    user is read again before each change is filtered, so that access gained
+    or lost meanwhile, e.g. by joining a phase, applies to it.
+
+    :param client: The key of the user or address opening the stream.
+    :type client: str
+
+    :param challengeId: Only send the changes to this challenge, its phases
+    and their leaderboards.
+    :type challengeId: ObjectId or None
+    :param heartbeat: The number of seconds between comments sent to keep
+    the connection open when there is no change.
+    :type heartbeat: float
+    :returns: A generator of UTF-8 encoded events.
+    """
+    subscription = getFeed().subscribe(client)
+    if subscription is None:
+        yield b'retry: 30000\nevent: busy\ndata: {}\n\n'
+        return
+    try:
+        yield b'retry: 5000\n\n'
+        while True:
+            change = subscription.get(heartbeat)
+            if subscription.overflowed:
+                yield b'event: overflow\ndata: {}\n\n'
+                return
+            if change is None:
+                yield b': keepalive\n\n'
+                continue
+            if challengeId is not None and _challengeId(change) != challengeId:
+                continue
+            # Access may have changed since the last event of this stream,
+            # including the groups of the user
+            clearRequestAccess()
+            if user is not None:
+                user = ModelImporter.model('user').load(
+                    user['_id'], force=True)
+                if user is None:
+                    return
+            payload = _payload(change, user)
+            if payload is None:
+                continue
+            data = json.dumps({
+                'action': change.action,
+                'doc': payload
+            }, default=exportValue, sort_keys=True)
+            yield ('id: %d\nevent: %s\ndata: %s\n\n' % (
+                change.id, change.kind, data)).encode('utf8')
+    finally:
+        getFeed().unsubscribe(subscription)
@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # pragma: no cover
+    from collections import Mapping
+
+from girder import logger
+from girder.utility.config import getConfig
+from girder.utility.model_importer import ModelImporter
+import numpy
+
+
+def fileChecksum(file):
+    """
+    Return a short checksum identifying the contents of a file document. It
+    is derived from the SHA-512 of the file when the assetstore computed
+    one, or else from its size and modification time.
+    """
+    checksum = file.get('sha512')
+    if not checksum:
+        checksum = hashlib.sha512(('%s-%s' % (
+            file.get('size'), file.get('updated', file.get('created')))
+        ).encode('utf8')).hexdigest()
+    return checksum[:32]
+
+
+def groundTruthHash(checksums, metric):
+    """
+    Return a fingerprint of the ground truth files and the metric that
+    results are computed against. It is stored with the score details of each
+    submission, so that out of date results are found by comparing a single
+    indexed field.
+
+    :param checksums: The checksums of the ground truth files, by name.
+    :type checksums: dict
+    :param metric: The metric scoring the files.
+    :type metric: metrics.Metric
+    """
+    parts = ['%s:%s' % (metric.name, metric.version)] + [
+        '%s:%s' % (name, checksums[name]) for name in sorted(checksums)]
+    return hashlib.sha512('\n'.join(parts).encode('utf8')).hexdigest()[:32]
+
+
+class GroundTruthCache(object):
+    """
+    A two level LRU cache of decoded ground truth files, keyed by file ID and
+    checksum. Entries live in process memory and are spilled to a directory
+    on disk, so that other processes and later runs can reuse them. Arrays
+    read back from disk are memory-mapped. Since the checksum is part of the
+    key, a changed file is never served stale; ``invalidate`` only frees the
+    space taken by the old versions.
+
+    :param maxMemory: The maximum number of bytes to keep in memory.
+    :type maxMemory: int
+    :param maxDisk: The maximum number of bytes to keep on disk; 0 disables
+    the disk level.
+    :type maxDisk: int
+    :param directory: The directory holding the disk level.
+    :type directory: str
+    """
+    def __init__(self, maxMemory, maxDisk, directory):
+        self.maxMemory = maxMemory
+        self.maxDisk = maxDisk
+        self.directory = directory
+        self.hits = self.diskHits = self.misses = self.evictions = 0
+
+        self._lock = threading.RLock()
+        # key -> (value, size), least recently used first
+        self._memory = collections.OrderedDict()
+        self._memorySize = 0
+        # key -> (path, size), least recently used first
+        self._disk = collections.OrderedDict()
+        self._diskSize = 0
+
+        if self.maxDisk:
+            self._scanDisk()
+
+    @staticmethod
+    def key(file):
+        """
+        Return the cache key of a file document.
+        """
+        return str(file['_id']), fileChecksum(file)
+
+    def _path(self, key, value=None):
+        name = '%s-%s' % key
+        if value is None or isinstance(value, bytes):
+            return os.path.join(self.directory, name + '.bin')
+        return os.path.join(self.directory, name + '.npy')
+
+    def _scanDisk(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        entries = []
+        for name in os.listdir(self.directory):
+            base, ext = os.path.splitext(name)
+            if ext not in ('.npy', '.bin') or '-' not in base:
+                continue
+            path = os.path.join(self.directory, name)
+            stat = os.stat(path)
+            entries.append((stat.st_atime, tuple(base.split('-', 1)), path,
+                            stat.st_size))
+        for _, key, path, size in sorted(entries):
+            self._disk[key] = (path, size)
+            self._diskSize += size
+
+    def get(self, file, load):
+        """
+        Get the decoded contents of a ground truth file, loading them with
+        ``load(file)`` on a miss.
+
+        :param file: The file document.
+        :type file: dict
+        :param load: Function returning the decoded contents of the file.
+        """
+        key = self.key(file)
+        with self._lock:
+            if key in self._memory:
+                self.hits += 1
+                self._memory[key] = self._memory.pop(key)
+                return self._memory[key][0]
+
+            if key in self._disk:
+                path, size = self._disk.pop(key)
+                try:
+                    value = self._readDisk(path)
+                except (IOError, OSError, ValueError):
+                    logger.exception('Dropping unreadable cache entry %s', path)
+                    self._diskSize -= size
+                    self._removePath(path)
+                else:
+                    self.diskHits += 1
+                    self._disk[key] = (path, size)
+                    self._putMemory(key, value)
+                    return value
+
+            self.misses += 1
+
+        value = load(file)
+        with self._lock:
+            self._putMemory(key, value)
+            self._putDisk(key, value)
+        return value
+
+    def link(self, file, load, path):
+        """
+        Hard-link the disk copy of a ground truth file to a path, writing it
+        first on a miss, so that a scoring run can map the file without
+        writing it again. The link stays valid if the entry is evicted later.
+
+        :param file: The file document.
+        :type file: dict
+        :param load: Function returning the decoded contents of the file.
+        :param path: Where to link the file to.
+        :type path: str
+        :returns: Whether the file was linked. It is not if the disk level
+        is disabled or cannot hold the file, or is on another filesystem.
+        :rtype: bool
+        """
+        if not self.maxDisk:
+            return False
+        key = self.key(file)
+        with self._lock:
+            cached = key in self._disk
+        if not cached:
+            self.get(file, load)
+        with self._lock:
+            entry = self._disk.pop(key, None)
+            if entry is None:
+                return False
+            if cached:
+                self.diskHits += 1
+            self._disk[key] = entry
+            try:
+                os.link(entry[0], path)
+            except OSError:
+                return False
+        return True
+
+    def _readDisk(self, path):
+        if path.endswith('.npy'):
+            return numpy.load(path, mmap_mode='r', allow_pickle=False)
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _sizeOf(self, value):
+        return getattr(value, 'nbytes', None) or len(value)
+
+    def _putMemory(self, key, value):
+        # Threads that missed on the same key concurrently each put it
+        if key in self._memory:
+            self._memorySize -= self._memory.pop(key)[1]
+        size = self._sizeOf(value)
+        if size > self.maxMemory:
+            return
+        self._memory[key] = (value, size)
+        self._memorySize += size
+        while self._memorySize > self.maxMemory:
+            _, (_, evicted) = self._memory.popitem(last=False)
+            self._memorySize -= evicted
+            self.evictions += 1
+
+    def _putDisk(self, key, value):
+        if not self.maxDisk or key in self._disk:
+            return
+        if not isinstance(value, (bytes, numpy.ndarray)):
+            return
+
+        path = self._path(key, value)
+        tmp = path + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                if isinstance(value, bytes):
+                    f.write(value)
+                else:
+                    numpy.save(f, value, allow_pickle=False)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            logger.exception('Could not write cache entry %s', path)
+            self._removePath(tmp)
+            return
+
+        size = os.path.getsize(path)
+        self._disk[key] = (path, size)
+        self._diskSize += size
+        while self._diskSize > self.maxDisk and self._disk:
+            _, (evictedPath, evicted) = self._disk.popitem(last=False)
+            self._diskSize -= evicted
+            self._removePath(evictedPath)
+            self.evictions += 1
+
+    def _removePath(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def invalidate(self, fileId):
+        """
+        Drop every cached version of a file.
+
+        :param fileId: The ID of the file.
+        """
+        fileId = str(fileId)
+        with self._lock:
+            for key in [k for k in self._memory if k[0] == fileId]:
+                _, size = self._memory.pop(key)
+                self._memorySize -= size
+            for key in [k for k in self._disk if k[0] == fileId]:
+                path, size = self._disk.pop(key)
+                self._diskSize -= size
+                self._removePath(path)
+
+    def stats(self):
+        """
+        Return the hit/miss counters and the current size of each level.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'diskHits': self.diskHits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'memoryEntries': len(self._memory),
+                'memoryBytes': self._memorySize,
+                'maxMemoryBytes': self.maxMemory,
+                'diskEntries': len(self._disk),
+                'diskBytes': self._diskSize,
+                'maxDiskBytes': self.maxDisk
+            }
+
+
+class GroundTruth(Mapping):
+    """
+    The decoded ground truth files of a phase keyed by name. Each file is
+    loaded through a ``GroundTruthCache`` when it is looked up, and
+    ``link`` places it for a scoring run without decoding it when the cache
+    already holds it on disk.
+
+    :param files: The ground truth file documents.
+    :type files: list of dict
+    :param cache: The cache to load the files through.
+    :type cache: GroundTruthCache
+    :param load: Function returning the decoded contents of a file.
+    """
+    def __init__(self, files, cache, load):
+        self._files = {f['name']: f for f in files}
+        self._cache = cache
+        self._load = load
+
+    def __getitem__(self, name):
+        return self._cache.get(self._files[name], self._load)
+
+    def __iter__(self):
+        return iter(self._files)
+
+    def __len__(self):
+        return len(self._files)
+
+    def link(self, name, path):
+        return self._cache.link(self._files[name], self._load, path)
+
+
+_cache = None
+_cacheLock = threading.Lock()
+
+
+def getCache():
+    """
+    Return the process-wide ground truth cache, creating it from the
+    ``[challenge]`` section of the Girder configuration on first use.
+    """
+    global _cache
+    with _cacheLock:
+        if _cache is None:
+            conf = getConfig().get('challenge', {})
+            _cache = GroundTruthCache(
+                maxMemory=int(conf.get('ground_truth_cache_memory',
+                                       2 * 1024 ** 3)),
+                maxDisk=int(conf.get('ground_truth_cache_disk',
+                                     20 * 1024 ** 3)),
+                directory=conf.get('ground_truth_cache_dir', os.path.join(
+                    tempfile.gettempdir(), 'girder_challenge_ground_truth')))
+        return _cache
+
+
+def invalidateFile(event):
+    """
+    Event handler dropping the cached versions of a file that was changed or
+    removed.
+    """
+    getCache().invalidate(event.info['_id'])
+
+
+_folders = {'ids': frozenset(), 'expires': 0}
+_foldersLock = threading.Lock()
+
+
+def groundTruthFolderIds():
+    """
+    Return the IDs of the ground truth folders of all phases. They are read
+    with one query covered by an index, at most every
+    ``ground_truth_folders_ttl`` seconds (30 by default). Saving a phase in
+    this process invalidates them; the ground truth folder of a phase created
+    by another process is only known once that delay is over.
+
+    :rtype: frozenset
+    """
+    with _foldersLock:
+        if _folders['expires'] < time.time():
+            conf = getConfig().get('challenge', {})
+            ids = ModelImporter.model('phase', 'challenge').collection.distinct(
+                'groundTruthFolderId')
+            _folders['ids'] = frozenset(id for id in ids if id is not None)
+            _folders['expires'] = time.time() + float(
+                conf.get('ground_truth_folders_ttl', 30))
+        return _folders['ids']
+
+
+def invalidateFolderIds():
+    """
+    Forget the ground truth folder IDs read by ``groundTruthFolderIds``, so
+    that the next call reads them again.
+    """
+    with _foldersLock:
+        _folders['expires'] = 0
+
+
+def rescoreOnFileChange(event):
+    """
+    Event handler queueing the incremental re-scoring of the phases whose
+    ground truth folder holds a file that was changed or removed. The phases
+    are only looked up when the file is in a known ground truth folder, so
+    that saving any other file costs a single lookup of its item.
+    """
+    itemId = event.info.get('itemId')
+    if itemId is None:
+        return
+    folderIds = groundTruthFolderIds()
+    if not folderIds:
+        return
+    item = ModelImporter.model('item').load(
+        itemId, force=True, fields=['folderId'])
+    if item is None or item['folderId'] not in folderIds:
+        return
+    for phase in ModelImporter.model('phase', 'challenge').find(
+            {'groundTruthFolderId': item['folderId']}, limit=0):
+        ModelImporter.model('job', 'challenge').enqueue('rescore', phase)
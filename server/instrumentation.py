@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Latency histograms of the REST handlers and model methods of the plugin,
+along with the number of MongoDB commands each call issued through the
+models of the plugin, exposed in the Prometheus text format. Everything is
+off unless ``instrumentation`` is set in the ``[challenge]`` section of the
+Girder configuration; when off, a timed call costs one attribute lookup.
+"""
+
+import bisect
+import functools
+import threading
+import time
+
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+# Upper bounds of the buckets of MongoDB commands per call
+COMMAND_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+
+METRICS_HELP = {
+    'challenge_route_seconds': 'Latency of the challenge REST handlers.',
+    'challenge_route_mongo_commands':
+        'MongoDB commands issued by each call of a challenge REST handler.',
+    'challenge_model_seconds': 'Latency of the challenge model methods.',
+    'challenge_model_mongo_commands':
+        'MongoDB commands issued by each call of a challenge model method.'
+}
+
+
+class Histogram(object):
+    """
+    A cumulative histogram in the manner of Prometheus: the number of
+    observations less than or equal to each bucket bound, plus their sum and
+    count.
+
+    :param buckets: The upper bounds of the buckets, in increasing order.
+    :type buckets: tuple
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum
+
+
+# Collection methods that send a command to MongoDB. A cursor returned by
+# find or aggregate counts as one command, however many batches it reads.
+COMMAND_METHODS = frozenset((
+    'aggregate', 'bulk_write', 'count', 'count_documents', 'delete_many',
+    'delete_one', 'distinct', 'find', 'find_one', 'find_one_and_delete',
+    'find_one_and_replace', 'find_one_and_update', 'insert_many',
+    'insert_one', 'replace_one', 'update_many', 'update_one'))
+
+
+class CommandCounter(object):
+    """
+    Counts the MongoDB commands sent by each thread, so that the commands
+    issued by a call can be told apart from those of concurrent requests.
+    """
+    def __init__(self):
+        self._local = threading.local()
+
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+    def add(self):
+        self._local.count = self.count() + 1
+
+
+class CountingCollection(object):
+    """
+    Proxy of a collection counting the commands sent through it while
+    instrumentation is on.
+    """
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not _state['enabled'] or name not in COMMAND_METHODS:
+            return attr
+
+        def counted(*args, **kwargs):
+            _counter.add()
+            return attr(*args, **kwargs)
+        return counted
+
+
+class CountedModel(object):
+    """
+    Mixin of the models of the plugin wrapping their collection, however
+    Girder (re)connects it, so that their commands are counted. Commands
+    sent through the models of Girder itself, such as folders and groups,
+    are not counted.
+    """
+    @property
+    def collection(self):
+        return self._countedCollection
+
+    @collection.setter
+    def collection(self, collection):
+        if isinstance(collection, CountingCollection):
+            collection = collection._collection
+        self._countedCollection = CountingCollection(collection)
+
+
+_state = {'enabled': False}
+_histograms = {}
+_histogramsLock = threading.Lock()
+_counter = CommandCounter()
+
+
+def _histogram(metric, name, buckets):
+    key = (metric, name)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        with _histogramsLock:
+            histogram = _histograms.setdefault(key, Histogram(buckets))
+    return histogram
+
+
+def timed(kind, name):
+    """
+    Decorator recording the latency of each call of a function, and the
+    number of MongoDB commands it issued, under the given name. For REST
+    handlers that stream their response, such as exports, uploads and the
+    change feed, this only covers the time until the handler returns the
+    generator of the body, not the time spent streaming it.
+
+    :param kind: Either 'route' for REST handlers or 'model' for model
+    methods.
+    :type kind: str
+    :param name: The name to record the calls under.
+    :type name: str
+    """
+    seconds = 'challenge_%s_seconds' % kind
+    commands = 'challenge_%s_mongo_commands' % kind
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            if not _state['enabled']:
+                return func(*args, **kwargs)
+            start = time.time()
+            startCount = _counter.count()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _histogram(seconds, name, LATENCY_BUCKETS).observe(
+                    time.time() - start)
+                _histogram(commands, name, COMMAND_BUCKETS).observe(
+                    _counter.count() - startCount)
+        return wrapped
+    return decorator
+
+
+def configure(enabled):
+    """
+    Turn instrumentation on or off.
+
+    :param enabled: Whether to record calls.
+    :type enabled: bool
+    """
+    _state['enabled'] = bool(enabled)
+
+
+def _format(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """
+    Render every histogram in the Prometheus text exposition format.
+
+    :rtype: str
+    """
+    with _histogramsLock:
+        histograms = sorted(_histograms.items())
+
+    lines = []
+    lastMetric = None
+    for (metric, name), histogram in histograms:
+        if metric != lastMetric:
+            lines.append('# HELP %s %s' % (metric, METRICS_HELP[metric]))
+            lines.append('# TYPE %s histogram' % metric)
+            lastMetric = metric
+        label = name.replace('\\', '\\\\').replace('"', '\\"')
+        counts, total = histogram.snapshot()
+        cumulative = 0
+        for bound, count in zip(
+                histogram.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append('%s_bucket{name="%s",le="%s"} %d' % (
+                metric, label, _format(bound), cumulative))
+        lines.append('%s_sum{name="%s"} %s' % (metric, label, _format(total)))
+        lines.append('%s_count{name="%s"} %d' % (metric, label, cumulative))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Built-in metrics for scoring segmentation and classification submissions.
+Every metric takes the submitted and ground truth arrays, which may be
+memory-mapped, and works on whole volumes with NumPy. Overlap metrics walk
+the volumes in slabs along the first axis so that memory-mapped inputs are
+never fully loaded into memory. Like the scoring module, this does not
+depend on Girder.
+"""
+
+import collections
+
+import numpy
+from scipy import ndimage
+
+# Approximate number of bytes of each input to process at a time
+SLAB_BYTES = 64 * 1024 * 1024
+
+Metric = collections.namedtuple(
+    'Metric', ('name', 'func', 'higherIsBetter', 'version'))
+
+
+def _checkShapes(submitted, groundTruth):
+    if submitted.shape != groundTruth.shape:
+        raise ValueError('Submitted shape %s does not match ground truth '
+                         'shape %s.' % (submitted.shape, groundTruth.shape))
+
+
+def _slabs(array):
+    """
+    Yield index expressions splitting an array into slabs along its first
+    axis of about SLAB_BYTES each.
+    """
+    if array.ndim == 0:
+        yield Ellipsis
+        return
+    rowBytes = array.itemsize * (array.size // max(array.shape[0], 1))
+    step = max(1, SLAB_BYTES // max(rowBytes, 1))
+    for start in range(0, array.shape[0], step):
+        yield slice(start, start + step)
+
+
+def _overlap(submitted, groundTruth):
+    """
+    Count the foreground voxels of both masks and of their intersection.
+    Nonzero values are foreground.
+    """
+    submitted = numpy.asanyarray(submitted)
+    groundTruth = numpy.asanyarray(groundTruth)
+    _checkShapes(submitted, groundTruth)
+
+    nSubmitted = nTruth = nBoth = 0
+    for s in _slabs(submitted):
+        a = submitted[s] != 0
+        b = groundTruth[s] != 0
+        nSubmitted += numpy.count_nonzero(a)
+        nTruth += numpy.count_nonzero(b)
+        nBoth += numpy.count_nonzero(a & b)
+    return nSubmitted, nTruth, nBoth
+
+
+def dice(submitted, groundTruth):
+    """
+    Dice coefficient of two binary masks. Two empty masks score 1.
+    """
+    nSubmitted, nTruth, nBoth = _overlap(submitted, groundTruth)
+    total = nSubmitted + nTruth
+    return 2.0 * nBoth / total if total else 1.0
+
+
+def jaccard(submitted, groundTruth):
+    """
+    Jaccard index (intersection over union) of two binary masks. Two empty
+    masks score 1.
+    """
+    nSubmitted, nTruth, nBoth = _overlap(submitted, groundTruth)
+    union = nSubmitted + nTruth - nBoth
+    return float(nBoth) / union if union else 1.0
+
+
+def hausdorff(submitted, groundTruth):
+    """
+    Symmetric Hausdorff distance between two binary masks, in voxels. Each
+    directed distance is read from the Euclidean distance transform of the
+    other mask's background. Two empty masks are 0 apart. The distance from
+    an empty mask to a non-empty one is undefined and reported as None, which
+    leaves the submission unscored rather than storing an infinite value that
+    cannot be serialized to JSON.
+    """
+    a = numpy.asanyarray(submitted) != 0
+    b = numpy.asanyarray(groundTruth) != 0
+    _checkShapes(a, b)
+
+    hasA, hasB = a.any(), b.any()
+    if not hasA and not hasB:
+        return 0.0
+    if not hasA or not hasB:
+        return None
+
+    toB = ndimage.distance_transform_edt(~b)
+    aToB = toB[a].max()
+    del toB
+    toA = ndimage.distance_transform_edt(~a)
+    return float(max(aToB, toA[b].max()))
+
+
+def auc(submitted, groundTruth):
+    """
+    Area under the ROC curve of submitted per-voxel scores against a binary
+    ground truth, computed from the Mann-Whitney U statistic with tied scores
+    given their average rank.
+    """
+    scores = numpy.asanyarray(submitted)
+    labels = numpy.asanyarray(groundTruth) != 0
+    _checkShapes(scores, labels)
+    scores = scores.ravel()
+    labels = labels.ravel()
+
+    nPos = numpy.count_nonzero(labels)
+    nNeg = labels.size - nPos
+    if not nPos or not nNeg:
+        raise ValueError('AUC is undefined unless the ground truth has both '
+                         'positive and negative voxels.')
+
+    unique, inverse, counts = numpy.unique(
+        scores, return_inverse=True, return_counts=True)
+    del unique
+    # 1-based average rank of each distinct score
+    ranks = numpy.cumsum(counts) - (counts - 1) / 2.0
+    rankSum = ranks[inverse][labels].sum()
+    return float((rankSum - nPos * (nPos + 1) / 2.0) / (nPos * nNeg))
+
+
+def accuracy(submitted, groundTruth):
+    """
+    Fraction of voxels (or samples) whose submitted label equals the ground
+    truth label.
+    """
+    submitted = numpy.asanyarray(submitted)
+    groundTruth = numpy.asanyarray(groundTruth)
+    _checkShapes(submitted, groundTruth)
+    if not submitted.size:
+        raise ValueError('Accuracy is undefined for empty inputs.')
+
+    equal = 0
+    for s in _slabs(submitted):
+        equal += numpy.count_nonzero(submitted[s] == groundTruth[s])
+    return float(equal) / submitted.size
+
+
+METRICS = {m.name: m for m in (
+    Metric('dice', dice, True, 1),
+    Metric('jaccard', jaccard, True, 1),
+    Metric('hausdorff', hausdorff, False, 2),
+    Metric('auc', auc, True, 1),
+    Metric('accuracy', accuracy, True, 1)
+)}
+
+DEFAULT_METRIC = 'dice'
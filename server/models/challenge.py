@@ -22,12 +22,39 @@ import datetime
 from girder.constants import AccessType
 from girder.models.model_base import AccessControlledModel, ValidationException
 from girder.utility.progress import noProgress
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
+from ..cache import cachedAccessLevel, invalidateAccess, invalidateDocument
+from ..feed import publish
+from ..instrumentation import CountedModel, timed
+from ..utility import (DUPLICATE_KEY, PROVISIONING, READY, accessQuery,
+                       combineQueries, insertDocuments, keysetQuery,
+                       keysetSort, listProjection, newCollection,
+                       normalizeName, prefixSearch, textSearch)
 
-class Challenge(AccessControlledModel):
+
+class Challenge(CountedModel, AccessControlledModel):
     def initialize(self):
         self.name = 'challenge_challenge'
         self.ensureIndices(('collectionId', 'name'))
+        # Support the permission clauses of accessQuery and keyset paging
+        # sorted by name
+        self.ensureIndices((
+            ([('name', 1), ('_id', 1)], {}),
+            ([('public', 1), ('name', 1), ('_id', 1)], {}),
+            ([('access.users.id', 1), ('name', 1), ('_id', 1)], {}),
+            ([('access.groups.id', 1), ('name', 1), ('_id', 1)], {})
+        ))
+        # Support prefix search on the normalized name, which must also be
+        # unique. Documents saved before it existed are not indexed until
+        # they are backfilled.
+        self.ensureIndices((
+            ('lowerName', {'unique': True, 'sparse': True}),
+            ([('public', 1), ('lowerName', 1)], {}),
+            ([('access.users.id', 1), ('lowerName', 1)], {}),
+            ([('access.groups.id', 1), ('lowerName', 1)], {})
+        ))
         self.ensureTextIndex({
             'name': 10,
             'description': 1
@@ -35,34 +62,81 @@ class Challenge(AccessControlledModel):
 
         self.exposeFields(level=AccessType.READ, fields=(
             '_id', 'creatorId', 'collectionId', 'name', 'description',
-            'instructions'))
+            'instructions', 'created', 'updated', 'state'))
+        # Exposed fields returned by summary listings, which leave out the
+        # long text fields
+        self.summaryFields = ('_id', 'creatorId', 'collectionId', 'name',
+                              'created', 'updated', 'state')
+
+    @timed('model', 'challenge.list')
+    def list(self, user=None, limit=50, offset=0, sort=None, after=None,
+             fields=None):
+        """
+        List a page of challenges the user can read. The permission check is
+        part of the query, so only the requested page is read from the
+        database.
+
+        :param after: If set, the (sort value, _id) pair of the last
+        challenge of the previous page. The listing resumes right after it
+        and offset is ignored.
+        :type after: tuple or None
+        :param fields: If set, only read these fields, along with those
+        needed to check access and page through the listing.
+        :type fields: list of str or None
+        :returns: The page of documents.
+        :rtype: list of dict
+        """
+        sort = keysetSort(sort)
+        query = accessQuery(user, AccessType.READ)
+        if after is not None:
+            query = combineQueries(query, keysetQuery(sort, after))
+            offset = 0
+        # Read the page here so that the timing covers the query
+        return list(self.find(query, limit=limit, offset=offset, sort=sort,
+                              fields=listProjection(fields, sort)))
+
+    def count(self, user=None):
+        """
+        Count the challenges the user can read.
+        """
+        return self.find(accessQuery(user, AccessType.READ), limit=0).count()
 
-    def list(self, user=None, limit=50, offset=0, sort=None):
+    def prefixSearch(self, query, user=None, filters=None, limit=0,
+                     offset=0, level=AccessType.READ, fields=None):
         """
-        List a page of challenges.
+        Search for challenges whose name starts with the query, ignoring case.
         """
-        cursor = self.find({}, limit=0, sort=sort)
+        return prefixSearch(self, query, user=user, filters=filters,
+                            limit=limit, offset=offset, level=level,
+                            fields=fields)
 
-        for r in self.filterResultsByPermission(cursor=cursor, user=user,
-                                                level=AccessType.READ,
-                                                limit=limit, offset=offset):
-            yield r
+    def textSearch(self, query, user=None, filters=None, limit=0, offset=0,
+                   level=AccessType.READ):
+        """
+        Full text search on the name and description of challenges.
+        """
+        return textSearch(self, query, user=user, filters=filters,
+                          limit=limit, offset=offset, level=level)
 
+    @timed('model', 'challenge.subtreeCount')
     def subtreeCount(self, challenge):
         """
         Count up the recursive size of the challenge. This sums the size of
-        each individual phase, then adds 1 for the challenge itself.
+        each individual phase, then adds 1 for the challenge itself. Phases
+        and their submissions are each counted in a single aggregation rather
+        than by visiting every phase.
         """
         count = 1
-
-        phases = self.model('phase', 'challenge').find({
-            'challengeId': challenge['_id']
-        }, fields=(), limit=0)
-        for phase in phases:
-            count += self.model('phase', 'challenge').subtreeCount(phase)
-
+        for model in ('phase', 'submission'):
+            result = list(self.model(model, 'challenge').collection.aggregate([
+                {'$match': {'challengeId': challenge['_id']}},
+                {'$group': {'_id': None, 'count': {'$sum': 1}}}
+            ]))
+            if result:
+                count += result[0]['count']
         return count
 
+    @timed('model', 'challenge.validate')
     def validate(self, doc):
         doc['name'] = doc['name'].strip()
         if doc.get('description'):
@@ -73,53 +147,227 @@ class Challenge(AccessControlledModel):
         if not doc['name']:
             raise ValidationException(
                 'Challenge name must not be empty.', 'name')
+        # Uniqueness of the name is enforced by the unique index on
+        # lowerName; see save().
+        doc['lowerName'] = normalizeName(doc['name'])
 
-        # Ensure unique name for the collection
-        q = {
-            'name': doc['name']
-        }
+        return doc
+
+    def getAccessLevel(self, doc, user):
+        return cachedAccessLevel(
+            self, doc, user,
+            lambda: AccessControlledModel.getAccessLevel(self, doc, user))
+
+    def hasAccess(self, doc, user=None, level=AccessType.READ):
+        return self.getAccessLevel(doc, user) >= level
+
+    def setAccessList(self, doc, *args, **kwargs):
+        # Access changes count as modifications for Last-Modified
+        doc['updated'] = datetime.datetime.utcnow()
+        doc = AccessControlledModel.setAccessList(self, doc, *args, **kwargs)
         if '_id' in doc:
-            q['_id'] = {'$ne': doc['_id']}
-        duplicate = self.findOne(q, fields=['_id'])
-        if duplicate is not None:
-            raise ValidationException('A challenge with that name already '
-                                      'exists.', 'name')
+            invalidateAccess(self.name, doc['_id'])
+        return doc
 
+    def setPublic(self, doc, *args, **kwargs):
+        doc['updated'] = datetime.datetime.utcnow()
+        doc = AccessControlledModel.setPublic(self, doc, *args, **kwargs)
+        if '_id' in doc:
+            invalidateAccess(self.name, doc['_id'])
         return doc
 
+    def save(self, challenge, *args, **kwargs):
+        action = 'update' if '_id' in challenge else 'create'
+        try:
+            challenge = AccessControlledModel.save(
+                self, challenge, *args, **kwargs)
+        except DuplicateKeyError:
+            raise ValidationException('A challenge with that name already '
+                                      'exists.', 'name')
+        invalidateDocument(self.name, challenge['_id'])
+        publish('challenge', action, challenge)
+        return challenge
+
+    @timed('model', 'challenge.remove')
     def remove(self, challenge, progress=noProgress):
-        # Remove all phases for this challenge
-        phases = self.model('phase', 'challenge').find({
-            'challengeId': challenge['_id']
-        }, limit=0, timeout=False)
-        for phase in phases:
-            self.model('phase', 'challenge').remove(phase, progress=progress)
-        phases.close()
+        # Remove all submissions and phases for this challenge in batches
+        self.model('submission', 'challenge').removeForChallenge(
+            challenge, progress=progress)
+        self.model('leaderboard', 'challenge').removeForChallenge(challenge)
+        self.model('job', 'challenge').removeForChallenge(challenge)
+        self.model('phase', 'challenge').removeForChallenge(
+            challenge, progress=progress)
 
         AccessControlledModel.remove(self, challenge)
+        invalidateDocument(self.name, challenge['_id'])
+        # Stands for the removal of its phases as well
+        publish('challenge', 'remove', challenge)
 
         progress.update(increment=1,
                         message='Deleted challenge ' + challenge['name'])
 
-    def createChallenge(self, name, creator, description='', instructions='',
-                        public=True):
-        collection = self.model('collection').findOne({
-            'name': name
-        })
-
-        if collection is None:
-            collection = self.model('collection').createCollection(
-                name, creator=creator, public=public)
+    def _challengeDoc(self, name, creator, collection, description='',
+                      instructions='', public=True):
         challenge = {
             'name': name,
             'creatorId': creator['_id'],
-            'collectionId': collection['_id'],
+            'collectionId': collection['_id'] if collection else None,
             'description': description,
             'instructions': instructions,
+            'state': READY if collection else PROVISIONING,
             'created': datetime.datetime.utcnow()
         }
 
         self.setPublic(challenge, public=public)
         self.setUserAccess(challenge, user=creator, level=AccessType.ADMIN)
+        return challenge
+
+    def _collection(self, name, creator, public):
+        """
+        Create the collection of a challenge, or reuse the collection that
+        already has its name.
+
+        :returns: The collection, and whether it was created.
+        """
+        try:
+            return self.model('collection').createCollection(
+                name, creator=creator, public=public), True
+        except ValidationException:
+            collection = self.model('collection').findOne({'name': name})
+            if collection is None:
+                raise
+            return collection, False
+
+    @timed('model', 'challenge.createChallenge')
+    def createChallenge(self, name, creator, description='', instructions='',
+                        public=True, defer=False):
+        """
+        Create a new challenge along with its collection.
+
+        :param defer: Save the challenge right away in the provisioning state
+        and leave the creation of its collection to a job.
+        :type defer: bool
+        """
+        collection, created = None, False
+        if not defer:
+            collection, created = self._collection(name, creator, public)
+
+        try:
+            challenge = self.save(self._challengeDoc(
+                name, creator, collection, description=description,
+                instructions=instructions, public=public))
+        except ValidationException:
+            # E.g. another challenge has the same name but for case, which
+            # the collection names do not catch; do not leave the new
+            # collection behind.
+            if created:
+                self.model('collection').remove(collection)
+            raise
+        if defer:
+            self.model('job', 'challenge').enqueue('provision', challenge)
+        return challenge
+
+    def provision(self, challenge):
+        """
+        Create the collection of a challenge created with ``defer=True`` and
+        mark the challenge ready. A collection that already has the name of
+        the challenge is reused, so provisioning may be retried safely.
+
+        :returns: The challenge document, up to date.
+        """
+        if challenge.get('state') != PROVISIONING:
+            return challenge
+        creator = self.model('user').load(challenge['creatorId'], force=True)
+        collection, _ = self._collection(
+            challenge['name'], creator, challenge.get('public', False))
+
+        updated = self.collection.find_one_and_update(
+            {'_id': challenge['_id'], 'state': PROVISIONING},
+            {'$set': {'collectionId': collection['_id'], 'state': READY,
+                      'updated': datetime.datetime.utcnow()}},
+            return_document=ReturnDocument.AFTER)
+        invalidateDocument(self.name, challenge['_id'])
+        if updated is None:
+            # Provisioned concurrently, or removed
+            return self.load(challenge['_id'], force=True)
+        publish('challenge', 'update', updated)
+        return updated
+
+    def createChallenges(self, specs, creator):
+        """
+        Create many challenges at once. Challenges whose name is already taken
+        are returned as they are rather than created again, so the same specs
+        can be provisioned repeatedly. Existing challenges and collections are
+        looked up with one query each, and the new collections and challenges
+        are each written with a single ``insert_many``.
+
+        :param specs: The challenges to create, each a dict with a ``name``
+        and optional ``description``, ``instructions`` and ``public`` keys.
+        :type specs: list of dict
+        :param creator: The user creating the challenges.
+        :type creator: dict
+        :returns: A (challenge, created) pair for each spec, in order.
+        :rtype: list of tuple
+        """
+        names = [spec['name'].strip() for spec in specs]
+        existing = {doc['lowerName']: doc for doc in self.find({
+            'lowerName': {'$in': [normalizeName(n) for n in names]}
+        }, limit=0)}
+
+        collections = {c['name']: c for c in self.model('collection').find({
+            'name': {'$in': names}
+        }, limit=0)}
+
+        new, newCollections = {}, {}
+        for name, spec in zip(names, specs):
+            lowerName = normalizeName(name)
+            if lowerName in existing or lowerName in new:
+                continue
+            public = spec.get('public', False)
+            collection = collections.get(name)
+            if collection is None:
+                collection = newCollection(name, creator, public)
+                collections[name] = newCollections[lowerName] = collection
+            new[lowerName] = self.validate(self._challengeDoc(
+                name, creator, collection,
+                description=spec.get('description', ''),
+                instructions=spec.get('instructions', ''), public=public))
+
+        if new:
+            insertDocuments('collection', list(newCollections.values()))
+            try:
+                self.collection.insert_many(list(new.values()), ordered=False)
+            except BulkWriteError as e:
+                if e.details.get('writeConcernErrors') or any(
+                        err['code'] != DUPLICATE_KEY
+                        for err in e.details.get('writeErrors', ())):
+                    raise
+                # Some challenges were created concurrently; use those, and
+                # drop the collections created for ours.
+                taken = [err['op']['lowerName']
+                         for err in e.details['writeErrors']]
+                for doc in self.find(
+                        {'lowerName': {'$in': taken}}, limit=0):
+                    existing[doc['lowerName']] = doc
+                    new.pop(doc['lowerName'], None)
+                    collection = newCollections.get(doc['lowerName'])
+                    if collection is not None and \
+                            collection['_id'] != doc['collectionId']:
+                        self.model('collection').remove(collection)
+            for doc in new.values():
+                publish('challenge', 'create', doc)
+
+        return [(new[normalizeName(n)], True) if normalizeName(n) in new
+                else (existing[normalizeName(n)], False) for n in names]
+
+    def updateChallenge(self, challenge):
+        """
+        Updates a challenge.
+        :param challenge: The challenge document to update
+        :type challenge: dict
+        :returns: The challenge document that was edited.
+        """
+        challenge['updated'] = datetime.datetime.utcnow()
 
+        # Validate and save the challenge
         return self.save(challenge)
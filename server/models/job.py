@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import atexit
+import datetime
+import six
+import threading
+
+from girder import logger
+from girder.models.model_base import Model
+from girder.utility.config import getConfig
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from ..instrumentation import CountedModel
+
+# Deadline used to sort phases without one after all others
+NO_DEADLINE = datetime.datetime(9999, 12, 31)
+# Upper bound of the delay before a failed job is retried, in seconds
+MAX_RETRY_DELAY = 3600
+# Types of jobs run before any other, whatever the state of their phase
+URGENT_TYPES = ('provision',)
+URGENT_DEADLINE = datetime.datetime(1970, 1, 1)
+
+
+class Job(CountedModel, Model):
+    """
+    A queue of background work, such as scoring the submissions to a phase.
+    Jobs are stored in Mongo so that the workers of every Girder process
+    share the queue without any other broker. Workers lease a job with a
+    single ``findAndModify``; the lease expires unless it is renewed, so
+    jobs of a worker that died are eventually run again.
+
+    Queued jobs are taken from active phases first, then by earliest phase
+    deadline, then oldest first; provisioning jobs go before all of them.
+    At most ``job_phase_concurrency`` jobs of a phase run at once: a running
+    job holds one of that many numbered slots of its phase, which a unique
+    index keeps from being taken twice. Jobs on a whole challenge have no
+    phase and no such limit. Another unique index, restricted to queued
+    jobs, keeps a job from being queued twice with the same parameters.
+    """
+    def initialize(self):
+        self.name = 'challenge_job'
+        self.ensureIndices((
+            ([('state', 1), ('active', -1), ('deadline', 1), ('created', 1)],
+             {}),
+            ([('state', 1), ('leaseExpires', 1)], {}),
+            ([('phaseId', 1), ('state', 1), ('created', -1)], {}),
+            ([('phaseId', 1), ('slot', 1)], {
+                'unique': True,
+                'partialFilterExpression': {'slot': {'$exists': True}}
+            }),
+            ([('type', 1), ('challengeId', 1), ('phaseId', 1),
+              ('params', 1)], {
+                'unique': True,
+                'partialFilterExpression': {'state': 'queued'}
+            }),
+            'challengeId'
+        ))
+
+        conf = getConfig().get('challenge', {})
+        self.leaseSeconds = float(conf.get('job_lease', 600))
+        self.maxAttempts = int(conf.get('job_max_attempts', 5))
+        self.retryDelay = float(conf.get('job_retry_delay', 30))
+        self.phaseConcurrency = int(conf.get('job_phase_concurrency', 1))
+        self.enqueueDelay = float(conf.get('job_enqueue_delay', 1))
+
+        # Jobs to queue at the end of the current delay, keyed by type and
+        # phase ID
+        self._pending = {}
+        self._pendingLock = threading.Lock()
+        self._flushTimer = None
+        atexit.register(self.flushPending)
+
+    def validate(self, doc):
+        return doc
+
+    def _priority(self, phase, type):
+        if type in URGENT_TYPES:
+            return {'active': True, 'deadline': URGENT_DEADLINE}
+        return {
+            'active': bool(phase.get('active')),
+            'deadline': phase.get('deadline') or NO_DEADLINE
+        }
+
+    def enqueue(self, type, phase, params=None):
+        """
+        Queue a job for a phase. If an identical job is already waiting, it
+        is returned instead of queueing another one; the unique index on
+        queued jobs settles concurrent calls.
+
+        :param type: The type of the job, which selects its handler.
+        :type type: str
+        :param phase: The phase the job works on, or a challenge for jobs on
+        a whole challenge.
+        :type phase: dict
+        :param params: Parameters passed on to the handler.
+        :type params: dict or None
+        :returns: The job document.
+        """
+        if 'challengeId' in phase:
+            phaseId, challengeId = phase['_id'], phase['challengeId']
+        else:
+            phaseId, challengeId = None, phase['_id']
+        now = datetime.datetime.utcnow()
+        update = {
+            '$set': self._priority(phase, type),
+            '$setOnInsert': {
+                'challengeId': challengeId,
+                'attempts': 0,
+                'maxAttempts': self.maxAttempts,
+                'notBefore': now,
+                'created': now
+            }
+        }
+        query = {
+            'type': type,
+            'challengeId': challengeId,
+            'phaseId': phaseId,
+            'params': params or {},
+            'state': 'queued'
+        }
+        while True:
+            try:
+                return self.collection.find_one_and_update(
+                    query, update, upsert=True,
+                    return_document=ReturnDocument.AFTER)
+            except DuplicateKeyError:
+                # Inserted concurrently; the retry updates that job instead.
+                continue
+
+    def enqueueSoon(self, type, phase):
+        """
+        Queue a job for a phase once ``job_enqueue_delay`` seconds have
+        passed, for all the calls made meanwhile in this process. A burst of
+        submissions to a phase thus queues its scoring once rather than on
+        every request. Pending jobs are queued when the process exits; those
+        lost to a crash are queued by the next call for their phase.
+
+        :param type: The type of the job, which selects its handler.
+        :type type: str
+        :param phase: The phase the job works on.
+        :type phase: dict
+        """
+        if self.enqueueDelay <= 0:
+            self.enqueue(type, phase)
+            return
+        with self._pendingLock:
+            self._pending[(type, phase['_id'])] = phase
+            if self._flushTimer is None:
+                self._flushTimer = threading.Timer(
+                    self.enqueueDelay, self.flushPending)
+                self._flushTimer.daemon = True
+                self._flushTimer.start()
+
+    def flushPending(self):
+        """
+        Queue the jobs waiting in ``enqueueSoon`` right away.
+        """
+        with self._pendingLock:
+            pending, self._pending = self._pending, {}
+            if self._flushTimer is not None:
+                self._flushTimer.cancel()
+                self._flushTimer = None
+        for (type, _), phase in six.iteritems(pending):
+            try:
+                self.enqueue(type, phase)
+            except Exception:
+                logger.exception('Could not queue a %s job for phase %s.',
+                                 type, phase['_id'])
+
+    def reprioritize(self, phase):
+        """
+        Update the priority of the queued jobs of a phase, e.g. after its
+        deadline changed.
+        """
+        self.collection.update_many(
+            {'phaseId': phase['_id'], 'state': 'queued',
+             'type': {'$nin': list(URGENT_TYPES)}},
+            {'$set': self._priority(phase, None)})
+
+    def lease(self, workerId):
+        """
+        Take the job to run next, if any. The job is marked as running and
+        leased to the worker for ``job_lease`` seconds.
+
+        :param workerId: A unique name of the worker.
+        :type workerId: str
+        :returns: The job document, or None if no job can run now.
+        """
+        now = datetime.datetime.utcnow()
+        busyPhases = []
+        while True:
+            job = self.collection.find_one_and_update({
+                'state': 'queued',
+                'notBefore': {'$lte': now},
+                'phaseId': {'$nin': busyPhases}
+            }, {
+                '$set': {
+                    'state': 'running',
+                    'workerId': workerId,
+                    'leaseExpires': now + datetime.timedelta(
+                        seconds=self.leaseSeconds),
+                    'updated': now
+                },
+                '$inc': {'attempts': 1}
+            }, sort=[('active', -1), ('deadline', 1), ('created', 1)],
+                return_document=ReturnDocument.AFTER)
+            if job is None or self._takeSlot(job):
+                return job
+
+            # The phase already runs as many jobs as it may; put this one
+            # back and look further down the queue.
+            try:
+                self.collection.update_one(
+                    {'_id': job['_id'], 'workerId': workerId},
+                    {'$set': {'state': 'queued'},
+                     '$unset': {'workerId': '', 'leaseExpires': ''},
+                     '$inc': {'attempts': -1}})
+            except DuplicateKeyError:
+                # An identical job was queued meanwhile and stands for this
+                # one, which never ran.
+                self.collection.delete_one(
+                    {'_id': job['_id'], 'workerId': workerId})
+            busyPhases.append(job['phaseId'])
+
+    def _takeSlot(self, job):
+        if job['phaseId'] is None:
+            return True
+        for slot in range(self.phaseConcurrency):
+            try:
+                result = self.collection.update_one(
+                    {'_id': job['_id'], 'workerId': job['workerId']},
+                    {'$set': {'slot': slot}})
+            except DuplicateKeyError:
+                continue
+            job['slot'] = slot
+            return result.modified_count == 1
+        return False
+
+    def renewLease(self, job):
+        """
+        Extend the lease of a running job.
+
+        :returns: Whether the worker still holds the lease.
+        :rtype: bool
+        """
+        return self.collection.update_one({
+            '_id': job['_id'],
+            'workerId': job['workerId'],
+            'state': 'running'
+        }, {'$set': {'leaseExpires': datetime.datetime.utcnow() +
+                     datetime.timedelta(seconds=self.leaseSeconds)}}
+        ).modified_count == 1
+
+    def complete(self, job):
+        """
+        Mark a leased job as done and free its phase slot.
+        """
+        self.collection.update_one({
+            '_id': job['_id'],
+            'workerId': job['workerId'],
+            'state': 'running'
+        }, {
+            '$set': {'state': 'done', 'updated': datetime.datetime.utcnow()},
+            '$unset': {'slot': '', 'workerId': '', 'leaseExpires': ''}
+        })
+
+    def fail(self, job, error):
+        """
+        Record the failure of a leased job. It is queued again after a delay
+        doubling with each attempt, until it has been tried ``maxAttempts``
+        times.
+
+        :param error: A description of the failure.
+        :type error: str
+        """
+        self._release(job, error, {
+            'workerId': job['workerId'],
+            'state': 'running'
+        })
+
+    def _release(self, job, error, query):
+        now = datetime.datetime.utcnow()
+        update = {
+            '$set': {'error': error, 'updated': now},
+            '$unset': {'slot': '', 'workerId': '', 'leaseExpires': ''}
+        }
+        if job['attempts'] < job['maxAttempts']:
+            delay = min(self.retryDelay * 2 ** (job['attempts'] - 1),
+                        MAX_RETRY_DELAY)
+            update['$set']['state'] = 'queued'
+            update['$set']['notBefore'] = now + datetime.timedelta(
+                seconds=delay)
+        else:
+            update['$set']['state'] = 'error'
+        query['_id'] = job['_id']
+        try:
+            return self.collection.update_one(
+                query, update).modified_count == 1
+        except DuplicateKeyError:
+            # An identical job was queued meanwhile and will do the work.
+            update['$set']['state'] = 'error'
+            update['$set'].pop('notBefore', None)
+            return self.collection.update_one(
+                query, update).modified_count == 1
+
+    def reclaim(self):
+        """
+        Release the jobs whose lease expired, as if they had failed, so that
+        they are retried by another worker.
+
+        :returns: The number of jobs released.
+        :rtype: int
+        """
+        count = 0
+        for job in self.find({
+            'state': 'running',
+            'leaseExpires': {'$lt': datetime.datetime.utcnow()}
+        }, limit=0):
+            count += self._release(
+                job, 'The lease of worker %s expired.' % job['workerId'], {
+                    'state': 'running',
+                    'workerId': job['workerId'],
+                    'leaseExpires': job['leaseExpires']
+                })
+        return count
+
+    def list(self, phase, limit=50, offset=0):
+        """
+        List the jobs of a phase, most recent first.
+        """
+        return self.find({'phaseId': phase['_id']}, limit=limit,
+                         offset=offset, sort=[('created', -1)])
+
+    def removeForPhase(self, phase):
+        self.collection.delete_many({'phaseId': phase['_id']})
+
+    def removeForChallenge(self, challenge):
+        self.collection.delete_many({'challengeId': challenge['_id']})
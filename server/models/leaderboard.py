@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import datetime
+
+from girder.models.model_base import Model
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from ..feed import publish
+from ..instrumentation import CountedModel
+from ..metrics import DEFAULT_METRIC, METRICS
+from ..utility import DUPLICATE_KEY
+
+# Leaderboard fields returned by listings; all of them are in the
+# (phaseId, score, ...) index so that listings are covered by it.
+LISTED_FIELDS = ('score', 'userId', 'submissionId')
+
+
+class Leaderboard(CountedModel, Model):
+    """
+    The best score of each participant of a phase, kept up to date as
+    submissions are scored so that rankings never have to scan submissions.
+    """
+    def initialize(self):
+        self.name = 'challenge_leaderboard'
+        self.ensureIndices((
+            ([('phaseId', 1), ('userId', 1)], {'unique': True}),
+            ([('phaseId', 1), ('score', -1), ('userId', 1),
+              ('submissionId', 1)], {}),
+            'challengeId'
+        ))
+
+    def validate(self, doc):
+        return doc
+
+    def _sortDir(self, phase):
+        metric = METRICS[phase.get('metric') or DEFAULT_METRIC]
+        return -1 if metric.higherIsBetter else 1
+
+    def updateScores(self, phase, submissions):
+        """
+        Record newly computed scores, keeping only the best score of each
+        participant. This is a single unordered bulk write of conditional
+        upserts: an entry is only replaced by a better score, and an upsert
+        that would create a second entry for a participant fails on the
+        unique index and is ignored.
+
+        :param phase: The phase the submissions belong to.
+        :type phase: dict
+        :param submissions: Scored submissions, with at least ``_id``,
+        ``creatorId`` and ``score``. Those without a score are ignored.
+        :type submissions: iterable of dict
+        """
+        if self._updateScores(phase, submissions):
+            publish('leaderboard', 'update', phase)
+
+    def _updateScores(self, phase, submissions):
+        """
+        :returns: Whether there was any score to record.
+        :rtype: bool
+        """
+        worse = '$lt' if self._sortDir(phase) == -1 else '$gt'
+        now = datetime.datetime.utcnow()
+        ops = [UpdateOne({
+            'phaseId': phase['_id'],
+            'userId': s['creatorId'],
+            'score': {worse: s['score']}
+        }, {'$set': {
+            'challengeId': phase['challengeId'],
+            'score': s['score'],
+            'submissionId': s['_id'],
+            'updated': now
+        }}, upsert=True) for s in submissions if s.get('score') is not None]
+
+        if not ops:
+            return False
+        try:
+            self.collection.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            if e.details.get('writeConcernErrors') or any(
+                    err['code'] != DUPLICATE_KEY
+                    for err in e.details.get('writeErrors', ())):
+                raise
+        return True
+
+    def refreshUsers(self, phase, userIds):
+        """
+        Recompute the entries of some participants from their submissions,
+        e.g. after a submission was removed.
+        """
+        submissions = self.model('submission', 'challenge').find({
+            'phaseId': phase['_id'],
+            'creatorId': {'$in': list(userIds)},
+            'score': {'$ne': None}
+        }, fields=['creatorId', 'score'], limit=0)
+
+        best = {}
+        sortDir = self._sortDir(phase)
+        for s in submissions:
+            current = best.get(s['creatorId'])
+            if current is None or sortDir * (current['score'] - s['score']) > 0:
+                best[s['creatorId']] = s
+
+        ops = [DeleteOne({'phaseId': phase['_id'], 'userId': userId})
+               for userId in userIds if userId not in best]
+        ops += [UpdateOne({
+            'phaseId': phase['_id'],
+            'userId': userId
+        }, {'$set': {
+            'challengeId': phase['challengeId'],
+            'score': s['score'],
+            'submissionId': s['_id'],
+            'updated': datetime.datetime.utcnow()
+        }}, upsert=True) for userId, s in best.items()]
+        if ops:
+            self.collection.bulk_write(ops, ordered=False)
+            publish('leaderboard', 'update', phase)
+
+    def rebuild(self, phase):
+        """
+        Rebuild the leaderboard of a phase from all of its scored
+        submissions, e.g. after every submission was rescored.
+        """
+        self.removeForPhase(phase)
+        self._updateScores(phase, self.model('submission', 'challenge').find({
+            'phaseId': phase['_id'],
+            'score': {'$ne': None}
+        }, fields=['creatorId', 'score'], limit=0))
+        publish('leaderboard', 'update', phase)
+
+    def list(self, phase, limit=50, offset=0):
+        """
+        List the best scores of a phase from best to worst, each with its
+        1-based rank as given by ``getRank``: ties share the best rank. The
+        query is covered by the leaderboard index; one more query counts the
+        better entries when the page does not start at the top.
+
+        :returns: The page of entries.
+        :rtype: list of dict
+        """
+        fields = {field: True for field in LISTED_FIELDS}
+        fields['_id'] = False
+        sortDir = self._sortDir(phase)
+        entries = list(self.find(
+            {'phaseId': phase['_id']}, fields=fields, limit=limit,
+            offset=offset, sort=[('score', sortDir), ('userId', -sortDir)]))
+
+        for i, entry in enumerate(entries):
+            if i and entry['score'] == entries[i - 1]['score']:
+                entry['rank'] = entries[i - 1]['rank']
+            elif i or not offset:
+                entry['rank'] = offset + i + 1
+            else:
+                entry['rank'] = self._rank(phase, entry['score'])
+        return entries
+
+    def _rank(self, phase, score):
+        better = '$gt' if self._sortDir(phase) == -1 else '$lt'
+        return 1 + self.find({
+            'phaseId': phase['_id'],
+            'score': {better: score}
+        }, fields={'_id': False, 'score': True}, limit=0).count()
+
+    def getRank(self, phase, user):
+        """
+        Get the leaderboard entry of a participant along with its 1-based
+        rank, or None if the participant has no scored submission. Ties share
+        the best rank.
+        """
+        fields = {field: True for field in LISTED_FIELDS}
+        fields['_id'] = False
+        entry = self.findOne(
+            {'phaseId': phase['_id'], 'userId': user['_id']}, fields=fields)
+        if entry is None:
+            return None
+        entry['rank'] = self._rank(phase, entry['score'])
+        return entry
+
+    def removeForPhase(self, phase):
+        self.collection.delete_many({'phaseId': phase['_id']})
+
+    def removeForChallenge(self, challenge):
+        self.collection.delete_many({'challengeId': challenge['_id']})
@@ -19,50 +19,236 @@
 
 import datetime
 
+from girder import events
 from girder.constants import AccessType
 from girder.models.model_base import AccessControlledModel, ValidationException
 from girder.utility.progress import noProgress
+from pymongo import ReturnDocument, UpdateOne
 
+from ..cache import (cachedAccessLevel, invalidateAccess, invalidateDocument,
+                     invalidateListing)
+from ..constants import PluginSettings
+from ..feed import publish
+from ..groundtruth import GroundTruth, getCache, invalidateFolderIds
+from ..instrumentation import CountedModel, timed
+from ..metrics import DEFAULT_METRIC, METRICS
+from ..scoring import decode
+from ..utility import (PROVISIONING, READY, accessQuery, combineQueries,
+                       folderFiles, insertDocuments, keysetQuery, keysetSort,
+                       listProjection, newFolder, newGroup, normalizeName,
+                       prefixSearch, readFile, textSearch)
 
-class Phase(AccessControlledModel):
+GROUND_TRUTH_FOLDER = 'Ground truth'
+
+
+class Phase(CountedModel, AccessControlledModel):
     def initialize(self):
         self.name = 'challenge_phase'
-        self.ensureIndices(('challengeId', 'name'))
+        self.ensureIndices(('challengeId', 'name', 'groundTruthFolderId',
+                            'participantGroupId'))
+        # Support the permission clauses of accessQuery and keyset paging
+        # sorted by name
+        self.ensureIndices((
+            ([('challengeId', 1), ('name', 1), ('_id', 1)], {}),
+            ([('challengeId', 1), ('public', 1), ('name', 1), ('_id', 1)],
+             {}),
+            ([('challengeId', 1), ('access.users.id', 1), ('name', 1),
+              ('_id', 1)], {}),
+            ([('challengeId', 1), ('access.groups.id', 1), ('name', 1),
+              ('_id', 1)], {})
+        ))
+        # Support prefix search on the normalized name
+        self.ensureIndices((
+            'lowerName',
+            ([('public', 1), ('lowerName', 1)], {}),
+            ([('access.users.id', 1), ('lowerName', 1)], {}),
+            ([('access.groups.id', 1), ('lowerName', 1)], {})
+        ))
+        self.ensureTextIndex({
+            'name': 10,
+            'description': 1
+        })
 
         self.exposeFields(level=AccessType.READ, fields=(
             '_id', 'name', 'public', 'description', 'created', 'updated',
             'active', 'challengeId', 'folderId', 'participantGroupId',
-            'groundTruthFolderId', 'instructions'))
+            'groundTruthFolderId', 'instructions', 'metric',
+            'participantCount', 'deadline', 'state'))
+        # Exposed fields returned by summary listings, which leave out the
+        # long text fields
+        self.summaryFields = (
+            '_id', 'name', 'public', 'created', 'updated', 'active',
+            'challengeId', 'metric', 'participantCount', 'deadline', 'state')
 
-    def list(self, challenge, user=None, limit=50, offset=0, sort=None):
+    @timed('model', 'phase.list')
+    def list(self, challenge, user=None, limit=50, offset=0, sort=None,
+             after=None, fields=None):
         """
-        List phases for a challenge.
+        List phases for a challenge that the user can read. The permission
+        check is part of the query, so only the requested page is read from
+        the database.
+
+        :param after: If set, the (sort value, _id) pair of the last phase of
+        the previous page. The listing resumes right after it and offset is
+        ignored.
+        :type after: tuple or None
+        :param fields: If set, only read these fields, along with those
+        needed to check access and page through the listing.
+        :type fields: list of str or None
+        :returns: The page of documents.
+        :rtype: list of dict
         """
-        cursor = self.find(
-            {'challengeId': challenge['_id']}, limit=0, sort=sort)
+        sort = keysetSort(sort)
+        query = combineQueries({'challengeId': challenge['_id']},
+                               accessQuery(user, AccessType.READ))
+        if after is not None:
+            query = combineQueries(query, keysetQuery(sort, after))
+            offset = 0
+        # Read the page here so that the timing covers the query
+        return list(self.find(query, limit=limit, offset=offset, sort=sort,
+                              fields=listProjection(fields, sort)))
 
-        for r in self.filterResultsByPermission(cursor=cursor, user=user,
-                                                level=AccessType.READ,
-                                                limit=limit, offset=offset):
-            yield r
+    def loadMany(self, ids, user=None, level=AccessType.READ):
+        """
+        Load several phases with a single query, checking permissions as part
+        of it. Phases that do not exist or on which the user lacks the given
+        access level are left out.
 
+        :param ids: The IDs of the phases to load.
+        :type ids: list of ObjectId
+        :returns: A cursor over the phases.
+        """
+        query = combineQueries({'_id': {'$in': list(ids)}},
+                               accessQuery(user, level))
+        return self.find(query, limit=0)
+
+    def count(self, challenge, user=None):
+        """
+        Count the phases of a challenge that the user can read.
+        """
+        query = combineQueries({'challengeId': challenge['_id']},
+                               accessQuery(user, AccessType.READ))
+        return self.find(query, limit=0).count()
+
+    @timed('model', 'phase.validate')
     def validate(self, doc):
         if not doc.get('name'):
             raise ValidationException('Phase name must not be empty.',
                                       field='name')
+        doc['lowerName'] = normalizeName(doc['name'])
+        doc['metric'] = doc.get('metric') or DEFAULT_METRIC
+        if doc['metric'] not in METRICS:
+            raise ValidationException(
+                'Unknown metric "%s". Valid metrics are: %s.' % (
+                    doc['metric'], ', '.join(sorted(METRICS))), field='metric')
+        if doc.get('deadline') is not None and not isinstance(
+                doc['deadline'], datetime.datetime):
+            raise ValidationException('Phase deadline must be a date.',
+                                      field='deadline')
         return doc
 
+    def prefixSearch(self, query, user=None, filters=None, limit=0,
+                     offset=0, level=AccessType.READ, fields=None):
+        """
+        Search for phases whose name starts with the query, ignoring case.
+        """
+        return prefixSearch(self, query, user=user, filters=filters,
+                            limit=limit, offset=offset, level=level,
+                            fields=fields)
+
+    def textSearch(self, query, user=None, filters=None, limit=0, offset=0,
+                   level=AccessType.READ):
+        """
+        Full text search on the name and description of phases.
+        """
+        return textSearch(self, query, user=user, filters=filters,
+                          limit=limit, offset=offset, level=level)
+
+    @timed('model', 'phase.subtreeCount')
     def subtreeCount(self, phase):
-        # TODO if we refactor to move submission into challenge, count them here
-        return 1
+        """
+        Count up the recursive size of the phase: its submissions plus 1 for
+        the phase itself.
+        """
+        return 1 + self.model('submission', 'challenge').find({
+            'phaseId': phase['_id']
+        }, limit=0).count()
+
+    def getAccessLevel(self, doc, user):
+        return cachedAccessLevel(
+            self, doc, user,
+            lambda: AccessControlledModel.getAccessLevel(self, doc, user))
+
+    def hasAccess(self, doc, user=None, level=AccessType.READ):
+        return self.getAccessLevel(doc, user) >= level
 
+    def setAccessList(self, doc, *args, **kwargs):
+        # Access changes count as modifications for Last-Modified
+        doc['updated'] = datetime.datetime.utcnow()
+        doc = AccessControlledModel.setAccessList(self, doc, *args, **kwargs)
+        if '_id' in doc:
+            invalidateAccess(self.name, doc['_id'])
+        return doc
+
+    def setPublic(self, doc, *args, **kwargs):
+        doc['updated'] = datetime.datetime.utcnow()
+        doc = AccessControlledModel.setPublic(self, doc, *args, **kwargs)
+        if '_id' in doc:
+            invalidateAccess(self.name, doc['_id'])
+        return doc
+
+    def save(self, phase, *args, **kwargs):
+        action = 'update' if '_id' in phase else 'create'
+        phase = AccessControlledModel.save(self, phase, *args, **kwargs)
+        invalidateDocument(self.name, phase['_id'], phase['challengeId'])
+        invalidateFolderIds()
+        publish('phase', action, phase)
+        return phase
+
+    @timed('model', 'phase.remove')
     def remove(self, phase, progress=noProgress):
+        self.model('submission', 'challenge').removeForPhase(
+            phase, progress=progress)
+        self.model('leaderboard', 'challenge').removeForPhase(phase)
+        self.model('job', 'challenge').removeForPhase(phase)
         AccessControlledModel.remove(self, phase, progress=progress)
+        invalidateDocument(self.name, phase['_id'], phase['challengeId'])
+        publish('phase', 'remove', phase)
         progress.update(increment=1, message='Deleted phase ' + phase['name'])
 
+    def removeForChallenge(self, challenge, progress=noProgress,
+                           batchSize=1000):
+        """
+        Remove all phases of a challenge. The ids of the phases are collected
+        up front and the documents are deleted with one ``delete_many`` per
+        batch rather than one request per phase. This does not remove the
+        submissions to those phases; see
+        ``Submission.removeForChallenge``.
+
+        :param challenge: The challenge whose phases should be removed.
+        :type challenge: dict
+        :param progress: Progress context updated after each batch.
+        :param batchSize: The maximum number of phases to delete at once.
+        :type batchSize: int
+        """
+        ids = [p['_id'] for p in self.find({
+            'challengeId': challenge['_id']
+        }, fields=['_id'], limit=0)]
+
+        for start in range(0, len(ids), batchSize):
+            batch = ids[start:start + batchSize]
+            self.collection.delete_many({'_id': {'$in': batch}})
+            for id in batch:
+                invalidateDocument(self.name, id)
+            progress.update(increment=len(batch), message='Deleted %d of %d '
+                            'phases' % (start + len(batch), len(ids)))
+        invalidateListing(self.name, challenge['_id'])
+
+    @timed('model', 'phase.createPhase')
     def createPhase(self, name, challenge, creator, description='',
                     instructions='', active=False, public=True,
-                    participantGroup=None, groundTruthFolder=None):
+                    participantGroup=None, groundTruthFolder=None,
+                    metric=DEFAULT_METRIC, deadline=None, defer=False):
         """
         Create a new phase for a challenge. Will create a top-level folder under
         the challenge's collection. Will also create a new group for the
@@ -92,7 +278,33 @@ class Phase(AccessControlledModel):
         :param groundTruthFolder: The folder containing ground truth data
         for this challenge phase. If set to None, will create one under this
         phase's folder.
+        :param metric: The name of the built-in metric used to score
+        submissions to this phase.
+        :type metric: str
+        :param deadline: When the phase closes. Scoring jobs of active phases
+        with the nearest deadline run first.
+        :type deadline: datetime.datetime or None
+        :param defer: Save the phase right away in the provisioning state and
+        leave the creation of its folders and group to a job, which marks it
+        ready when done.
+        :type defer: bool
         """
+        if defer:
+            participantCount = 0
+            if participantGroup is not None:
+                participantCount = self.countMembers(
+                    [participantGroup['_id']])[participantGroup['_id']]
+            phase = self.save(self._phaseDoc(
+                name, challenge, creator, None, groundTruthFolder,
+                participantGroup, description=description,
+                instructions=instructions, active=active, public=public,
+                metric=metric, participantCount=participantCount,
+                deadline=deadline, state=PROVISIONING))
+            self.model('job', 'challenge').enqueue(
+                'provision', phase, {'creatorId': creator['_id']})
+            return phase
+
+        challenge = self.model('challenge', 'challenge').provision(challenge)
         collection = self.model('collection').load(challenge['collectionId'],
                                                    force=True)
 
@@ -102,33 +314,511 @@ class Phase(AccessControlledModel):
 
         if groundTruthFolder is None:
             groundTruthFolder = self.model('folder').createFolder(
-                folder, 'Ground truth', parentType='folder', public=False,
+                folder, GROUND_TRUTH_FOLDER, parentType='folder', public=False,
                 creator=creator, allowRename=True)
 
         if participantGroup is None:
-            groupName = '{} {} participants'.format(challenge['name'], name)
+            groupName = self._groupName(challenge, name)
             participantGroup = self.model('group').findOne({'name': groupName})
             if participantGroup is None:
                 participantGroup = self.model('group').createGroup(
                     groupName, creator, public=public)
+        participantCount = self.countMembers(
+            [participantGroup['_id']])[participantGroup['_id']]
+
+        return self.save(self._phaseDoc(
+            name, challenge, creator, folder, groundTruthFolder,
+            participantGroup, description=description,
+            instructions=instructions, active=active, public=public,
+            metric=metric, participantCount=participantCount,
+            deadline=deadline))
 
+    def _groupName(self, challenge, name):
+        return '{} {} participants'.format(challenge['name'], name)
+
+    def _phaseDoc(self, name, challenge, creator, folder, groundTruthFolder,
+                  participantGroup, description='', instructions='',
+                  active=False, public=True, metric=DEFAULT_METRIC,
+                  participantCount=0, deadline=None, state=READY):
         phase = {
             'name': name,
             'description': description,
             'instructions': instructions,
             'active': active,
             'challengeId': challenge['_id'],
-            'folderId': folder['_id'],
-            'participantGroupId': participantGroup['_id'],
-            'groundTruthFolderId': groundTruthFolder['_id'],
+            'folderId': folder['_id'] if folder else None,
+            'participantGroupId':
+                participantGroup['_id'] if participantGroup else None,
+            'groundTruthFolderId':
+                groundTruthFolder['_id'] if groundTruthFolder else None,
+            'metric': metric,
+            'participantCount': participantCount,
+            'deadline': deadline,
+            'state': state,
             'created': datetime.datetime.utcnow()
         }
 
         self.setPublic(phase, public=public)
         self.setUserAccess(phase, user=creator, level=AccessType.ADMIN)
-        self.setGroupAccess(phase, participantGroup, level=AccessType.READ)
+        if participantGroup is not None:
+            self.setGroupAccess(phase, participantGroup, level=AccessType.READ)
+        return phase
 
-        return self.save(phase)
+    def provision(self, phase, creator):
+        """
+        Create the folders and participant group of a phase created with
+        ``defer=True``, provisioning its challenge first if needed, and mark
+        the phase ready. Folders and groups that already exist under the
+        expected names are reused, as in ``createPhases``, so provisioning may
+        be retried safely.
+
+        :param creator: The user who created the phase.
+        :type creator: dict
+        :returns: The phase document, up to date.
+        """
+        if phase.get('state') != PROVISIONING:
+            return phase
+        challengeModel = self.model('challenge', 'challenge')
+        challenge = challengeModel.load(phase['challengeId'], force=True)
+        if challenge is None:
+            return phase
+        challenge = challengeModel.provision(challenge)
+
+        folderModel = self.model('folder')
+        public = phase.get('public', False)
+        update = {'state': READY, 'updated': datetime.datetime.utcnow()}
+        if phase.get('folderId') is None:
+            collection = self.model('collection').load(
+                challenge['collectionId'], force=True)
+            folder = folderModel.findOne({
+                'parentCollection': 'collection',
+                'parentId': collection['_id'],
+                'name': phase['name']
+            })
+            if folder is None:
+                folder = folderModel.createFolder(
+                    collection, phase['name'], parentType='collection',
+                    public=public, creator=creator)
+            update['folderId'] = folder['_id']
+        else:
+            folder = folderModel.load(phase['folderId'], force=True)
+
+        if phase.get('groundTruthFolderId') is None:
+            groundTruthFolder = folderModel.findOne({
+                'parentCollection': 'folder',
+                'parentId': folder['_id'],
+                'name': GROUND_TRUTH_FOLDER
+            })
+            if groundTruthFolder is None:
+                groundTruthFolder = folderModel.createFolder(
+                    folder, GROUND_TRUTH_FOLDER, parentType='folder',
+                    public=False, creator=creator)
+            update['groundTruthFolderId'] = groundTruthFolder['_id']
+
+        ops = {'$set': update}
+        if phase.get('participantGroupId') is None:
+            groupName = self._groupName(challenge, phase['name'])
+            group = self.model('group').findOne({'name': groupName})
+            if group is None:
+                group = self.model('group').createGroup(
+                    groupName, creator, public=public)
+            update['participantGroupId'] = group['_id']
+            update['participantCount'] = self.countMembers(
+                [group['_id']])[group['_id']]
+            ops['$push'] = {'access.groups': {
+                'id': group['_id'], 'level': AccessType.READ}}
+
+        updated = self.collection.find_one_and_update(
+            {'_id': phase['_id'], 'state': PROVISIONING}, ops,
+            return_document=ReturnDocument.AFTER)
+        invalidateDocument(self.name, phase['_id'], phase['challengeId'])
+        invalidateFolderIds()
+        if updated is None:
+            # Provisioned concurrently, or removed
+            return self.load(phase['_id'], force=True)
+        publish('phase', 'update', updated)
+        return updated
+
+    def createPhases(self, specs, creator):
+        """
+        Create many phases at once, possibly across several challenges.
+        Phases whose name is already used in their challenge are returned as
+        they are rather than created again, and folders and participant groups
+        that already exist under the expected names are reused, so the same
+        specs can be provisioned repeatedly. Unlike challenge names, phase
+        names have no unique index, since existing deployments may hold
+        phases whose names differ only in case; two concurrent calls with
+        the same specs may therefore both create a phase.
+
+        Existing phases, collections, folders and groups are each looked up
+        with a single query. The missing folders and groups are built as their
+        models would build them, and they and the new phases are each written
+        with a single ``insert_many``, once every phase is valid.
+
+        :param specs: (challenge, spec) pairs, where each spec is a dict with
+        a ``name`` and optional ``description``, ``instructions``,
+        ``active``, ``public`` and ``metric`` keys.
+        :type specs: list of tuple
+        :param creator: The user creating the phases.
+        :type creator: dict
+        :returns: A (phase, created) pair for each spec, in order.
+        :rtype: list of tuple
+        """
+        ready = {}
+        for challenge, _ in specs:
+            if challenge['_id'] not in ready:
+                ready[challenge['_id']] = self.model(
+                    'challenge', 'challenge').provision(challenge)
+        specs = [(ready[challenge['_id']], dict(
+            spec, name=spec['name'].strip())) for challenge, spec in specs]
+        keys = [(c['_id'], normalizeName(s['name'])) for c, s in specs]
+        if not specs:
+            return []
+
+        existing = {}
+        for doc in self.find({
+            'challengeId': {'$in': list({c['_id'] for c, _ in specs})},
+            'lowerName': {'$in': list({key[1] for key in keys})}
+        }, limit=0):
+            existing.setdefault((doc['challengeId'], doc['lowerName']), doc)
+
+        todo, seen = [], set()
+        for key, (challenge, spec) in zip(keys, specs):
+            if key not in existing and key not in seen:
+                seen.add(key)
+                todo.append((key, challenge, spec))
+        if not todo:
+            return [(existing[key], False) for key in keys]
+
+        folderModel = self.model('folder')
+        collections = {c['_id']: c for c in self.model('collection').find({
+            '_id': {'$in': list({c['collectionId'] for _, c, _ in todo})}
+        }, limit=0)}
+
+        folders = {(f['parentId'], f['name']): f for f in folderModel.find({
+            'parentCollection': 'collection',
+            'parentId': {'$in': list(collections)},
+            'name': {'$in': list({s['name'] for _, _, s in todo})}
+        }, limit=0)}
+        newFolders = []
+        for _, challenge, spec in todo:
+            folderKey = (challenge['collectionId'], spec['name'])
+            if folderKey not in folders:
+                folders[folderKey] = newFolder(
+                    collections[challenge['collectionId']], 'collection',
+                    spec['name'], creator, spec.get('public', False))
+                newFolders.append(folders[folderKey])
+
+        phaseFolders = [folders[(c['collectionId'], s['name'])]
+                        for _, c, s in todo]
+        groundTruthFolders = {f['parentId']: f for f in folderModel.find({
+            'parentCollection': 'folder',
+            'parentId': {'$in': [f['_id'] for f in phaseFolders]},
+            'name': GROUND_TRUTH_FOLDER
+        }, limit=0)}
+        for folder in phaseFolders:
+            if folder['_id'] not in groundTruthFolders:
+                groundTruthFolders[folder['_id']] = newFolder(
+                    folder, 'folder', GROUND_TRUTH_FOLDER, creator, False)
+                newFolders.append(groundTruthFolders[folder['_id']])
+
+        # Group names are unique regardless of case
+        groupNames = [self._groupName(c, s['name']).lower()
+                      for _, c, s in todo]
+        groups = {g['lowerName']: g for g in self.model('group').find({
+            'lowerName': {'$in': groupNames}
+        }, limit=0)}
+        counts = self.countMembers(g['_id'] for g in groups.values())
+        newGroups = []
+        for groupName, (_, challenge, spec) in zip(groupNames, todo):
+            if groupName not in groups:
+                groups[groupName] = newGroup(
+                    self._groupName(challenge, spec['name']), creator,
+                    spec.get('public', False))
+                newGroups.append(groups[groupName])
+                # The creator joins the groups they create
+                counts[groups[groupName]['_id']] = 1
+
+        new = {}
+        for (key, challenge, spec), folder, groupName in zip(
+                todo, phaseFolders, groupNames):
+            new[key] = self.validate(self._phaseDoc(
+                spec['name'], challenge, creator, folder,
+                groundTruthFolders[folder['_id']], groups[groupName],
+                description=spec.get('description', ''),
+                instructions=spec.get('instructions', ''),
+                active=spec.get('active', False),
+                public=spec.get('public', False),
+                metric=spec.get('metric') or DEFAULT_METRIC,
+                participantCount=counts.get(groups[groupName]['_id'], 0)))
+        insertDocuments('folder', newFolders)
+        insertDocuments('group', newGroups)
+        self.collection.insert_many([new[key] for key, _, _ in todo])
+        invalidateFolderIds()
+        for challengeId in {challengeId for challengeId, _ in new}:
+            invalidateListing(self.name, challengeId)
+        for key, _, _ in todo:
+            publish('phase', 'create', new[key])
+
+        return [(new[key], True) if key in new else (existing[key], False)
+                for key in keys]
+
+    def countMembers(self, groupIds):
+        """
+        Count the members of each of some groups with a single aggregation.
+
+        :param groupIds: The IDs of the groups.
+        :returns: The number of members keyed by group ID.
+        :rtype: dict
+        """
+        groupIds = list(groupIds)
+        counts = {groupId: 0 for groupId in groupIds}
+        if groupIds:
+            for result in self.model('user').collection.aggregate([
+                {'$match': {'groups': {'$in': groupIds}}},
+                {'$unwind': '$groups'},
+                {'$match': {'groups': {'$in': groupIds}}},
+                {'$group': {'_id': '$groups', 'count': {'$sum': 1}}}
+            ]):
+                counts[result['_id']] = result['count']
+        return counts
+
+    def backfillParticipantCounts(self):
+        """
+        Set ``participantCount`` on phases saved before it was introduced.
+        This scans the phases for those without it, so it should only run
+        once, through ``runMigration``.
+        """
+        phases = list(self.find({'participantCount': {'$exists': False}},
+                                fields=['participantGroupId'], limit=0))
+        if not phases:
+            return
+        counts = self.countMembers(
+            {p['participantGroupId'] for p in phases})
+        now = datetime.datetime.utcnow()
+        self.collection.bulk_write([UpdateOne({'_id': p['_id']}, {
+            '$set': {'participantCount': counts[p['participantGroupId']],
+                     'updated': now}
+        }) for p in phases], ordered=False)
+
+    def _incParticipantCounts(self, groupIds, delta):
+        """
+        Add to the participant counter of the phases whose participant group
+        is one of some groups, and drop the cached copies of these phases.
+        """
+        groupIds = list(groupIds)
+        if not groupIds:
+            return
+        phases = list(self.find({'participantGroupId': {'$in': groupIds}},
+                                fields=['challengeId'], limit=0))
+        if not phases:
+            return
+        self.collection.update_many(
+            {'_id': {'$in': [p['_id'] for p in phases]}},
+            {'$inc': {'participantCount': delta},
+             '$set': {'updated': datetime.datetime.utcnow()}})
+        for phase in phases:
+            invalidateDocument(self.name, phase['_id'], phase['challengeId'])
+
+    def countMembershipChanges(self, event):
+        """
+        Handler of ``model.user.save`` keeping ``participantCount`` in step
+        with memberships changed outside of this plugin, e.g. through the
+        group endpoints of Girder. It runs before the user is written, so the
+        groups stored in the database are those the user is leaving.
+        ``addParticipant`` and ``addParticipants`` update users directly and
+        count their own joins.
+        """
+        user = event.info
+        groups = set(user.get('groups', ()))
+        stored = set()
+        if '_id' in user:
+            stored = set((self.model('user').load(
+                user['_id'], force=True, fields=['groups']) or {}).get(
+                'groups', ()))
+        self._incParticipantCounts(groups - stored, 1)
+        self._incParticipantCounts(stored - groups, -1)
+
+    def countRemovedUser(self, event):
+        """
+        Handler of ``model.user.remove`` taking a deleted user out of the
+        participant counts of the phases they took part in.
+        """
+        user = self.model('user').load(
+            event.info['_id'], force=True, fields=['groups'])
+        if user is not None:
+            self._incParticipantCounts(user.get('groups', ()), -1)
+
+    def countRemovedGroup(self, event):
+        """
+        Handler of ``model.group.remove``: the phases of a deleted participant
+        group are left without participants.
+        """
+        group = event.info
+        phases = list(self.find({'participantGroupId': group['_id']},
+                                fields=['challengeId'], limit=0))
+        if not phases:
+            return
+        self.collection.update_many(
+            {'_id': {'$in': [p['_id'] for p in phases]}},
+            {'$set': {'participantCount': 0,
+                      'updated': datetime.datetime.utcnow()}})
+        for phase in phases:
+            invalidateDocument(self.name, phase['_id'], phase['challengeId'])
+
+    def rescoreChangedMetrics(self):
+        """
+        Queue the incremental re-scoring of the phases whose metric changed
+        version since the plugin was last loaded, as recorded in the
+        ``challenge.metric_versions`` setting. Only phases with scores
+        computed with another version of their metric are queued, and only
+        those scores are then recomputed. This costs one read of the setting
+        when no version changed. On the first load, the setting is seeded
+        with the current versions and nothing is rescored.
+        """
+        settingModel = self.model('setting')
+        previous = settingModel.get(PluginSettings.METRIC_VERSIONS, None)
+        current = {m.name: m.version for m in METRICS.values()}
+        if not previous:
+            settingModel.set(PluginSettings.METRIC_VERSIONS, current)
+            return
+        changed = sorted(name for name, version in current.items()
+                         if previous.get(name) != version)
+        if not changed:
+            return
+
+        submissionModel = self.model('submission', 'challenge')
+        jobModel = self.model('job', 'challenge')
+        for name in changed:
+            phaseIds = submissionModel.collection.distinct('phaseId', {
+                'scored': {'$exists': True},
+                'scoreDetail.metric': name,
+                'scoreDetail.metricVersion': {'$ne': current[name]}
+            })
+            if not phaseIds:
+                continue
+            query = {'metric': name}
+            if name == DEFAULT_METRIC:
+                query = {'$or': [query, {'metric': None}]}
+            query['_id'] = {'$in': phaseIds}
+            query['groundTruthFolderId'] = {'$ne': None}
+            for phase in self.find(query, limit=0):
+                jobModel.enqueue('rescore', phase)
+        settingModel.set(PluginSettings.METRIC_VERSIONS, current)
+
+    def addParticipant(self, phase, user):
+        """
+        Add a user to the participant group of a phase. The user must be
+        able to read the group, as with ``Group.joinGroup``: it is public or
+        the user was given access to it. Membership is added with a single
+        conditional update, so concurrent joins neither lose updates nor
+        count a user twice, and the group and phase documents are only
+        touched when the user was not already a participant.
+
+        :returns: Whether the user was added.
+        :rtype: bool
+        """
+        group = self.model('group').load(
+            phase['participantGroupId'], user=user, level=AccessType.READ,
+            exc=True)
+        result = self.model('user').collection.update_one(
+            {'_id': user['_id'], 'groups': {'$ne': group['_id']}},
+            {'$addToSet': {'groups': group['_id']},
+             '$pull': {'groupInvites': {'groupId': group['_id']}}})
+        groups = user.setdefault('groups', [])
+        if group['_id'] not in groups:
+            groups.append(group['_id'])
+        if not result.modified_count:
+            return False
+
+        self._grantMembership(phase, group, [user['_id']], 1)
+        return True
+
+    def addParticipants(self, phase, userIds, enroller, batchSize=1000):
+        """
+        Add many users to the participant group of a phase, e.g. when
+        importing an enrollment list. The enroller must have write access on
+        the group, as for adding members to it with ``Group.addUser``. Each
+        batch costs one query for the users that are not participants yet and
+        one update of their membership, however many users it holds. Unknown
+        users are ignored.
+
+        :param userIds: The IDs of the users to add.
+        :type userIds: list of ObjectId
+        :param enroller: The user adding the participants.
+        :type enroller: dict
+        :param batchSize: The maximum number of users to update at once.
+        :type batchSize: int
+        :returns: The number of users that were added.
+        :rtype: int
+        """
+        group = self.model('group').load(
+            phase['participantGroupId'], user=enroller,
+            level=AccessType.WRITE, exc=True)
+        userIds = list(set(userIds))
+        added = 0
+        for start in range(0, len(userIds), batchSize):
+            joining = [u['_id'] for u in self.model('user').find({
+                '_id': {'$in': userIds[start:start + batchSize]},
+                'groups': {'$ne': group['_id']}
+            }, fields=['_id'], limit=0)]
+            if not joining:
+                continue
+            result = self.model('user').collection.update_many(
+                {'_id': {'$in': joining}, 'groups': {'$ne': group['_id']}},
+                {'$addToSet': {'groups': group['_id']},
+                 '$pull': {'groupInvites': {'groupId': group['_id']}}})
+            if result.modified_count:
+                self._grantMembership(
+                    phase, group, joining, result.modified_count)
+                added += result.modified_count
+        return added
+
+    def _grantMembership(self, phase, group, userIds, count):
+        """
+        Record new members of a phase's participant group, as
+        ``Group.addUser`` would: add their entries to the group's access
+        list, drop their pending requests to join, and fire the save events
+        of the group and users. Then bump the participant counter of the
+        phase.
+        """
+        self.model('group').collection.bulk_write([UpdateOne(
+            {'_id': group['_id'], 'access.users.id': {'$ne': userId}},
+            {'$push': {'access.users': {
+                'id': userId, 'level': AccessType.READ}},
+             '$pull': {'requests': userId}}
+        ) for userId in userIds], ordered=False)
+        self.collection.update_one({'_id': phase['_id']}, {
+            '$inc': {'participantCount': count},
+            '$set': {'updated': datetime.datetime.utcnow()}})
+        invalidateDocument(self.name, phase['_id'], phase['challengeId'])
+
+        events.trigger('model.group.save.after', self.model('group').load(
+            group['_id'], force=True))
+        for user in self.model('user').find(
+                {'_id': {'$in': userIds}}, limit=0):
+            events.trigger('model.user.save.after', user)
+
+    def loadGroundTruth(self, phase, files=None):
+        """
+        Get the files in the ground truth folder of a phase, decoded when
+        they are looked up. Decoded files are served from the ground truth
+        cache when possible.
+
+        :param phase: The phase whose ground truth to load.
+        :type phase: dict
+        :param files: The ground truth file documents to load; defaults to
+        every file in the folder.
+        :type files: list of dict or None
+        :returns: The decoded ground truth files keyed by file name.
+        :rtype: groundtruth.GroundTruth
+        """
+        def load(file):
+            return decode(file['name'], readFile(file))
+
+        if files is None:
+            files = folderFiles(phase['groundTruthFolderId'])
+        return GroundTruth(files, getCache(), load)
 
     def updatePhase(self, phase):
         """
@@ -0,0 +1,514 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import datetime
+import itertools
+import six
+import sys
+
+from girder.models.model_base import Model, ValidationException
+from girder.utility.progress import noProgress
+from pymongo import UpdateOne
+
+from ..groundtruth import fileChecksum, groundTruthHash
+from ..instrumentation import CountedModel
+from ..metrics import DEFAULT_METRIC, METRICS
+from ..scoring import (EncodedFile, FileInspector, ScoringEngine, aggregate,
+                       isNpy)
+from ..utility import folderFiles, localPath, readFile, readNpyHeader
+
+
+class Submission(CountedModel, Model):
+    def initialize(self):
+        self.name = 'challenge_submission'
+        self.ensureIndices((
+            'challengeId',
+            ([('phaseId', 1), ('creatorId', 1), ('created', -1)], {}),
+            ([('phaseId', 1), ('created', -1)], {}),
+            ([('phaseId', 1), ('scoreDetail.groundTruthHash', 1)], {})
+        ))
+
+        self.exposed = (
+            '_id', 'phaseId', 'challengeId', 'creatorId', 'created', 'title',
+            'folderId', 'meta', 'score', 'scoreDetail', 'scored')
+
+    def filter(self, submission):
+        """
+        Filter a submission document down to the fields exposed through the
+        REST API.
+        """
+        return {k: submission[k] for k in self.exposed if k in submission}
+
+    def list(self, phase, creator=None, limit=50, offset=0, sort=None):
+        """
+        List submissions to a phase, optionally only those of one creator.
+        """
+        query = {'phaseId': phase['_id']}
+        if creator is not None:
+            query['creatorId'] = creator['_id']
+        return self.find(query, limit=limit, offset=offset, sort=sort)
+
+    def export(self, phase, fields):
+        """
+        Iterate over every submission to a phase, oldest first, reading only
+        the given fields. Documents are fetched from the server in batches as
+        the cursor is consumed, so memory use does not depend on the number
+        of submissions.
+        """
+        return self.find(
+            {'phaseId': phase['_id']}, fields=list(fields), limit=0,
+            sort=[('created', 1)]).batch_size(1000)
+
+    def validate(self, doc):
+        if not isinstance(doc.get('title') or '', six.string_types):
+            raise ValidationException(
+                'Submission title must be a string.', 'title')
+        doc['title'] = (doc.get('title') or '').strip()
+
+        if not doc.get('phaseId') or not doc.get('challengeId'):
+            raise ValidationException(
+                'A submission must belong to a phase.', 'phaseId')
+        if not doc.get('creatorId'):
+            raise ValidationException(
+                'A submission must have a creator.', 'creatorId')
+        if not isinstance(doc.get('meta', {}), dict):
+            raise ValidationException(
+                'Submission metadata must be an object.', 'meta')
+        self._validateKeys(doc.get('meta', {}))
+
+        return doc
+
+    def _validateKeys(self, value):
+        """
+        Reject metadata keys that MongoDB cannot store, as Girder does when
+        setting the metadata of an item. Nested objects are checked too.
+        """
+        if isinstance(value, dict):
+            for key, item in six.viewitems(value):
+                if '.' in key or key.startswith('$'):
+                    raise ValidationException(
+                        'The key name %s must not contain a period or begin '
+                        'with a dollar sign.' % key, 'meta')
+                self._validateKeys(item)
+        elif isinstance(value, list):
+            for item in value:
+                self._validateKeys(item)
+
+    def _buildSubmission(self, phase, creator, title='', folderId=None,
+                         meta=None, created=None):
+        return {
+            'phaseId': phase['_id'],
+            'challengeId': phase['challengeId'],
+            'creatorId': creator['_id'],
+            'title': title,
+            'folderId': folderId,
+            'meta': meta or {},
+            'score': None,
+            'created': created or datetime.datetime.utcnow()
+        }
+
+    def createSubmission(self, phase, creator, title='', folderId=None,
+                         meta=None):
+        """
+        Create a single submission to a phase and queue the phase for
+        scoring, once for the submissions made to it within
+        ``job_enqueue_delay`` seconds. This costs a single write, plus a
+        query when the submission has a folder.
+
+        :param phase: The phase being submitted to.
+        :type phase: dict
+        :param creator: The user making the submission.
+        :type creator: dict
+        :param title: A title for this submission.
+        :type title: str
+        :param folderId: The ID of the folder holding the submitted data.
+        :type folderId: ObjectId or None
+        :param meta: Arbitrary metadata about the submission.
+        :type meta: dict or None
+        """
+        submission = self.save(self._buildSubmission(
+            phase, creator, title=title, folderId=folderId, meta=meta))
+        self.model('job', 'challenge').enqueueSoon('score', phase)
+        return submission
+
+    def createFolder(self, phase, creator):
+        """
+        Create a private folder for a submission under the folder of a phase.
+        Only the creator and whoever administers the phase folder can read
+        it.
+        """
+        parent = self.model('folder').load(phase['folderId'], force=True)
+        return self.model('folder').createFolder(
+            parent, '%s %s' % (creator['login'], datetime.datetime.utcnow()
+                               .strftime('%Y-%m-%d %H%M%S')),
+            parentType='folder', public=False, creator=creator,
+            allowRename=True)
+
+    def storeFile(self, phase, creator, folder, name, size, chunks):
+        """
+        Stream a submitted file into a folder. Each chunk is inspected before
+        it is handed to the assetstore, so that a file with an invalid
+        ``.npy`` header, or whose shape differs from the ground truth file of
+        the same name, is rejected as soon as its header arrives. The
+        checksum gathered on the way is returned, and the header is recorded
+        on the file document, so that the file never has to be read again to
+        get them. If anything fails, the partial upload and its item are
+        removed.
+
+        :param phase: The phase being submitted to.
+        :type phase: dict
+        :param creator: The user uploading the file.
+        :type creator: dict
+        :param folder: The submission folder to store the file in.
+        :type folder: dict
+        :param name: The name of the file.
+        :type name: str
+        :param size: The size of the file in bytes.
+        :type size: int
+        :param chunks: The contents of the file.
+        :type chunks: iterable of bytes
+        :returns: The entry describing the file in the submission's
+        ``meta.files``.
+        :rtype: dict
+        """
+        shape = None
+        if isNpy(name):
+            for file in folderFiles(phase['groundTruthFolderId']):
+                if file['name'] == name:
+                    try:
+                        shape = readNpyHeader(file)['shape']
+                    except ValueError:
+                        # Let scoring report the broken ground truth
+                        pass
+                    break
+
+        inspector = FileInspector(name, size, shape=shape)
+        item = self.model('item').createItem(name, creator, folder)
+        upload = self.model('upload').createUpload(
+            creator, name, parentType='item', parent=item, size=size)
+        checksum = None
+        stored = False
+        try:
+            for chunk in chunks:
+                inspector.update(chunk)
+                if inspector.received == size:
+                    checksum = inspector.finish()
+                upload = self.model('upload').handleChunk(
+                    upload, six.BytesIO(chunk))
+                # The upload turns into a file with its last chunk
+                stored = inspector.received == size
+            if checksum is None:
+                inspector.finish()
+
+            file = upload
+            # The header is kept on the file document rather than in the
+            # submission's metadata, which clients can set to anything
+            update = {'npyHeader': inspector.header}
+            if not file.get('sha512'):
+                update['sha512'] = checksum
+            self.model('file').collection.update_one(
+                {'_id': file['_id']}, {'$set': update})
+        except Exception as e:
+            # Whatever failed, leave no partial upload or item behind
+            exc = sys.exc_info()
+            if not stored:
+                self.model('upload').cancelUpload(upload)
+            self.model('item').remove(item)
+            if isinstance(e, ValueError):
+                raise ValidationException(str(e), 'file')
+            six.reraise(*exc)
+
+        return {
+            'name': name,
+            'fileId': file['_id'],
+            'size': size,
+            'sha512': checksum
+        }
+
+    def addFile(self, phase, submission, entry):
+        """
+        Record a file stored with ``storeFile`` in a submission, and queue
+        the submission for scoring again. Its previous score is cleared so
+        that the scoring job, which only picks unscored submissions, scores
+        it with the new file.
+        """
+        self.collection.update_one({'_id': submission['_id']}, {
+            '$push': {'meta.files': entry},
+            '$set': {'score': None},
+            '$unset': {'scored': '', 'scoreDetail': ''}})
+        submission.setdefault('meta', {}).setdefault('files', []).append(entry)
+        hadScore = submission.get('score') is not None
+        submission['score'] = None
+        submission.pop('scored', None)
+        submission.pop('scoreDetail', None)
+        if hadScore:
+            # The new score may be worse, which incremental updates of the
+            # leaderboard do not account for.
+            self.model('leaderboard', 'challenge').refreshUsers(
+                phase, [submission['creatorId']])
+        self.model('job', 'challenge').enqueueSoon('score', phase)
+        return submission
+
+    def createSubmissions(self, phase, creator, submissions):
+        """
+        Create many submissions to a phase at once. Every submission is
+        validated first, then all of them are written with a single unordered
+        ``insert_many`` so that a burst of uploads costs one round trip. The
+        phase is queued for scoring once.
+
+        :param phase: The phase being submitted to.
+        :type phase: dict
+        :param creator: The user making the submissions.
+        :type creator: dict
+        :param submissions: The submissions to create, as dicts with optional
+        ``title``, ``folderId`` and ``meta`` keys.
+        :type submissions: list of dict
+        :returns: The created submission documents.
+        """
+        now = datetime.datetime.utcnow()
+        docs = [self.validate(self._buildSubmission(
+            phase, creator, title=s.get('title', ''),
+            folderId=s.get('folderId'), meta=s.get('meta'), created=now))
+            for s in submissions]
+
+        if docs:
+            self.collection.insert_many(docs, ordered=False)
+            self.model('job', 'challenge').enqueue('score', phase)
+        return docs
+
+    def remove(self, submission, **kwargs):
+        Model.remove(self, submission, **kwargs)
+
+        if submission.get('score') is not None:
+            phase = self.model('phase', 'challenge').load(
+                submission['phaseId'], force=True)
+            self.model('leaderboard', 'challenge').refreshUsers(
+                phase, [submission['creatorId']])
+
+    def removeForPhase(self, phase, progress=noProgress):
+        """
+        Remove all submissions to a phase.
+        """
+        result = self.collection.delete_many({'phaseId': phase['_id']})
+        progress.update(increment=result.deleted_count,
+                        message='Deleted submissions of ' + phase['name'])
+
+    def removeForChallenge(self, challenge, progress=noProgress):
+        """
+        Remove all submissions to any phase of a challenge.
+        """
+        result = self.collection.delete_many({
+            'challengeId': challenge['_id']
+        })
+        progress.update(increment=result.deleted_count,
+                        message='Deleted submissions of ' + challenge['name'])
+
+    def score(self, phase, submissions, metric, processes=None, stale=None):
+        """
+        Score submissions to a phase against its ground truth. The ground
+        truth is loaded once, each submitted file whose name matches a ground
+        truth file is scored on a pool of processes, and all results are
+        written back with a single bulk write. The checksum of each ground
+        truth file and the metric version are recorded in the score details,
+        along with a fingerprint of both, so that ``rescoreStale`` can tell
+        which results are out of date.
+
+        :param phase: The phase whose ground truth to score against.
+        :type phase: dict
+        :param submissions: The submissions to score, with at least their
+        ``_id``, ``creatorId``, ``folderId`` and ``meta``, and their
+        ``scoreDetail`` if stale is set.
+        :type submissions: iterable of dict
+        :param metric: The metric to score with.
+        :type metric: metrics.Metric
+        :param processes: The number of worker processes, or None for one per
+        core.
+        :type processes: int or None
+        :param stale: If set, only the ground truth files named in this dict,
+        keyed by submission ID, are scored again; the other results of each
+        submission are kept from its score details.
+        :type stale: dict or None
+        :returns: The results keyed by submission ID, as returned by
+        ``scoring.aggregate``.
+        """
+        submissions = list(submissions)
+        files = folderFiles(phase['groundTruthFolderId'])
+        checksums = {f['name']: fileChecksum(f) for f in files}
+        if stale is not None:
+            needed = set().union(*stale.values()) if stale else set()
+            files = [f for f in files if f['name'] in needed]
+        groundTruth = self.model('phase', 'challenge').loadGroundTruth(
+            phase, files)
+
+        assetstores = {}
+
+        def tasks():
+            # Files are decoded where they are scored, so that a file that
+            # cannot be decoded only fails its own result. Workers read the
+            # files of filesystem assetstores themselves; others are read
+            # here as the engine asks for more tasks.
+            for submission in submissions:
+                if not submission.get('folderId'):
+                    continue
+                names = groundTruth if stale is None else \
+                    stale[submission['_id']]
+                for file in folderFiles(submission['folderId']):
+                    if file['name'] not in names:
+                        continue
+                    path = localPath(file, assetstores)
+                    # Headers recorded at upload spare parsing them again
+                    yield (submission['_id'], file['name'], EncodedFile(
+                        path, None if path else readFile(file),
+                        file.get('npyHeader')))
+
+        def kept():
+            # Results of current ground truth files that need no rescoring
+            for submission in submissions:
+                detail = submission.get('scoreDetail') or {}
+                errors = {e['name']: e['error']
+                          for e in detail.get('errors', ())}
+                for f in detail.get('files', ()):
+                    if (f['name'] in checksums and
+                            f['name'] not in stale[submission['_id']]):
+                        yield (submission['_id'], f['name'], f['value'],
+                               errors.get(f['name']))
+
+        engine = ScoringEngine(metric.func, processes=processes)
+        results = engine.score(groundTruth, tasks(), link=groundTruth.link)
+        if stale is not None:
+            results = itertools.chain(results, kept())
+        results = aggregate(results, checksums,
+                            keys=[s['_id'] for s in submissions])
+
+        now = datetime.datetime.utcnow()
+        groundTruthSums = [{'name': name, 'checksum': checksum}
+                           for name, checksum in sorted(checksums.items())]
+        ops = [UpdateOne({'_id': id}, {'$set': {
+            'score': result['score'],
+            'scoreDetail': {
+                'files': result['files'],
+                'errors': result['errors'],
+                'metric': metric.name,
+                'metricVersion': metric.version,
+                'groundTruth': groundTruthSums,
+                'groundTruthHash': groundTruthHash(checksums, metric)
+            },
+            'scored': now
+        }}) for id, result in six.iteritems(results)]
+        if ops:
+            self.collection.bulk_write(ops, ordered=False)
+
+        self.model('leaderboard', 'challenge').updateScores(phase, [{
+            '_id': s['_id'],
+            'creatorId': s['creatorId'],
+            'score': results[s['_id']]['score']
+        } for s in submissions])
+
+        return results
+
+    def rescoreStale(self, phase, processes=None, progress=noProgress):
+        """
+        Score again the (submission, ground truth file) pairs of a phase whose
+        result is out of date because the ground truth file was added,
+        changed or removed, or because the phase's metric or its version
+        changed since. Submissions scored against other ground truth or
+        another metric are selected by their ground truth fingerprint, with
+        a query served by an index, and only their out of date pairs are
+        computed, so the work is proportional to what changed.
+
+        :param phase: The phase to rescore.
+        :type phase: dict
+        :param processes: The number of worker processes, or None for one per
+        core.
+        :type processes: int or None
+        :param progress: Progress context updated once scoring is done.
+        :returns: The results keyed by submission ID.
+        """
+        metric = METRICS[phase.get('metric') or DEFAULT_METRIC]
+        checksums = {f['name']: fileChecksum(f) for f in
+                     folderFiles(phase['groundTruthFolderId'])}
+
+        # Results scored before fingerprints were recorded are selected too,
+        # and get one when written back.
+        submissions = list(self.find({
+            'phaseId': phase['_id'],
+            'scoreDetail.groundTruthHash': {
+                '$ne': groundTruthHash(checksums, metric)},
+            'scored': {'$exists': True}
+        }, fields=['_id', 'creatorId', 'folderId', 'meta', 'scoreDetail'],
+            limit=0))
+
+        stale = {}
+        for submission in submissions:
+            detail = submission.get('scoreDetail') or {}
+            if (detail.get('metric') != metric.name or
+                    detail.get('metricVersion') != metric.version):
+                stale[submission['_id']] = set(checksums)
+            else:
+                previous = {g['name']: g['checksum']
+                            for g in detail.get('groundTruth', ())}
+                stale[submission['_id']] = {
+                    name for name, checksum in six.iteritems(checksums)
+                    if previous.get(name) != checksum}
+
+        progress.update(total=len(submissions), message='Rescoring %d '
+                        'submissions' % len(submissions))
+        results = self.score(phase, submissions, metric, processes=processes,
+                             stale=stale)
+        # Scores may have gotten worse, which incremental updates of the
+        # leaderboard do not account for.
+        self.model('leaderboard', 'challenge').refreshUsers(
+            phase, {s['creatorId'] for s in submissions})
+        progress.update(current=len(results), message='Rescored %d '
+                        'submissions' % len(results))
+        return results
+
+    def scorePhase(self, phase, rescore=False, processes=None,
+                   progress=noProgress):
+        """
+        Score the submissions to a phase with the phase's metric.
+
+        :param phase: The phase to score.
+        :type phase: dict
+        :param rescore: Whether to also score submissions that were already
+        scored, including those whose scoring failed.
+        :type rescore: bool
+        :param processes: The number of worker processes, or None for one per
+        core.
+        :type processes: int or None
+        :param progress: Progress context updated once scoring is done.
+        """
+        query = {'phaseId': phase['_id']}
+        if not rescore:
+            query['scored'] = {'$exists': False}
+        submissions = list(self.find(
+            query, fields=['_id', 'creatorId', 'folderId', 'meta'], limit=0))
+
+        progress.update(total=len(submissions), message='Scoring %d '
+                        'submissions' % len(submissions))
+        metric = METRICS[phase.get('metric') or DEFAULT_METRIC]
+        results = self.score(phase, submissions, metric,
+                             processes=processes)
+        if rescore:
+            # Best scores may have gotten worse, which incremental updates
+            # of the leaderboard do not account for.
+            self.model('leaderboard', 'challenge').rebuild(phase)
+        progress.update(current=len(results), message='Scored %d '
+                        'submissions' % len(results))
+        return results
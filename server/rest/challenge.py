@@ -17,13 +17,27 @@
 #  limitations under the License.
 ###############################################################################
 
+import cherrypy
 import json
+import six
 
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
 from girder.api import access
 from girder.api.describe import Description
 from girder.api.rest import Resource, loadmodel, RestException
 from girder.constants import AccessType
-from girder.utility.progress import ProgressContext
+from girder.utility.config import getConfig
+
+from ..cache import (computeEtag, conditionalResponse, filteredDocument,
+                     filteredResponse, loadDocument)
+from ..feed import eventStream, getFeed
+from ..instrumentation import render, timed
+from ..metrics import DEFAULT_METRIC, METRICS
+from ..utility import (backgroundTask, decodeCursor, encodeCursor,
+                       listFields, requireReady)
+
+MAX_BULK_SIZE = 1000
 
 
 class Challenge(Resource):
@@ -31,22 +45,39 @@ class Challenge(Resource):
         self.resourceName = 'challenge'
 
         self.route('GET', (), self.listChallenges)
+        self.route('GET', ('count',), self.countChallenges)
+        self.route('GET', ('feed',), self.getFeed)
+        self.route('GET', ('metrics',), self.getMetrics)
         self.route('GET', (':id',), self.getChallenge)
         self.route('GET', (':id', 'access'), self.getAccess)
         self.route('POST', (), self.createChallenge)
+        self.route('POST', ('bulk',), self.createChallenges)
         self.route('PUT', (':id',), self.updateChallenge)
         self.route('PUT', (':id', 'access'), self.updateAccess)
         self.route('DELETE', (':id',), self.deleteChallenge)
 
+    @timed('route', 'challenge.listChallenges')
     @access.public
     def listChallenges(self, params):
         limit, offset, sort = self.getPagingParameters(params, 'name')
 
+        after = None
+        if params.get('after'):
+            try:
+                after = decodeCursor(params['after'])
+            except ValueError:
+                raise RestException('Invalid "after" cursor.')
+
+        model = self.model('challenge', 'challenge')
+        fields = listFields(params, model.summaryFields)
         user = self.getCurrentUser()
-        results = self.model('challenge', 'challenge').list(
-            user=user, offset=offset, limit=limit, sort=sort)
-        return [self.model('challenge', 'challenge').filter(c, user)
-                for c in results]
+        results = model.list(
+            user=user, offset=offset, limit=limit, sort=sort, after=after,
+            fields=fields)
+        if limit and len(results) == limit:
+            cherrypy.response.headers['Girder-Next-After'] = encodeCursor(
+                results[-1], sort)
+        return [model.filter(c, user) for c in results]
     listChallenges.description = (
         Description('List challenges.')
         .param('limit', "Result set size limit (default=50).", required=False,
@@ -56,18 +87,104 @@ class Challenge(Resource):
         .param('sort', "Field to sort the result list by (default=name)",
                required=False)
         .param('sortdir', "1 for ascending, -1 for descending (default=1)",
-               required=False, dataType='int'))
+               required=False, dataType='int')
+        .param('after', 'Opaque cursor returned in the Girder-Next-After '
+               'response header of the previous page. When passed, the '
+               'listing resumes after the last challenge of that page and '
+               'offset is ignored.', required=False)
+        .param('fields', 'A comma-separated list of the fields to return. '
+               'Only these fields are read from the database, along with the '
+               'ID and those needed to check access and to sort.',
+               required=False)
+        .param('view', 'Pass "summary" to return every field but the long '
+               'description and instructions (default=full).',
+               required=False))
+
+    @timed('route', 'challenge.countChallenges')
+    @access.public
+    def countChallenges(self, params):
+        return {
+            'nChallenges': self.model('challenge', 'challenge').count(
+                user=self.getCurrentUser())
+        }
+    countChallenges.description = (
+        Description('Get the total number of challenges visible to the '
+                    'current user.'))
+
+    @access.public
+    def getFeed(self, params):
+        challengeId = None
+        if params.get('challengeId'):
+            try:
+                challengeId = ObjectId(params['challengeId'])
+            except (InvalidId, TypeError):
+                raise RestException('Invalid challengeId.')
+        user = self.getCurrentUser()
+        if user is not None:
+            client = 'user:%s' % user['_id']
+        else:
+            client = 'ip:%s' % cherrypy.request.remote.ip
+        if not getFeed().canSubscribe(client):
+            raise RestException('Too many open change feeds; try again '
+                                'later.', code=503)
 
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        cherrypy.response.headers['X-Accel-Buffering'] = 'no'
+        cherrypy.response.stream = True
+        heartbeat = float(getConfig().get('challenge', {}).get(
+            'feed_heartbeat', 15))
+
+        def stream():
+            for event in eventStream(client, user, challengeId,
+                                     heartbeat=heartbeat):
+                yield event
+        return stream
+    getFeed.description = (
+        Description('Stream the changes to the challenges and phases visible '
+                    'to the current user as server-sent events, so that '
+                    'clients need not poll. Events of type "challenge" and '
+                    '"phase" carry the action ("create", "update" or '
+                    '"remove") and the document; "leaderboard" events carry '
+                    'the IDs of a phase whose leaderboard changed. An '
+                    '"overflow" event ends a stream that fell too far behind; '
+                    'clients should then reload and reconnect. Each stream '
+                    'holds a server thread, so their number is limited '
+                    'overall and per user or address; a "busy" event ends a '
+                    'stream opened past the limit. Only the changes made by '
+                    'the server process holding the connection are sent.')
+        .param('challengeId', 'Only stream the changes to this challenge and '
+               'its phases.', required=False)
+        .errorResponse('Too many open change feeds.', 503))
+
+    @access.admin
+    def getMetrics(self, params):
+        cherrypy.response.headers['Content-Type'] = \
+            'text/plain; version=0.0.4; charset=utf-8'
+
+        def stream():
+            yield render().encode('utf8')
+        return stream
+    getMetrics.description = (
+        Description('Get the latency histograms and MongoDB command counts of '
+                    'the challenge REST handlers and model methods of this '
+                    'server process, in the Prometheus text format. They are '
+                    'only recorded when "instrumentation" is enabled in the '
+                    '[challenge] configuration section.'))
+
+    @timed('route', 'challenge.createChallenge')
     @access.admin
     def createChallenge(self, params):
         self.requireParams('name', params)
         public = self.boolParam('public', params, default=False)
         description = params.get('description', '').strip()
         instructions = params.get('instructions', '').strip()
+        defer = self.boolParam('defer', params, default=False)
 
         challenge = self.model('challenge', 'challenge').createChallenge(
             name=params['name'].strip(), description=description, public=public,
-            instructions=instructions, creator=self.getCurrentUser())
+            instructions=instructions, creator=self.getCurrentUser(),
+            defer=defer)
 
         return challenge
     createChallenge.description = (
@@ -77,18 +194,119 @@ class Challenge(Resource):
         .param('instructions', 'Instructional text for this challenge.',
                required=False)
         .param('public', 'Whether the challenge should be publicly visible.',
+               dataType='boolean')
+        .param('defer', 'Return as soon as the challenge is saved, in the '
+               '"provisioning" state, and create its collection in the '
+               'background (default=false).', required=False,
                dataType='boolean'))
 
+    def _parseSpecs(self, value):
+        try:
+            specs = json.loads(value)
+        except ValueError:
+            raise RestException('The challenges parameter must be JSON.')
+
+        def valid(spec):
+            return isinstance(spec, dict) and isinstance(
+                spec.get('name'), six.string_types) and spec['name'].strip()
+
+        if not isinstance(specs, list) or not all(valid(s) for s in specs):
+            raise RestException('The challenges parameter must be a list of '
+                                'objects with a non-empty name.')
+
+        def requireBool(spec, key):
+            if not isinstance(spec.get(key, False), bool):
+                raise RestException('The "%s" key of "%s" must be a boolean.'
+                                    % (key, spec['name']))
+
+        def requireString(spec, key):
+            if not isinstance(spec.get(key, ''), six.string_types):
+                raise RestException('The "%s" key of "%s" must be a string.'
+                                    % (key, spec['name']))
+
+        nPhases = 0
+        for spec in specs:
+            requireBool(spec, 'public')
+            requireString(spec, 'description')
+            requireString(spec, 'instructions')
+            phases = spec.setdefault('phases', [])
+            if not isinstance(phases, list) or not all(
+                    valid(p) for p in phases):
+                raise RestException('The phases of a challenge must be a list '
+                                    'of objects with a non-empty name.')
+            for phase in phases:
+                requireBool(phase, 'public')
+                requireBool(phase, 'active')
+                requireString(phase, 'description')
+                requireString(phase, 'instructions')
+                if (phase.get('metric') or DEFAULT_METRIC) not in METRICS:
+                    raise RestException('Unknown metric "%s".' % phase[
+                        'metric'])
+            nPhases += len(phases)
+        if len(specs) + nPhases > MAX_BULK_SIZE:
+            raise RestException('At most %d challenges and phases may be '
+                                'created at once.' % MAX_BULK_SIZE)
+        return specs
+
+    @timed('route', 'challenge.createChallenges')
+    @access.admin
+    def createChallenges(self, params):
+        self.requireParams('challenges', params)
+        specs = self._parseSpecs(params['challenges'])
+        user = self.getCurrentUser()
+
+        challenges = self.model('challenge', 'challenge').createChallenges(
+            specs, creator=user)
+        phases = iter(self.model('phase', 'challenge').createPhases(
+            [(challenge, phase) for (challenge, _), spec in zip(
+                challenges, specs) for phase in spec['phases']],
+            creator=user))
+
+        results = []
+        for (challenge, created), spec in zip(challenges, specs):
+            result = self.model('challenge', 'challenge').filter(
+                challenge, user)
+            result['wasCreated'] = created
+            result['phases'] = []
+            for _ in spec['phases']:
+                phase, phaseCreated = next(phases)
+                result['phases'].append(dict(
+                    self.model('phase', 'challenge').filter(phase, user),
+                    wasCreated=phaseCreated))
+            results.append(result)
+        return results
+    createChallenges.description = (
+        Description('Create many challenges and their phases in a single '
+                    'request. Challenges and phases whose name is already '
+                    'taken are returned as they are instead of being created '
+                    'again, so provisioning the same specification twice in '
+                    'a row is harmless. Concurrent requests with the same '
+                    'phases may still create them twice, as phase names are '
+                    'not unique. Each returned challenge and phase has a '
+                    '"wasCreated" flag telling whether this request created '
+                    'it.')
+        .param('challenges', 'A JSON list of challenges, each an object with '
+               'a "name" and optional "description", "instructions", '
+               '"public" and "phases" keys. "phases" is a list of objects '
+               'with a "name" and optional "description", "instructions", '
+               '"active", "public" and "metric" keys. "public" and "active" '
+               'are booleans and default to false, as when creating a single '
+               'challenge or phase. At most %d challenges and phases may be '
+               'sent at once.' % MAX_BULK_SIZE)
+        .errorResponse('The specification was invalid.'))
+
+    @timed('route', 'challenge.updateChallenge')
     @access.user
     @loadmodel(model='challenge', plugin='challenge', level=AccessType.WRITE)
     def updateChallenge(self, challenge, params):
+        requireReady(challenge, 'challenge')
         challenge['name'] = params.get('name', challenge['name']).strip()
         challenge['description'] = params.get(
             'description', challenge.get('description', '')).strip()
         challenge['instructions'] = params.get(
             'instructions', challenge.get('instructions', '')).strip()
 
-        self.model('challenge', 'challenge').save(challenge)
+        self.model('challenge', 'challenge').updateChallenge(challenge)
         return challenge
     updateChallenge.description = (
         Description('Update the properties of a challenge.')
@@ -100,10 +318,12 @@ class Challenge(Resource):
         .errorResponse('ID was invalid.')
         .errorResponse('Write permission denied on the challenge.', 403))
 
+    @timed('route', 'challenge.updateAccess')
     @access.user
     @loadmodel(model='challenge', plugin='challenge', level=AccessType.ADMIN)
     def updateAccess(self, challenge, params):
         self.requireParams('access', params)
+        requireReady(challenge, 'challenge')
 
         public = self.boolParam('public', params, default=False)
         self.model('challenge', 'challenge').setPublic(challenge, public)
@@ -123,18 +343,46 @@ class Challenge(Resource):
         .errorResponse('ID was invalid.')
         .errorResponse('Admin permission denied on the challenge.', 403))
 
+    @timed('route', 'challenge.getChallenge')
     @access.public
-    @loadmodel(model='challenge', plugin='challenge', level=AccessType.READ)
-    def getChallenge(self, challenge, params):
-        return self.model('challenge', 'challenge').filter(
-            challenge, self.getCurrentUser())
+    def getChallenge(self, id, params):
+        user = self.getCurrentUser()
+        model = self.model('challenge', 'challenge')
+        challenge = loadDocument(model, id, user, level=AccessType.READ)
+
+        include = set(filter(None, params.get('include', '').split(',')))
+        if not include <= {'phases'}:
+            raise RestException('Invalid include parameter; the only valid '
+                                'value is "phases".')
+        if not include:
+            return filteredResponse(model, challenge, user)
+
+        filtered, etag = filteredDocument(model, challenge, user)
+        filtered = dict(filtered)
+        phases = self.model('phase', 'challenge').list(
+            challenge, user=user, limit=0, sort=[('name', 1)])
+        filtered['phases'] = [
+            self.model('phase', 'challenge').filter(p, user) for p in phases]
+        # The newest change to the challenge or any of its phases
+        modified = [doc.get('updated') or doc.get('created')
+                    for doc in [challenge] + phases]
+        conditionalResponse(computeEtag([etag, filtered['phases']], phases),
+                            max([m for m in modified if m] or [None]))
+        return filtered
     getChallenge.description = (
-        Description('Get a challenge by ID.')
+        Description('Get a challenge by ID. The response carries ETag and '
+                    'Last-Modified headers, and conditional requests are '
+                    'answered with 304 Not Modified.')
         .responseClass('Challenge')
         .param('id', 'The ID of the challenge.', paramType='path')
+        .param('include', 'Pass "phases" to also return the phases of the '
+               'challenge visible to the current user, in a "phases" field. '
+               'The ETag and Last-Modified headers then cover them too.',
+               required=False)
         .errorResponse('ID was invalid.')
         .errorResponse('Read permission denied on the challenge.', 403))
 
+    @timed('route', 'challenge.getAccess')
     @access.user
     @loadmodel(model='challenge', plugin='challenge', level=AccessType.ADMIN)
     def getAccess(self, challenge, params):
@@ -145,23 +393,28 @@ class Challenge(Resource):
         .errorResponse('ID was invalid.')
         .errorResponse('Admin access was denied for the challenge.', 403))
 
+    @timed('route', 'challenge.deleteChallenge')
     @access.user
     @loadmodel(model='challenge', plugin='challenge', level=AccessType.ADMIN)
     def deleteChallenge(self, challenge, params):
-        progress = self.boolParam('progress', params, default=False)
-        with ProgressContext(progress, user=self.getCurrentUser(),
-                             title=u'Deleting challenge ' + challenge['name'],
-                             message='Calculating total size...') as ctx:
-            if progress:
-                ctx.update(
-                    total=self.model('challenge', 'challenge').subtreeCount(
-                        challenge))
-            self.model('challenge', 'challenge').remove(challenge, progress=ctx)
-        return {'message': 'Deleted challenge %s.' % challenge['name']}
+        model = self.model('challenge', 'challenge')
+
+        def delete(ctx):
+            ctx.update(total=model.subtreeCount(challenge))
+            model.remove(challenge, progress=ctx)
+
+        job = backgroundTask(
+            delete, user=self.getCurrentUser(),
+            title=u'Deleting challenge ' + challenge['name'],
+            message='Calculating total size...')
+        return {
+            'message': 'Deleting challenge %s.' % challenge['name'],
+            'jobId': job['_id']
+        }
     deleteChallenge.description = (
-        Description('Delete a challenge.')
+        Description('Delete a challenge. The deletion runs in the background; '
+                    'the returned jobId is the ID of the progress notification '
+                    'tracking it.')
         .param('id', 'The ID of the challenge to delete.', paramType='path')
-        .param('progress', 'Whether to record progress on this task. Default '
-               'is false.', required=False, dataType='boolean')
         .errorResponse('ID was invalid.')
         .errorResponse('Admin access was denied for the challenge.', 403))
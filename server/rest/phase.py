@@ -17,13 +17,35 @@
 #  limitations under the License.
 ###############################################################################
 
+import cherrypy
+import csv
+import dateutil.parser
+import dateutil.tz
 import json
+import six
 
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
 from girder.api import access
 from girder.api.describe import Description
 from girder.api.rest import Resource, loadmodel, RestException
 from girder.constants import AccessType
-from girder.utility.progress import ProgressContext
+
+from ..cache import (computeEtag, conditionalResponse, filteredResponse,
+                     getResponseCache, listingAclKey, listTag, loadDocument)
+from ..groundtruth import getCache
+from ..instrumentation import timed
+from ..metrics import DEFAULT_METRIC, METRICS
+from ..utility import (backgroundTask, csvChunks, decodeCursor, encodeCursor,
+                       gzipChunks, listFields, ndjsonChunks, requireReady)
+
+MAX_IDS = 1000
+EXPORT_FIELDS = ('_id', 'creatorId', 'title', 'created', 'folderId',
+                 'score', 'scored')
+EXPORT_FORMATS = {
+    'csv': ('text/csv', csvChunks),
+    'ndjson': ('application/x-ndjson', ndjsonChunks)
+}
 
 
 class Phase(Resource):
@@ -31,28 +53,78 @@ class Phase(Resource):
         self.resourceName = 'challenge_phase'
 
         self.route('GET', (), self.listPhases)
+        self.route('GET', ('count',), self.countPhases)
+        self.route('GET', ('ground_truth_cache',), self.getGroundTruthCache)
         self.route('GET', (':id',), self.getPhase)
         self.route('GET', (':id', 'access'), self.getAccess)
+        self.route('GET', (':id', 'export'), self.exportPhase)
+        self.route('GET', (':id', 'job'), self.listJobs)
+        self.route('GET', (':id', 'leaderboard'), self.getLeaderboard)
+        self.route('GET', (':id', 'leaderboard', 'rank'), self.getRank)
         self.route('POST', (), self.createPhase)
         self.route('POST', (':id', 'participant'), self.joinPhase)
+        self.route('POST', (':id', 'participants'), self.enrollParticipants)
+        self.route('POST', (':id', 'score'), self.scorePhase)
         self.route('PUT', (':id',), self.updatePhase)
         self.route('PUT', (':id', 'access'), self.updateAccess)
         self.route('DELETE', (':id',), self.deletePhase)
 
+    @timed('route', 'challenge_phase.listPhases')
     @access.public
-    @loadmodel(map={'challengeId': 'challenge'}, model='challenge',
-               plugin='challenge', level=AccessType.READ)
-    def listPhases(self, challenge, params):
+    def listPhases(self, params):
+        if 'ids' in params:
+            return self._loadPhases(params['ids'])
+
+        self.requireParams('challengeId', params)
         limit, offset, sort = self.getPagingParameters(params, 'name')
 
+        after = None
+        if params.get('after'):
+            try:
+                after = decodeCursor(params['after'])
+            except ValueError:
+                raise RestException('Invalid "after" cursor.')
+
+        model = self.model('phase', 'challenge')
+        fields = listFields(params, model.summaryFields)
         user = self.getCurrentUser()
-        results = self.model('phase', 'challenge').list(
-            challenge, user=user, offset=offset, limit=limit, sort=sort)
-        return [self.model('phase', 'challenge').filter(p, user)
-                for p in results]
+        challenge = loadDocument(
+            self.model('challenge', 'challenge'), params['challengeId'], user,
+            level=AccessType.READ)
+
+        cache = getResponseCache()
+        aclKey = listingAclKey(model, {'challengeId': challenge['_id']},
+                               challenge['_id'], user)
+        key = ('list', 'challenge_phase', str(challenge['_id']), aclKey,
+               limit, offset, tuple(sort), params.get('after'),
+               fields and tuple(fields))
+        cached = cache.get(key)
+        if cached is None:
+            results = model.list(
+                challenge, user=user, offset=offset, limit=limit, sort=sort,
+                after=after, fields=fields)
+            nextAfter = None
+            if limit and len(results) == limit:
+                nextAfter = encodeCursor(results[-1], sort)
+            filtered = [model.filter(p, user) for p in results]
+            cached = (filtered, nextAfter, computeEtag(filtered, results))
+            cache.set(key, cached, tags=[
+                listTag('challenge_phase', challenge['_id'])])
+
+        filtered, nextAfter, etag = cached
+        if nextAfter is not None:
+            cherrypy.response.headers['Girder-Next-After'] = nextAfter
+        conditionalResponse(etag)
+        return filtered
     listPhases.description = (
-        Description('List phases for a challenge.')
-        .param('challengeId', 'The ID of the challenge.')
+        Description('List phases for a challenge, or get several phases by ID. '
+                    'The response carries an ETag header, and conditional '
+                    'requests are answered with 304 Not Modified.')
+        .param('challengeId', 'The ID of the challenge. Required unless ids '
+               'is passed.', required=False)
+        .param('ids', 'A JSON list of phase IDs to get instead of listing the '
+               'phases of a challenge. Phases that do not exist or that the '
+               'user cannot read are left out.', required=False)
         .param('limit', "Result set size limit (default=50).", required=False,
                dataType='int')
         .param('offset', "Offset into result set (default=0).", required=False,
@@ -60,8 +132,82 @@ class Phase(Resource):
         .param('sort', "Field to sort the result list by (default=name)",
                required=False)
         .param('sortdir', "1 for ascending, -1 for descending (default=1)",
-               required=False, dataType='int'))
+               required=False, dataType='int')
+        .param('after', 'Opaque cursor returned in the Girder-Next-After '
+               'response header of the previous page. When passed, the '
+               'listing resumes after the last phase of that page and '
+               'offset is ignored.', required=False)
+        .param('fields', 'A comma-separated list of the fields to return. '
+               'Only these fields are read from the database, along with the '
+               'ID and those needed to check access and to sort.',
+               required=False)
+        .param('view', 'Pass "summary" to return every field but the long '
+               'description and instructions (default=full).',
+               required=False))
+
+    def _loadPhases(self, ids):
+        try:
+            ids = json.loads(ids)
+            if not isinstance(ids, list):
+                raise ValueError()
+            ids = [ObjectId(id) for id in ids]
+        except (ValueError, TypeError, InvalidId):
+            raise RestException(
+                'The ids parameter must be a JSON list of IDs.')
+        if len(ids) > MAX_IDS:
+            raise RestException(
+                'At most %d phases may be requested at once.' % MAX_IDS)
+
+        user = self.getCurrentUser()
+        phases = {p['_id']: p for p in self.model(
+            'phase', 'challenge').loadMany(ids, user=user)}
+        found = [phases[id] for id in ids if id in phases]
+        filtered = [self.model('phase', 'challenge').filter(p, user)
+                    for p in found]
+        conditionalResponse(computeEtag(filtered, found))
+        return filtered
+
+    @timed('route', 'challenge_phase.countPhases')
+    @access.public
+    @loadmodel(map={'challengeId': 'challenge'}, model='challenge',
+               plugin='challenge', level=AccessType.READ)
+    def countPhases(self, challenge, params):
+        return {
+            'nPhases': self.model('phase', 'challenge').count(
+                challenge, user=self.getCurrentUser())
+        }
+    countPhases.description = (
+        Description('Get the total number of phases of a challenge visible to '
+                    'the current user.')
+        .param('challengeId', 'The ID of the challenge.')
+        .errorResponse('Read permission denied on the challenge.', 403))
+
+    @timed('route', 'challenge_phase.getGroundTruthCache')
+    @access.admin
+    def getGroundTruthCache(self, params):
+        return getCache().stats()
+    getGroundTruthCache.description = (
+        Description('Get the hit and miss counters and the size of the ground '
+                    'truth cache of this server process.'))
+
+    def _parseDeadline(self, value):
+        """
+        Parse an ISO 8601 date to a naive UTC datetime. An empty value means
+        no deadline.
+        """
+        if not value:
+            return None
+        try:
+            deadline = dateutil.parser.parse(value)
+        except (ValueError, OverflowError):
+            raise RestException('Invalid deadline; it must be an ISO 8601 '
+                                'date.')
+        if deadline.tzinfo is not None:
+            deadline = deadline.astimezone(dateutil.tz.tzutc()).replace(
+                tzinfo=None)
+        return deadline
 
+    @timed('route', 'challenge_phase.createPhase')
     @access.user
     @loadmodel(map={'challengeId': 'challenge'}, level=AccessType.WRITE,
                model='challenge', plugin='challenge')
@@ -84,7 +230,10 @@ class Phase(Resource):
         phase = self.model('phase', 'challenge').createPhase(
             name=params['name'].strip(), description=description,
             instructions=instructions, active=active, public=public,
-            creator=user, challenge=challenge, participantGroup=group)
+            creator=user, challenge=challenge, participantGroup=group,
+            metric=params.get('metric', DEFAULT_METRIC),
+            deadline=self._parseDeadline(params.get('deadline')),
+            defer=self.boolParam('defer', params, default=False))
 
         return phase
     createPhase.description = (
@@ -101,8 +250,20 @@ class Phase(Resource):
         .param('public', 'Whether the phase should be publicly visible.',
                dataType='boolean')
         .param('active', 'Whether the phase will accept and score additional '
-               'submissions.', dataType='boolean', required=False))
+               'submissions.', dataType='boolean', required=False)
+        .param('metric', 'The metric used to score submissions to this phase '
+               '(default=%s). One of: %s.' % (
+                   DEFAULT_METRIC, ', '.join(sorted(METRICS))),
+               required=False)
+        .param('deadline', 'When the phase closes, as an ISO 8601 date. '
+               'Scoring of active phases closing soonest is run first.',
+               required=False)
+        .param('defer', 'Return as soon as the phase is saved, in the '
+               '"provisioning" state, and create its folders and participant '
+               'group in the background (default=false).', required=False,
+               dataType='boolean'))
 
+    @timed('route', 'challenge_phase.getAccess')
     @access.user
     @loadmodel(model='phase', plugin='challenge', level=AccessType.ADMIN)
     def getAccess(self, phase, params):
@@ -113,10 +274,12 @@ class Phase(Resource):
         .errorResponse('ID was invalid.')
         .errorResponse('Admin access was denied for the phase.', 403))
 
+    @timed('route', 'challenge_phase.updateAccess')
     @access.user
     @loadmodel(model='phase', plugin='challenge', level=AccessType.ADMIN)
     def updateAccess(self, phase, params):
         self.requireParams('access', params)
+        requireReady(phase, 'phase')
 
         public = self.boolParam('public', params, default=False)
         self.model('phase', 'challenge').setPublic(phase, public)
@@ -136,9 +299,12 @@ class Phase(Resource):
         .errorResponse('ID was invalid.')
         .errorResponse('Admin permission denied on the phase.', 403))
 
+    @timed('route', 'challenge_phase.updatePhase')
     @access.user
     @loadmodel(model='phase', plugin='challenge', level=AccessType.WRITE)
     def updatePhase(self, phase, params):
+        requireReady(phase, 'phase')
+        priority = (phase['active'], phase.get('deadline'))
         phase['active'] = self.boolParam('active', params, phase['active'])
         phase['name'] = params.get('name', phase['name']).strip()
         phase['description'] = params.get('description',
@@ -150,9 +316,22 @@ class Phase(Resource):
             group = self.model('group').load(
                 params['participantGroupId'],
                 user=user, level=AccessType.READ, exc=True)
-            phase['participantGroupId'] = group['_id']
+            if group['_id'] != phase['participantGroupId']:
+                phase['participantGroupId'] = group['_id']
+                counts = self.model('phase', 'challenge').countMembers(
+                    [group['_id']])
+                phase['participantCount'] = counts[group['_id']]
+        # Phases saved before metrics were selectable use the default one
+        metric = phase.get('metric') or DEFAULT_METRIC
+        phase['metric'] = params.get('metric', metric)
+        if 'deadline' in params:
+            phase['deadline'] = self._parseDeadline(params['deadline'])
 
         self.model('phase', 'challenge').updatePhase(phase)
+        if (phase['active'], phase.get('deadline')) != priority:
+            self.model('job', 'challenge').reprioritize(phase)
+        if phase['metric'] != metric:
+            self.model('job', 'challenge').enqueue('rescore', phase)
         return phase
     updatePhase.description = (
         Description('Update the properties of a challenge phase.')
@@ -167,57 +346,229 @@ class Phase(Resource):
         .param(
             'active', 'Whether the phase will accept and score additional '
             'submissions.', dataType='boolean', required=False)
+        .param('metric', 'The metric used to score submissions to this phase. '
+               'One of: %s.' % ', '.join(sorted(METRICS)), required=False)
+        .param('deadline', 'When the phase closes, as an ISO 8601 date. Pass '
+               'an empty value to remove the deadline.', required=False)
         .errorResponse('ID was invalid.')
         .errorResponse('Write permission denied on the phase.', 403))
 
+    @timed('route', 'challenge_phase.getPhase')
     @access.public
-    @loadmodel(model='phase', plugin='challenge', level=AccessType.READ)
-    def getPhase(self, phase, params):
-        return self.model('phase', 'challenge').filter(
-            phase, self.getCurrentUser())
+    def getPhase(self, id, params):
+        user = self.getCurrentUser()
+        model = self.model('phase', 'challenge')
+        phase = loadDocument(model, id, user, level=AccessType.READ)
+        return filteredResponse(model, phase, user)
     getPhase.description = (
-        Description('Get a phase by ID.')
+        Description('Get a phase by ID. The response carries ETag and '
+                    'Last-Modified headers, and conditional requests are '
+                    'answered with 304 Not Modified.')
         .responseClass('Phase')
         .param('id', 'The ID of the phase.', paramType='path')
         .errorResponse('ID was invalid.')
         .errorResponse('Read permission denied on the phase.', 403))
 
+    @timed('route', 'challenge_phase.getLeaderboard')
+    @access.public
+    @loadmodel(model='phase', plugin='challenge', level=AccessType.READ)
+    def getLeaderboard(self, phase, params):
+        limit, offset, _ = self.getPagingParameters(params, 'score')
+        return self.model('leaderboard', 'challenge').list(
+            phase, limit=limit, offset=offset)
+    getLeaderboard.description = (
+        Description('Get the best score of each participant of a phase, from '
+                    'best to worst, with their rank. Tied participants share '
+                    'the best rank.')
+        .param('id', 'The ID of the phase.', paramType='path')
+        .param('limit', "Result set size limit (default=50).", required=False,
+               dataType='int')
+        .param('offset', "Offset into result set (default=0).", required=False,
+               dataType='int')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read permission denied on the phase.', 403))
+
+    @timed('route', 'challenge_phase.exportPhase')
+    @access.user
+    @loadmodel(model='phase', plugin='challenge', level=AccessType.WRITE)
+    def exportPhase(self, phase, params):
+        fmt = params.get('format', 'csv')
+        if fmt not in EXPORT_FORMATS:
+            raise RestException('Invalid format; must be one of: %s.' %
+                                ', '.join(sorted(EXPORT_FORMATS)))
+        compress = self.boolParam('gzip', params, default=False)
+        fields = list(EXPORT_FIELDS)
+        if fmt == 'ndjson':
+            fields.append('scoreDetail')
+
+        contentType, encode = EXPORT_FORMATS[fmt]
+        filename = '%s.%s' % (phase['name'], fmt)
+        if compress:
+            contentType = 'application/gzip'
+            filename += '.gz'
+        cherrypy.response.headers['Content-Type'] = contentType
+        cherrypy.response.headers['Content-Disposition'] = \
+            'attachment; filename="%s"' % filename.replace('"', '')
+        cherrypy.response.stream = True
+
+        submissions = self.model('submission', 'challenge').export(
+            phase, fields)
+
+        def stream():
+            chunks = encode(submissions, fields)
+            if compress:
+                chunks = gzipChunks(chunks)
+            for chunk in chunks:
+                yield chunk
+        return stream
+    exportPhase.description = (
+        Description('Download every submission to a phase along with its '
+                    'score. The export is streamed from the database, so it '
+                    'can be of any size.')
+        .param('id', 'The ID of the phase.', paramType='path')
+        .param('format', 'Either "csv" (the default) or "ndjson". NDJSON '
+               'lines also include the per-file score details.',
+               required=False)
+        .param('gzip', 'Whether to compress the export with gzip.',
+               required=False, dataType='boolean')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Write permission denied on the phase.', 403))
+
+    @timed('route', 'challenge_phase.getRank')
+    @access.user
+    @loadmodel(model='phase', plugin='challenge', level=AccessType.READ)
+    def getRank(self, phase, params):
+        return self.model('leaderboard', 'challenge').getRank(
+            phase, self.getCurrentUser())
+    getRank.description = (
+        Description('Get the leaderboard entry and rank of the current user '
+                    'in a phase, or null if they have no scored submission.')
+        .param('id', 'The ID of the phase.', paramType='path')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read permission denied on the phase.', 403))
+
+    @timed('route', 'challenge_phase.joinPhase')
     @access.user
     @loadmodel(model='phase', plugin='challenge', level=AccessType.READ)
     def joinPhase(self, phase, params):
+        requireReady(phase, 'phase')
         user = self.getCurrentUser()
-        phase = self.model('phase', 'challenge').filter(
-            phase, self.getCurrentUser())
-        participantGroupId = phase['participantGroupId']
-        if 'groups' not in user or participantGroupId not in user['groups']:
-            participantGroup = self.model('group').load(
-                participantGroupId, user=user, level=AccessType.READ)
-            self.model('group').addUser(participantGroup, user,
-                                        level=AccessType.READ)
-        return phase
+        if (phase['participantGroupId'] not in user.get('groups', []) and
+                self.model('phase', 'challenge').addParticipant(phase, user)):
+            phase['participantCount'] = phase.get('participantCount', 0) + 1
+        return self.model('phase', 'challenge').filter(phase, user)
     joinPhase.description = (
-        Description('Join a phase as a competitor.')
+        Description('Join a phase as a competitor. The participant group of '
+                    'the phase must be public or readable by the user.')
         .responseClass('Phase')
         .param('id', 'The ID of the phase.', paramType='path')
         .errorResponse('ID was invalid.')
-        .errorResponse('Read permission denied on the phase.', 403))
+        .errorResponse('Read permission denied on the phase or its '
+                       'participant group.', 403))
+
+    @timed('route', 'challenge_phase.enrollParticipants')
+    @access.user
+    @loadmodel(model='phase', plugin='challenge', level=AccessType.WRITE)
+    def enrollParticipants(self, phase, params):
+        self.requireParams('userIds', params)
+        requireReady(phase, 'phase')
+
+        userIds = []
+        rows = csv.reader(six.StringIO(params['userIds']))
+        for line, row in enumerate(rows, start=1):
+            if not row or not row[0].strip():
+                continue
+            try:
+                userIds.append(ObjectId(row[0].strip()))
+            except (InvalidId, TypeError):
+                # Allow a header row
+                if line == 1:
+                    continue
+                raise RestException(
+                    'Invalid user ID on line %d: %s.' % (line, row[0]))
+
+        added = self.model('phase', 'challenge').addParticipants(
+            phase, userIds, enroller=self.getCurrentUser())
+        return {
+            'added': added,
+            'participantCount': self.model('phase', 'challenge').load(
+                phase['_id'], force=True, fields=['participantCount']
+            ).get('participantCount', 0)
+        }
+    enrollParticipants.description = (
+        Description('Add many users to the participants of a phase at once. '
+                    'Users that already participate and unknown user IDs are '
+                    'ignored.')
+        .param('id', 'The ID of the phase.', paramType='path')
+        .param('userIds', 'CSV text whose first column holds the IDs of the '
+               'users to enroll, one per line. A header line is allowed.')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Write permission denied on the phase or its '
+                       'participant group.', 403))
 
+    @timed('route', 'challenge_phase.scorePhase')
+    @access.user
+    @loadmodel(model='phase', plugin='challenge', level=AccessType.WRITE)
+    def scorePhase(self, phase, params):
+        requireReady(phase, 'phase')
+        rescore = self.boolParam('rescore', params, default=False)
+        job = self.model('job', 'challenge').enqueue(
+            'score', phase, {'rescore': True} if rescore else {})
+        return {
+            'message': 'Queued scoring of phase %s.' % phase['name'],
+            'jobId': job['_id']
+        }
+    scorePhase.description = (
+        Description('Queue the scoring of the submissions to a phase against '
+                    'its ground truth. If the same scoring is already queued, '
+                    'that job is returned. The state of the job can be '
+                    'followed with GET /challenge_phase/:id/job.')
+        .param('id', 'The ID of the phase.', paramType='path')
+        .param('rescore', 'Whether to also rescore submissions that already '
+               'have a score (default=false).', required=False,
+               dataType='boolean')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Write permission denied on the phase.', 403))
+
+    @timed('route', 'challenge_phase.listJobs')
+    @access.user
+    @loadmodel(model='phase', plugin='challenge', level=AccessType.WRITE)
+    def listJobs(self, phase, params):
+        limit, offset, _ = self.getPagingParameters(params, 'created')
+        return list(self.model('job', 'challenge').list(
+            phase, limit=limit, offset=offset))
+    listJobs.description = (
+        Description('List the background jobs of a phase, most recent first.')
+        .param('id', 'The ID of the phase.', paramType='path')
+        .param('limit', "Result set size limit (default=50).", required=False,
+               dataType='int')
+        .param('offset', "Offset into result set (default=0).", required=False,
+               dataType='int')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Write permission denied on the phase.', 403))
+
+    @timed('route', 'challenge_phase.deletePhase')
     @access.user
     @loadmodel(model='phase', plugin='challenge', level=AccessType.ADMIN)
     def deletePhase(self, phase, params):
-        progress = self.boolParam('progress', params, default=False)
-        with ProgressContext(progress, user=self.getCurrentUser(),
-                             title=u'Deleting phase ' + phase['name'],
-                             message='Calculating total size...') as ctx:
-            if progress:
-                ctx.update(
-                    total=self.model('phase', 'challenge').subtreeCount(phase))
-            self.model('phase', 'challenge').remove(phase, progress=ctx)
-        return {'message': 'Deleted phase %s.' % phase['name']}
+        model = self.model('phase', 'challenge')
+
+        def delete(ctx):
+            ctx.update(total=model.subtreeCount(phase))
+            model.remove(phase, progress=ctx)
+
+        job = backgroundTask(
+            delete, user=self.getCurrentUser(),
+            title=u'Deleting phase ' + phase['name'],
+            message='Calculating total size...')
+        return {
+            'message': 'Deleting phase %s.' % phase['name'],
+            'jobId': job['_id']
+        }
     deletePhase.description = (
-        Description('Delete a phase.')
+        Description('Delete a phase. The deletion runs in the background; the '
+                    'returned jobId is the ID of the progress notification '
+                    'tracking it.')
         .param('id', 'The ID of the phase to delete.', paramType='path')
-        .param('progress', 'Whether to record progress on this task. Default '
-               'is false.', required=False, dataType='boolean')
         .errorResponse('ID was invalid.')
         .errorResponse('Admin access was denied for the phase.', 403))
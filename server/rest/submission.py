@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import cherrypy
+import json
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from girder.api import access
+from girder.api.describe import Description
+from girder.api.rest import Resource, loadmodel, RestException
+from girder.constants import AccessType
+from girder.models.model_base import AccessException
+
+from ..utility import accessQuery, combineQueries, requireReady
+
+MAX_BATCH_SIZE = 1000
+# Size of the chunks read from the request body and handed to the assetstore
+UPLOAD_CHUNK_BYTES = 32 * 1024 * 1024
+
+
+class Submission(Resource):
+    def __init__(self):
+        self.resourceName = 'challenge_submission'
+
+        self.route('GET', (), self.listSubmissions)
+        self.route('GET', (':id',), self.getSubmission)
+        self.route('POST', (), self.createSubmission)
+        self.route('POST', ('batch',), self.createSubmissions)
+        self.route('POST', ('upload',), self.uploadSubmission)
+        self.route('DELETE', (':id',), self.deleteSubmission)
+
+    def _requireCanSubmit(self, phase, user):
+        """
+        Make sure the user may submit to the phase. This only inspects
+        documents that are already loaded, so it costs no database round trip.
+        """
+        requireReady(phase, 'phase')
+        if not phase.get('active'):
+            raise RestException('This phase is not accepting submissions.')
+        if (phase['participantGroupId'] not in user.get('groups', []) and
+                not self.model('phase', 'challenge').hasAccess(
+                    phase, user, AccessType.WRITE)):
+            raise AccessException(
+                'You must join this phase before submitting to it.')
+
+    def _requireFolders(self, folderIds, user):
+        """
+        Convert folder IDs to ObjectIds and make sure the user can write to
+        all of them, using a single query. Read access is not enough: it
+        would let participants submit public folders of others, including
+        their submissions.
+        """
+        try:
+            folderIds = [ObjectId(f) for f in folderIds]
+        except (InvalidId, TypeError):
+            raise RestException('Invalid folder ID.')
+
+        unique = list(set(folderIds))
+        if unique:
+            found = self.model('folder').find(combineQueries(
+                {'_id': {'$in': unique}},
+                accessQuery(user, AccessType.WRITE)), fields=['_id'], limit=0)
+            if len(list(found)) != len(unique):
+                raise AccessException(
+                    'Write access denied on a submitted folder.')
+        return folderIds
+
+    @access.user
+    @loadmodel(map={'phaseId': 'phase'}, model='phase', plugin='challenge',
+               level=AccessType.READ)
+    def listSubmissions(self, phase, params):
+        limit, offset, sort = self.getPagingParameters(params, 'created')
+
+        user = self.getCurrentUser()
+        # Participants only see their own submissions
+        creator = None
+        if not self.model('phase', 'challenge').hasAccess(
+                phase, user, AccessType.WRITE):
+            creator = user
+
+        results = self.model('submission', 'challenge').list(
+            phase, creator=creator, limit=limit, offset=offset, sort=sort)
+        return [self.model('submission', 'challenge').filter(s)
+                for s in results]
+    listSubmissions.description = (
+        Description('List submissions to a phase. Users without write access '
+                    'on the phase only see their own submissions.')
+        .param('phaseId', 'The ID of the phase.')
+        .param('limit', "Result set size limit (default=50).", required=False,
+               dataType='int')
+        .param('offset', "Offset into result set (default=0).", required=False,
+               dataType='int')
+        .param('sort', "Field to sort the result list by (default=created)",
+               required=False)
+        .param('sortdir', "1 for ascending, -1 for descending (default=1)",
+               required=False, dataType='int')
+        .errorResponse('Read permission denied on the phase.', 403))
+
+    @access.user
+    @loadmodel(model='submission', plugin='challenge')
+    def getSubmission(self, submission, params):
+        user = self.getCurrentUser()
+        phase = self.model('phase', 'challenge').load(
+            submission['phaseId'], user=user, level=AccessType.READ, exc=True)
+        if (submission['creatorId'] != user['_id'] and
+                not self.model('phase', 'challenge').hasAccess(
+                    phase, user, AccessType.WRITE)):
+            raise AccessException('Read access denied on the submission.')
+
+        return self.model('submission', 'challenge').filter(submission)
+    getSubmission.description = (
+        Description('Get a submission by ID.')
+        .param('id', 'The ID of the submission.', paramType='path')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read permission denied on the submission.', 403))
+
+    @access.user
+    @loadmodel(map={'phaseId': 'phase'}, model='phase', plugin='challenge',
+               level=AccessType.READ)
+    def createSubmission(self, phase, params):
+        user = self.getCurrentUser()
+        self._requireCanSubmit(phase, user)
+
+        folderId = None
+        if params.get('folderId'):
+            folderId = self._requireFolders([params['folderId']], user)[0]
+
+        submission = self.model('submission', 'challenge').createSubmission(
+            phase, user, title=params.get('title', ''), folderId=folderId)
+        return self.model('submission', 'challenge').filter(submission)
+    createSubmission.description = (
+        Description('Submit to a phase.')
+        .param('phaseId', 'The ID of the phase to submit to.')
+        .param('title', 'A title for this submission.', required=False)
+        .param('folderId', 'The ID of the folder containing the submitted '
+               'data.', required=False)
+        .errorResponse('The phase is not accepting submissions.')
+        .errorResponse('The user has not joined the phase.', 403))
+
+    @access.user
+    @loadmodel(map={'phaseId': 'phase'}, model='phase', plugin='challenge',
+               level=AccessType.READ)
+    def createSubmissions(self, phase, params):
+        self.requireParams('submissions', params)
+        user = self.getCurrentUser()
+        self._requireCanSubmit(phase, user)
+
+        try:
+            submissions = json.loads(params['submissions'])
+        except ValueError:
+            raise RestException('The submissions parameter must be JSON.')
+        if not isinstance(submissions, list) or \
+                not all(isinstance(s, dict) for s in submissions):
+            raise RestException(
+                'The submissions parameter must be a list of objects.')
+        if len(submissions) > MAX_BATCH_SIZE:
+            raise RestException('At most %d submissions may be created at '
+                                'once.' % MAX_BATCH_SIZE)
+
+        withFolder = [s for s in submissions if s.get('folderId')]
+        folderIds = self._requireFolders(
+            [s['folderId'] for s in withFolder], user)
+        for s, folderId in zip(withFolder, folderIds):
+            s['folderId'] = folderId
+
+        results = self.model('submission', 'challenge').createSubmissions(
+            phase, user, submissions)
+        return [self.model('submission', 'challenge').filter(s)
+                for s in results]
+    createSubmissions.description = (
+        Description('Submit many times to a phase in a single request. All '
+                    'submissions are written at once.')
+        .param('phaseId', 'The ID of the phase to submit to.')
+        .param('submissions', 'A JSON list of submissions, each an object '
+               'with optional "title", "folderId" and "meta" keys. At most '
+               '%d submissions may be sent at once. You must have write '
+               'access on the folders.' % MAX_BATCH_SIZE)
+        .errorResponse('The phase is not accepting submissions.')
+        .errorResponse('The user has not joined the phase.', 403)
+        .errorResponse('Write access was denied on a folder.', 403))
+
+    @access.user
+    @loadmodel(map={'phaseId': 'phase'}, model='phase', plugin='challenge',
+               level=AccessType.READ)
+    def uploadSubmission(self, phase, params):
+        self.requireParams(('name', 'size'), params)
+        user = self.getCurrentUser()
+        self._requireCanSubmit(phase, user)
+        model = self.model('submission', 'challenge')
+
+        name = params['name'].strip()
+        try:
+            size = int(params['size'])
+        except ValueError:
+            raise RestException('The size parameter must be an integer.')
+        if not name or size <= 0:
+            raise RestException('A non-empty file name and size are required.')
+
+        submission = None
+        if params.get('submissionId'):
+            submission = model.load(params['submissionId'], exc=True)
+            if (submission['creatorId'] != user['_id'] or
+                    submission['phaseId'] != phase['_id']):
+                raise AccessException('You can only add files to your own '
+                                      'submissions to this phase.')
+            if any(f['name'] == name for f in
+                   submission.get('meta', {}).get('files', ())):
+                raise RestException('A file named %s was already submitted.'
+                                    % name)
+            if not submission.get('folderId'):
+                raise RestException('This submission has no folder to add '
+                                    'files to.')
+            folder = self.model('folder').load(
+                submission['folderId'], force=True)
+        else:
+            folder = model.createFolder(phase, user)
+
+        def chunks():
+            body = cherrypy.request.body
+            while True:
+                chunk = body.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                yield chunk
+
+        try:
+            entry = model.storeFile(phase, user, folder, name, size, chunks())
+        except Exception:
+            if submission is None:
+                self.model('folder').remove(folder)
+            raise
+
+        if submission is None:
+            submission = model.createSubmission(
+                phase, user, title=params.get('title', ''),
+                folderId=folder['_id'], meta={'files': [entry]})
+        else:
+            model.addFile(phase, submission, entry)
+        return model.filter(submission)
+    uploadSubmission.description = (
+        Description('Upload a file to a phase as a submission. The request '
+                    'body is the contents of the file. It is checked and '
+                    'checksummed while it streams in; ".npy" files must have a '
+                    'valid header and the shape of the ground truth file of '
+                    'the same name, and are rejected as soon as their header '
+                    'shows otherwise.')
+        .param('phaseId', 'The ID of the phase to submit to.')
+        .param('name', 'The name of the file, matching the name of a ground '
+               'truth file.')
+        .param('size', 'The size of the file in bytes.', dataType='int')
+        .param('title', 'A title for a new submission.', required=False)
+        .param('submissionId', 'The ID of one of your submissions to add the '
+               'file to. If omitted, a new submission is created.',
+               required=False)
+        .errorResponse('The phase is not accepting submissions.')
+        .errorResponse('The file was invalid.')
+        .errorResponse('The user has not joined the phase.', 403))
+
+    @access.user
+    @loadmodel(model='submission', plugin='challenge')
+    def deleteSubmission(self, submission, params):
+        user = self.getCurrentUser()
+        phase = self.model('phase', 'challenge').load(
+            submission['phaseId'], user=user, level=AccessType.READ, exc=True)
+        if (submission['creatorId'] != user['_id'] and
+                not self.model('phase', 'challenge').hasAccess(
+                    phase, user, AccessType.ADMIN)):
+            raise AccessException('Admin access denied on the submission.')
+
+        self.model('submission', 'challenge').remove(submission)
+        return {'message': 'Deleted submission %s.' % submission['_id']}
+    deleteSubmission.description = (
+        Description('Delete a submission.')
+        .param('id', 'The ID of the submission to delete.', paramType='path')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Admin access was denied for the submission.', 403))
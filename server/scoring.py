@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""
+Scoring of submissions against the ground truth of a phase. This module does
+not depend on Girder so that it can be benchmarked on its own; the models
+are responsible for loading the data and storing the results.
+"""
+
+import ast
+import collections
+import hashlib
+import io
+import itertools
+import multiprocessing
+import numbers
+import os
+import shutil
+import struct
+import tempfile
+import threading
+
+import numpy
+
+NPY_MAGIC = b'\x93NUMPY'
+# Larger headers are rejected; NumPy itself never writes more than a few KB
+NPY_MAX_HEADER = 64 * 1024
+
+# Number of scoring runs whose ground truth a pool worker keeps mapped
+WORKER_RUNS = 4
+
+# Ground truth files mapped by the current pool worker, keyed by the
+# directory of the scoring run they belong to, least recently used first
+_worker = collections.OrderedDict()
+_pool = None
+_poolLock = threading.Lock()
+
+# A submitted file decoded where it is scored, read from a local path if set
+# or else from its contents, with its .npy header if known. A file that
+# cannot be decoded is reported as an error of its own pair.
+EncodedFile = collections.namedtuple('EncodedFile',
+                                     ('path', 'contents', 'header'))
+
+
+def isNpy(name):
+    return os.path.splitext(name)[1].lower() == '.npy'
+
+
+def decode(name, data, header=None):
+    """
+    Decode the contents of a ground truth or submission file. NumPy ``.npy``
+    files are decoded to arrays; anything else is returned as raw bytes.
+
+    :param name: The name of the file.
+    :type name: str
+    :param data: The contents of the file.
+    :type data: bytes
+    :param header: The header of a ``.npy`` file as returned by
+    ``parseNpyHeader``, if already known. The array is then a read-only view
+    of data rather than a copy. A header that does not match the size of the
+    data is ignored and the data is parsed in full.
+    :type header: dict or None
+    """
+    if isNpy(name):
+        if header is not None and header.get('nbytes') is not None and \
+                header['offset'] + header['nbytes'] == len(data):
+            return numpy.frombuffer(
+                data, dtype=numpy.dtype(header['descr']),
+                count=int(numpy.prod(header['shape'])),
+                offset=header['offset']
+            ).reshape(header['shape'],
+                      order='F' if header['fortranOrder'] else 'C')
+        return numpy.load(io.BytesIO(data), allow_pickle=False)
+    return data
+
+
+def parseNpyHeader(data):
+    """
+    Parse the header at the start of a ``.npy`` file.
+
+    :param data: The first bytes of the file; they may stop before the end
+    of the header.
+    :type data: bytes
+    :returns: None if more bytes are needed. Otherwise a dict with the
+    ``descr``, ``fortranOrder`` and ``shape`` of the array, the ``offset``
+    of its data, and its size in bytes as ``nbytes``.
+    :raises ValueError: If the data is not a valid ``.npy`` header.
+    """
+    if data[:len(NPY_MAGIC)] != NPY_MAGIC[:len(data)]:
+        raise ValueError('Not a .npy file.')
+    if len(data) < 8:
+        return None
+    major = bytearray(data[6:7])[0]
+    if major == 1:
+        lengthFormat = '<H'
+    elif major in (2, 3):
+        lengthFormat = '<I'
+    else:
+        raise ValueError('Unsupported .npy format version %d.' % major)
+    start = 8 + struct.calcsize(lengthFormat)
+    if len(data) < start:
+        return None
+    length = struct.unpack(lengthFormat, data[8:start])[0]
+    if length > NPY_MAX_HEADER:
+        raise ValueError('The .npy header is too long.')
+    if len(data) < start + length:
+        return None
+
+    try:
+        header = ast.literal_eval(data[start:start + length].decode(
+            'utf8' if major == 3 else 'latin1'))
+    except (SyntaxError, ValueError, UnicodeDecodeError):
+        raise ValueError('Malformed .npy header.')
+    if not isinstance(header, dict) or \
+            set(header) != {'descr', 'fortran_order', 'shape'}:
+        raise ValueError('Malformed .npy header.')
+    shape = header['shape']
+    if not isinstance(shape, tuple) or not all(
+            isinstance(n, numbers.Integral) and n >= 0 for n in shape):
+        raise ValueError('Invalid array shape in .npy header.')
+    if not isinstance(header['descr'], str):
+        raise ValueError('Structured arrays are not supported.')
+
+    try:
+        dtype = numpy.dtype(header['descr'])
+    except TypeError:
+        raise ValueError('Invalid dtype in .npy header.')
+    if dtype.hasobject:
+        raise ValueError('Object arrays are not allowed.')
+    nbytes = dtype.itemsize
+    for n in shape:
+        nbytes *= n
+
+    return {
+        'descr': header['descr'],
+        'fortranOrder': bool(header['fortran_order']),
+        'shape': list(shape),
+        'offset': start + length,
+        'nbytes': nbytes
+    }
+
+
+class FileInspector(object):
+    """
+    Inspects a file as it is streamed in: computes its SHA-512 checksum and,
+    for ``.npy`` files, parses and validates the header from the first bytes
+    so that an invalid file is rejected before the rest of it is read.
+
+    :param name: The name of the file.
+    :type name: str
+    :param size: The announced size of the file in bytes.
+    :type size: int
+    :param shape: If set, the shape that a ``.npy`` file must have.
+    :type shape: list or None
+    """
+    def __init__(self, name, size, shape=None):
+        self.name = name
+        self.size = size
+        self.shape = shape
+        self.received = 0
+        self.header = None
+        self._checksum = hashlib.sha512()
+        self._head = b'' if isNpy(name) else None
+
+    def update(self, chunk):
+        """
+        Inspect the next chunk of the file.
+
+        :raises ValueError: If the file is invalid.
+        """
+        self.received += len(chunk)
+        if self.received > self.size:
+            raise ValueError('Received more than the announced %d bytes.' %
+                             self.size)
+        self._checksum.update(chunk)
+
+        if self._head is not None:
+            self._head += chunk
+            self.header = parseNpyHeader(self._head)
+            if self.header is not None:
+                self._head = None
+                self._checkHeader()
+            elif len(self._head) > NPY_MAX_HEADER + 16:
+                raise ValueError('The .npy header is too long.')
+
+    def _checkHeader(self):
+        expected = self.header['offset'] + (self.header['nbytes'] or 0)
+        if self.header['nbytes'] is not None and expected != self.size:
+            raise ValueError('The array in the .npy header takes %d bytes but '
+                             'the file has %d.' % (expected, self.size))
+        if self.shape is not None and self.header['shape'] != list(
+                self.shape):
+            raise ValueError('Expected an array of shape %s, not %s.' % (
+                tuple(self.shape), tuple(self.header['shape'])))
+
+    def finish(self):
+        """
+        Check that the whole file was received.
+
+        :returns: The hex SHA-512 checksum of the file.
+        :raises ValueError: If the file is incomplete.
+        """
+        if self.received != self.size:
+            raise ValueError('Received %d of the announced %d bytes.' % (
+                self.received, self.size))
+        if isNpy(self.name) and self.header is None:
+            raise ValueError('Truncated .npy header.')
+        return self._checksum.hexdigest()
+
+
+def startPool(processes=None):
+    """
+    Start the pool of worker processes shared by every ``ScoringEngine`` of
+    this process, unless it is already running. It is started by the first
+    engine that needs it, so that processes which never score never fork.
+    The workers only run the metric and read the ground truth files passed
+    to them, so they do not depend on locks held by other threads of the
+    process when it forks.
+
+    :param processes: The number of worker processes; defaults to the number
+    of cores.
+    :type processes: int or None
+    :returns: The pool.
+    """
+    global _pool
+    with _poolLock:
+        if _pool is None:
+            _pool = multiprocessing.Pool(
+                processes or multiprocessing.cpu_count())
+        return _pool
+
+
+def _writeGroundTruth(directory, groundTruth, link=None):
+    """
+    Place the ground truth files in a directory for the pool workers to
+    map, and return the path of each keyed by name. Files that ``link``
+    places there are not decoded; the others are written from their decoded
+    contents.
+    """
+    paths = {}
+    for i, name in enumerate(sorted(groundTruth)):
+        path = os.path.join(
+            directory, '%d%s' % (i, '.npy' if isNpy(name) else '.bin'))
+        if link is None or not link(name, path):
+            value = groundTruth[name]
+            if isinstance(value, numpy.ndarray):
+                path = os.path.join(directory, '%d.npy' % i)
+                numpy.save(path, value, allow_pickle=False)
+            else:
+                path = os.path.join(directory, '%d.bin' % i)
+                with open(path, 'wb') as f:
+                    f.write(value)
+        paths[name] = path
+    return paths
+
+
+def _mapGroundTruth(name, path):
+    if path is None:
+        raise KeyError(name)
+    directory = os.path.dirname(path)
+    files = _worker.pop(directory, None) or {}
+    _worker[directory] = files
+    while len(_worker) > WORKER_RUNS:
+        _worker.popitem(last=False)
+    if path not in files:
+        files[path] = _readLocal(path, isNpy(path))
+    return files[path]
+
+
+def _readLocal(path, npy):
+    if npy:
+        return numpy.load(path, mmap_mode='r', allow_pickle=False)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _decodeSubmitted(name, data):
+    """
+    Decode a submitted file given as an ``EncodedFile``; other values are
+    already decoded.
+    """
+    if not isinstance(data, EncodedFile):
+        return data
+    if data.path is not None:
+        return _readLocal(data.path, isNpy(name))
+    return decode(name, data.contents, data.header)
+
+
+def _score(metric, key, name, data, truth):
+    try:
+        value = metric(_decodeSubmitted(name, data), truth())
+        if value is None:
+            return key, name, None, 'The metric is undefined for this file.'
+        return key, name, float(value), None
+    except Exception as e:
+        return key, name, None, '%s: %s' % (type(e).__name__, e)
+
+
+def _scoreBatch(metric, batch):
+    return [_score(metric, key, name, data,
+                   lambda: _mapGroundTruth(name, path))
+            for key, name, data, path in batch]
+
+
+class ScoringEngine(object):
+    """
+    Computes a metric for many (submission, ground truth file) pairs of one
+    phase across the pool of worker processes started by ``startPool``,
+    which is shared by every engine of the process so that the workers are
+    forked once rather than on every call. The ground truth is placed once
+    per call in a temporary directory, from which each worker memory-maps
+    the ``.npy`` files it needs, and submitted files given by path are read
+    by the workers themselves. Only a bounded number of pairs is handed to
+    the pool at a time, so the tasks are consumed as the workers progress.
+
+    :param metric: A picklable function called as ``metric(submitted,
+    groundTruth)`` that returns a number, or None where the metric is
+    undefined.
+    :param processes: The number of worker processes if the pool is not
+    running yet; defaults to the number of cores. With 1 the pairs are
+    scored in the calling process.
+    :type processes: int or None
+    :param chunksize: The number of pairs sent to a worker at a time.
+    :type chunksize: int
+    :param inFlight: The number of chunks handed to the pool at a time;
+    defaults to twice the number of processes.
+    :type inFlight: int or None
+    """
+    def __init__(self, metric, processes=None, chunksize=4, inFlight=None):
+        self.metric = metric
+        self.processes = processes or multiprocessing.cpu_count()
+        self.chunksize = chunksize
+        self.inFlight = inFlight or 2 * self.processes
+
+    def score(self, groundTruth, tasks, link=None):
+        """
+        Score submitted files against the ground truth.
+
+        :param groundTruth: The decoded ground truth files keyed by name.
+        Only the files that are needed and not linked are looked up.
+        :type groundTruth: Mapping
+        :param tasks: The pairs to score as (key, name, data) tuples, where
+        key identifies the submission, name is the ground truth file name
+        and data is the decoded submitted file or an ``EncodedFile``.
+        :param link: If set, called as ``link(name, path)`` to place a
+        ground truth file at a path without decoding it, e.g. from a cache
+        on disk. It returns whether it did.
+        :returns: A generator of (key, name, value, error) tuples in no
+        particular order. Exactly one of value and error is None.
+        """
+        if self.processes == 1:
+            for key, name, data in tasks:
+                yield _score(self.metric, key, name, data,
+                             lambda: groundTruth[name])
+            return
+
+        pool = startPool(self.processes)
+        directory = tempfile.mkdtemp(prefix='challenge_scoring_')
+        try:
+            paths = _writeGroundTruth(directory, groundTruth, link)
+            pooled = ((key, name, data, paths.get(name))
+                      for key, name, data in tasks)
+            pending = collections.deque()
+            while True:
+                batch = list(itertools.islice(pooled, self.chunksize))
+                if batch:
+                    pending.append(pool.apply_async(
+                        _scoreBatch, (self.metric, batch)))
+                if pending and (not batch or len(pending) >= self.inFlight):
+                    for result in pending.popleft().get():
+                        yield result
+                elif not batch:
+                    break
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def aggregate(results, names, keys=()):
+    """
+    Combine per-file results into one result per submission. A submission's
+    score is the mean of its file values; it is None if any ground truth
+    file is missing from the submission or could not be scored.
+
+    :param results: The (key, name, value, error) tuples from
+    ``ScoringEngine.score``.
+    :param names: The names of all ground truth files.
+    :param keys: Keys of submissions to include even if none of their files
+    were scored.
+    :returns: A dict mapping each key to a dict with ``score``, ``files``
+    and ``errors`` entries.
+    """
+    out = {key: {'files': [], 'errors': []} for key in keys}
+    for key, name, value, error in results:
+        entry = out.setdefault(key, {'files': [], 'errors': []})
+        entry['files'].append({'name': name, 'value': value})
+        if error is not None:
+            entry['errors'].append({'name': name, 'error': error})
+
+    for entry in out.values():
+        seen = set(f['name'] for f in entry['files'])
+        for name in sorted(set(names) - seen):
+            entry['errors'].append({'name': name, 'error': 'Missing file.'})
+        if entry['errors'] or not entry['files']:
+            entry['score'] = None
+        else:
+            entry['score'] = (sum(f['value'] for f in entry['files']) /
+                              len(entry['files']))
+    return out
@@ -0,0 +1,623 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import base64
+import binascii
+import csv
+import datetime
+import itertools
+import json
+import os
+import re
+import six
+import sys
+import threading
+import zlib
+
+from bson import json_util
+from bson.objectid import ObjectId
+from girder import events, logger
+from girder.api.rest import RestException
+from girder.constants import AccessType, AssetstoreType, SortDir
+from girder.utility.model_importer import ModelImporter
+from girder.utility.progress import ProgressContext
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from .constants import PluginSettings
+from .scoring import parseNpyHeader
+
+DUPLICATE_KEY = 11000
+
+# States of challenges and phases; those created with deferred provisioning
+# lack their collection, folders or group until they are ready.
+PROVISIONING = 'provisioning'
+READY = 'ready'
+
+
+def requireReady(doc, kind):
+    """
+    Reject a request that needs the collection, folders or participant group
+    of a challenge or phase that is still being provisioned.
+
+    :param kind: 'challenge' or 'phase', for the error message.
+    :type kind: str
+    """
+    if doc.get('state') == PROVISIONING:
+        raise RestException('This %s is still being provisioned; try again '
+                            'shortly.' % kind, code=409)
+
+
+def accessQuery(user, level=AccessType.READ):
+    """
+    Build a query matching the documents on which a user has at least the
+    given access level. This mirrors ``AccessControlledModel.hasAccess`` so
+    that permission filtering can be done by the database instead of by
+    iterating over a cursor.
+
+    :param user: The user to check access for, or None for anonymous access.
+    :type user: dict or None
+    :param level: The minimum access level required.
+    :type level: AccessType
+    :returns: A query dict; empty if the user can access every document.
+    """
+    if user is not None and user.get('admin', False):
+        return {}
+
+    clauses = []
+    if level <= AccessType.READ:
+        clauses.append({'public': True})
+    if user is not None:
+        clauses.append({'access.users': {'$elemMatch': {
+            'id': user['_id'],
+            'level': {'$gte': level}
+        }}})
+        if user.get('groups'):
+            clauses.append({'access.groups': {'$elemMatch': {
+                'id': {'$in': user['groups']},
+                'level': {'$gte': level}
+            }}})
+
+    if not clauses:
+        # Nothing can match; _id always exists.
+        return {'_id': {'$exists': False}}
+    return {'$or': clauses}
+
+
+def combineQueries(*queries):
+    """
+    Combine several query dicts so that all of them must match. Empty
+    queries are ignored.
+    """
+    queries = [q for q in queries if q]
+    if not queries:
+        return {}
+    if len(queries) == 1:
+        return queries[0]
+    return {'$and': queries}
+
+
+def normalizeName(name):
+    """
+    Normalize a name for prefix matching and uniqueness checks: case is
+    folded and runs of whitespace are collapsed to single spaces.
+    """
+    return ' '.join(name.lower().split())
+
+
+def prefixSearch(model, query, user=None, filters=None, limit=0, offset=0,
+                 level=AccessType.READ, fields=None):
+    """
+    Find the documents of a model whose normalized name starts with a query
+    string. The anchored match on ``lowerName``, the permission check and the
+    paging are all part of the database query.
+
+    :param model: The access controlled model to search.
+    :param query: The prefix to match.
+    :type query: str
+    :param filters: Additional query conditions.
+    :type filters: dict or None
+    :returns: A cursor over the matching documents sorted by name.
+    """
+    q = combineQueries(
+        {'lowerName': {'$regex': '^' + re.escape(normalizeName(query))}},
+        filters, accessQuery(user, level))
+    return model.find(q, limit=limit, offset=offset, fields=fields,
+                      sort=[('lowerName', SortDir.ASCENDING)])
+
+
+def textSearch(model, query, user=None, filters=None, limit=0, offset=0,
+               level=AccessType.READ):
+    """
+    Full text search on a model, with the permission check and the paging
+    done by the database rather than by filtering the results afterward.
+
+    :returns: A cursor over the matching documents, best matches first.
+    """
+    q = combineQueries({'$text': {'$search': query}}, filters,
+                       accessQuery(user, level))
+    return model.find(q, limit=limit, offset=offset, fields={
+        '_textScore': {'$meta': 'textScore'}
+    }, sort=[('_textScore', {'$meta': 'textScore'})])
+
+
+def runMigration(name, func, *args):
+    """
+    Run a one-off data migration, such as the backfill of a new field,
+    unless the ``challenge.migrations`` setting records that it already ran.
+    Migrations must be safe to run twice, since processes loading the plugin
+    at the same time may each run them.
+
+    :param name: The unique name of the migration.
+    :type name: str
+    :param func: The migration, called with the remaining arguments.
+    """
+    settingModel = ModelImporter.model('setting')
+    if name in (settingModel.get(PluginSettings.MIGRATIONS, []) or ()):
+        return
+    func(*args)
+    done = settingModel.get(PluginSettings.MIGRATIONS, []) or []
+    settingModel.set(PluginSettings.MIGRATIONS, sorted(set(done) | {name}))
+
+
+def backfillLowerNames(model):
+    """
+    Set ``lowerName`` on documents saved before it was introduced. This
+    scans the collection for documents without it, so it should only run
+    once, through ``runMigration``.
+
+    Names that only differ in case or spacing were allowed before
+    ``lowerName`` had a unique index. Such documents are renamed with a
+    numbered suffix, as in "Name (2)", so that they can still be saved and
+    found; each renaming is logged as a warning for administrators.
+    """
+    docs = list(model.find({'lowerName': {'$exists': False}},
+                           fields=['name'], limit=0))
+    ops = [UpdateOne({'_id': doc['_id']}, {
+        '$set': {'lowerName': normalizeName(doc.get('name', ''))}
+    }) for doc in docs]
+    if not ops:
+        return
+    try:
+        model.collection.bulk_write(ops, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details.get('writeErrors', ()):
+            if error['code'] != DUPLICATE_KEY:
+                raise
+            _renameDuplicate(model, docs[error['index']])
+
+
+def _renameDuplicate(model, doc):
+    name = doc.get('name', '')
+    for n in itertools.count(2):
+        newName = '%s (%d)' % (name, n)
+        try:
+            model.collection.update_one({'_id': doc['_id']}, {'$set': {
+                'name': newName, 'lowerName': normalizeName(newName)}})
+        except DuplicateKeyError:
+            continue
+        logger.warning('Renamed %s %s from "%s" to "%s": another %s has '
+                       'the same name but for case or spacing.', model.name,
+                       doc['_id'], name, newName, model.name)
+        return
+
+
+def keysetSort(sort):
+    """
+    Append ``_id`` as a tie-breaker to a sort specification so that the
+    ordering is total, as required for keyset pagination.
+
+    :param sort: A list of (field, direction) pairs, or None.
+    :returns: The sort list ending with an ``_id`` key.
+    """
+    sort = list(sort or [('_id', SortDir.ASCENDING)])
+    if sort[-1][0] != '_id':
+        sort.append(('_id', sort[0][1]))
+    return sort
+
+
+def encodeCursor(doc, sort):
+    """
+    Build an opaque cursor that resumes a listing right after ``doc``.
+
+    :param doc: The last document of the current page.
+    :type doc: dict
+    :param sort: The sort specification used for the listing.
+    :returns: The cursor as a URL-safe string.
+    """
+    field = keysetSort(sort)[0][0]
+    raw = json_util.dumps([doc.get(field), doc['_id']]).encode('utf8')
+    return base64.urlsafe_b64encode(raw).decode('utf8')
+
+
+def decodeCursor(cursor):
+    """
+    Decode a cursor built by ``encodeCursor``.
+
+    :returns: The (sort value, _id) pair of the last document seen.
+    :raises ValueError: If the cursor is malformed.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('utf8'))
+        value, id = json_util.loads(raw.decode('utf8'))
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError('Invalid cursor.')
+    return value, id
+
+
+def listProjection(fields, sort):
+    """
+    Build the projection of a listing restricted to some fields. The fields
+    that access checks and keyset cursors need are always read.
+
+    :param fields: The fields to return, or None for whole documents.
+    :type fields: list of str or None
+    :param sort: The sort specification of the listing.
+    :returns: The projection to pass to ``find``.
+    """
+    if fields is None:
+        return None
+    projection = set(fields) | {'_id', 'public', 'access'}
+    projection.add(keysetSort(sort)[0][0])
+    return sorted(projection)
+
+
+def listFields(params, summaryFields):
+    """
+    Read the ``fields`` and ``view`` parameters of a listing endpoint.
+
+    Nested paths are collapsed onto their top-level field, since they would
+    collide with the fields that are always read, such as ``access``.
+
+    :param params: The request parameters.
+    :type params: dict
+    :param summaryFields: The fields returned by ``view=summary``.
+    :returns: The fields to return, or None for every exposed field.
+    """
+    view = params.get('view', 'full')
+    if view not in ('full', 'summary'):
+        raise RestException('Invalid view; must be "full" or "summary".')
+    if params.get('fields'):
+        if view == 'summary':
+            raise RestException('Pass either fields or view, not both.')
+        fields = []
+        for field in params['fields'].split(','):
+            field = field.strip().split('.')[0]
+            if field.startswith('$'):
+                raise RestException('Invalid field "%s".' % field)
+            if field and field not in fields:
+                fields.append(field)
+        return fields
+    if view == 'summary':
+        return list(summaryFields)
+    return None
+
+
+def keysetQuery(sort, after):
+    """
+    Build the query selecting the documents that follow a cursor position,
+    so that paging is an index seek rather than a skip.
+
+    MongoDB sorts null and missing values before any other, but ``$gt`` and
+    ``$lt`` only match values of the same type as their operand, so these
+    documents are selected by branches of their own.
+
+    :param sort: The sort specification, as returned by ``keysetSort``.
+    :param after: The (sort value, _id) pair returned by ``decodeCursor``.
+    """
+    field, direction = sort[0]
+    value, id = after
+    ascending = direction == SortDir.ASCENDING
+    op = '$gt' if ascending else '$lt'
+    if field == '_id':
+        return {'_id': {op: id}}
+
+    branches = []
+    if value is None:
+        if ascending:
+            branches.append({field: {'$ne': None}})
+    else:
+        branches.append({field: {op: value}})
+        if not ascending:
+            branches.append({field: None})
+    branches.append({field: value, '_id': {op: id}})
+    return {'$or': branches}
+
+
+def backgroundTask(func, user, title, message=None):
+    """
+    Run ``func(progress)`` on a daemon thread, recording its progress through
+    a ``ProgressContext``. The progress record is created before this
+    returns, so its id can be handed back to the client right away as a job
+    id to follow.
+
+    :param func: The task to run; it receives the progress context.
+    :param user: The user to whom the progress notifications are sent.
+    :type user: dict
+    :param title: The title of the progress record.
+    :type title: str
+    :param message: The initial progress message.
+    :type message: str
+    :returns: The progress notification document.
+    """
+    ctx = ProgressContext(True, user=user, title=title, message=message)
+    # The context is entered here and exited on the worker thread, so that
+    # the record exists before the request returns.
+    ctx.__enter__()
+
+    def run():
+        try:
+            func(ctx)
+        except Exception:
+            logger.exception('Background task "%s" failed.', title)
+            ctx.__exit__(*sys.exc_info())
+        else:
+            ctx.__exit__(None, None, None)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return ctx.progress
+
+
+def _girderDoc(modelName, name, creator, public, parent=None, **fields):
+    """
+    Build a document as the create method of a Girder model would, with its
+    ID assigned up front so that other documents can refer to it before it
+    is inserted with ``insertDocuments``. The access policies of ``parent``
+    are copied first if it is given.
+    """
+    now = datetime.datetime.utcnow()
+    doc = {
+        '_id': ObjectId(),
+        'name': name,
+        'lowerName': name.lower(),
+        'description': '',
+        'creatorId': creator['_id'],
+        'created': now,
+        'updated': now
+    }
+    doc.update(fields)
+    model = ModelImporter.model(modelName)
+    if parent is not None:
+        model.copyAccessPolicies(src=parent, dest=doc)
+    model.setUserAccess(doc, user=creator, level=AccessType.ADMIN,
+                        save=False)
+    model.setPublic(doc, public, save=False)
+    return doc
+
+
+def newCollection(name, creator, public):
+    """
+    Build the document ``Collection.createCollection`` would save.
+    """
+    return _girderDoc('collection', name, creator, public, size=0)
+
+
+def newFolder(parent, parentType, name, creator, public):
+    """
+    Build the document ``Folder.createFolder`` would save under a collection
+    or folder, copying the access policies of the parent.
+    """
+    if parentType == 'collection':
+        base = (parent['_id'], 'collection')
+    else:
+        base = (parent['baseParentId'], parent['baseParentType'])
+    return _girderDoc(
+        'folder', name, creator, public, parent=parent,
+        parentCollection=parentType, parentId=parent['_id'],
+        baseParentId=base[0], baseParentType=base[1], size=0)
+
+
+def newGroup(name, creator, public):
+    """
+    Build the document ``Group.createGroup`` would save. The creator is an
+    administrator of the group; ``insertDocuments`` makes them a member.
+    """
+    return _girderDoc('group', name, creator, public, requests=[])
+
+
+def insertDocuments(modelName, docs):
+    """
+    Insert documents built by ``newCollection``, ``newFolder`` or
+    ``newGroup`` with a single ``insert_many`` rather than one save each,
+    and fire the ``save.after`` event of each of them. The creators of new
+    groups are made members with one update per creator.
+
+    :param modelName: The name of the Girder model of the documents.
+    :type modelName: str
+    :param docs: The documents to insert.
+    :type docs: list of dict
+    """
+    if not docs:
+        return
+    ModelImporter.model(modelName).collection.insert_many(docs)
+    if modelName == 'group':
+        creators = {}
+        for doc in docs:
+            creators.setdefault(doc['creatorId'], []).append(doc['_id'])
+        userModel = ModelImporter.model('user')
+        for creatorId, groupIds in creators.items():
+            userModel.collection.update_one(
+                {'_id': creatorId},
+                {'$addToSet': {'groups': {'$each': groupIds}}})
+            events.trigger('model.user.save.after',
+                           userModel.load(creatorId, force=True))
+    for doc in docs:
+        events.trigger('model.%s.save.after' % modelName, doc)
+
+
+def folderFiles(folderId):
+    """
+    List the files of all items directly under a folder using two queries.
+
+    :param folderId: The ID of the folder.
+    :type folderId: ObjectId
+    :returns: A list of file documents.
+    """
+    items = ModelImporter.model('item').find(
+        {'folderId': folderId}, fields=['_id'], limit=0)
+    return list(ModelImporter.model('file').find({
+        'itemId': {'$in': [item['_id'] for item in items]}
+    }, limit=0))
+
+
+def readFile(file):
+    """
+    Read the whole contents of a file from its assetstore.
+
+    :param file: The file document.
+    :type file: dict
+    :returns: The contents of the file.
+    :rtype: bytes
+    """
+    return b''.join(
+        ModelImporter.model('file').download(file, headers=False)())
+
+
+def localPath(file, assetstores):
+    """
+    Return the path of a file on the local filesystem, if it is stored in a
+    filesystem assetstore, so that it can be read without going through
+    Girder, e.g. by scoring processes.
+
+    :param file: The file document.
+    :type file: dict
+    :param assetstores: Assetstore documents already loaded, keyed by ID.
+    Those loaded here are added to it.
+    :type assetstores: dict
+    :returns: The path, or None if the file is not stored locally.
+    """
+    if file.get('linkUrl') or not file.get('assetstoreId'):
+        return None
+    assetstoreId = file['assetstoreId']
+    if assetstoreId not in assetstores:
+        assetstores[assetstoreId] = ModelImporter.model('assetstore').load(
+            assetstoreId)
+    assetstore = assetstores[assetstoreId]
+    if assetstore is None or \
+            assetstore['type'] != AssetstoreType.FILESYSTEM:
+        return None
+    if file.get('imported'):
+        return file['path']
+    return os.path.join(assetstore['root'], file['path'])
+
+
+def readNpyHeader(file):
+    """
+    Read the header of a ``.npy`` file, downloading only the first bytes of
+    the file from its assetstore.
+
+    :param file: The file document.
+    :type file: dict
+    :returns: The header as returned by ``scoring.parseNpyHeader``.
+    :raises ValueError: If the file does not start with a valid header.
+    """
+    head = b''
+    for chunk in ModelImporter.model('file').download(file, headers=False)():
+        head += chunk
+        header = parseNpyHeader(head)
+        if header is not None:
+            return header
+    raise ValueError('Truncated .npy header.')
+
+
+# Approximate number of bytes to buffer before yielding a chunk of an export
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+
+def exportValue(value):
+    """
+    Convert the ObjectIds and dates of a document to JSON-friendly values.
+    """
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    return value
+
+
+def _chunked(pieces):
+    """
+    Join a stream of byte strings into chunks of about EXPORT_CHUNK_BYTES.
+    """
+    buf, size = [], 0
+    for piece in pieces:
+        buf.append(piece)
+        size += len(piece)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield b''.join(buf)
+            buf, size = [], 0
+    if buf:
+        yield b''.join(buf)
+
+
+def csvChunks(docs, fields):
+    """
+    Encode documents as CSV with a header line, one row per document. Only
+    one chunk of rows is held in memory at a time.
+
+    :param docs: The documents to encode, e.g. a cursor.
+    :param fields: The fields to write, in column order.
+    :type fields: list of str
+    :returns: A generator of UTF-8 encoded chunks.
+    """
+    def encode(row):
+        out = six.StringIO()
+        values = ['' if v is None else exportValue(v) for v in row]
+        if six.PY2:
+            values = [v.encode('utf8') if isinstance(v, six.text_type)
+                      else v for v in values]
+        csv.writer(out, lineterminator='\n').writerow(values)
+        value = out.getvalue()
+        return value if six.PY2 else value.encode('utf8')
+
+    def rows():
+        yield encode(fields)
+        for doc in docs:
+            yield encode([doc.get(field) for field in fields])
+
+    return _chunked(rows())
+
+
+def ndjsonChunks(docs, fields):
+    """
+    Encode documents as newline-delimited JSON, one object per line.
+
+    :param docs: The documents to encode, e.g. a cursor.
+    :param fields: The fields to write.
+    :type fields: list of str
+    :returns: A generator of UTF-8 encoded chunks.
+    """
+    return _chunked((json.dumps(
+        {field: doc.get(field) for field in fields},
+        default=exportValue, sort_keys=True) + '\n').encode('utf8')
+        for doc in docs)
+
+
+def gzipChunks(chunks):
+    """
+    Compress a stream of chunks into a gzip stream as they are produced.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
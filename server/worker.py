@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import os
+import socket
+import threading
+
+from girder import logger
+from girder.utility.config import getConfig
+from girder.utility.model_importer import ModelImporter
+
+
+def scoreJob(job):
+    """
+    Score the submissions to the phase of a job.
+    """
+    phase = ModelImporter.model('phase', 'challenge').load(
+        job['phaseId'], force=True)
+    if phase is None:
+        return
+    ModelImporter.model('submission', 'challenge').scorePhase(
+        phase, rescore=job['params'].get('rescore', False))
+
+
+def rescoreJob(job):
+    """
+    Score again the out of date results of the phase of a job.
+    """
+    phase = ModelImporter.model('phase', 'challenge').load(
+        job['phaseId'], force=True)
+    if phase is None:
+        return
+    ModelImporter.model('submission', 'challenge').rescoreStale(phase)
+
+
+def provisionJob(job):
+    """
+    Create the collection, folders and group of a challenge or phase created
+    with deferred provisioning, and mark it ready.
+    """
+    if job['phaseId'] is None:
+        model = ModelImporter.model('challenge', 'challenge')
+        challenge = model.load(job['challengeId'], force=True)
+        if challenge is not None:
+            model.provision(challenge)
+        return
+
+    phase = ModelImporter.model('phase', 'challenge').load(
+        job['phaseId'], force=True)
+    if phase is None:
+        return
+    creator = ModelImporter.model('user').load(
+        job['params']['creatorId'], force=True)
+    if creator is None:
+        raise ValueError('The creator of phase %s no longer exists.' %
+                         phase['_id'])
+    ModelImporter.model('phase', 'challenge').provision(phase, creator)
+
+
+HANDLERS = {
+    'score': scoreJob,
+    'rescore': rescoreJob,
+    'provision': provisionJob
+}
+
+
+class JobWorker(object):
+    """
+    Runs jobs from the ``challenge_job`` queue on daemon threads of this
+    process. Each thread leases one job at a time and renews the lease while
+    the job runs; expired leases of other workers are reclaimed every few
+    polls.
+
+    :param handlers: The functions running each type of job, called with
+    the job document.
+    :type handlers: dict
+    :param threads: The number of jobs to run at once.
+    :type threads: int
+    :param pollInterval: The number of seconds to wait when the queue is
+    empty.
+    :type pollInterval: float
+    """
+    def __init__(self, handlers, threads=1, pollInterval=5.0):
+        self.handlers = handlers
+        self.threads = threads
+        self.pollInterval = pollInterval
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.threads):
+            thread = threading.Thread(target=self._loop, args=('%s:%d:%d' % (
+                socket.gethostname(), os.getpid(), i),))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self, workerId):
+        polls = 0
+        while not self._stop.is_set():
+            try:
+                if polls % 12 == 0:
+                    ModelImporter.model('job', 'challenge').reclaim()
+                polls += 1
+                if not self.runOnce(workerId):
+                    self._stop.wait(self.pollInterval)
+            except Exception:
+                logger.exception('Job worker %s failed.', workerId)
+                self._stop.wait(self.pollInterval)
+
+    def runOnce(self, workerId):
+        """
+        Lease and run one job.
+
+        :returns: Whether a job was run.
+        :rtype: bool
+        """
+        model = ModelImporter.model('job', 'challenge')
+        job = model.lease(workerId)
+        if job is None:
+            return False
+
+        done = threading.Event()
+
+        def renew():
+            while not done.wait(model.leaseSeconds / 3):
+                if not model.renewLease(job):
+                    return
+
+        renewer = threading.Thread(target=renew)
+        renewer.daemon = True
+        renewer.start()
+        try:
+            handler = self.handlers.get(job['type'])
+            if handler is None:
+                raise ValueError('Unknown job type "%s".' % job['type'])
+            handler(job)
+        except Exception as e:
+            logger.exception('Job %s failed.', job['_id'])
+            model.fail(job, '%s: %s' % (type(e).__name__, e))
+        else:
+            model.complete(job)
+        finally:
+            done.set()
+        return True
+
+
+_worker = None
+_workerLock = threading.Lock()
+
+
+def startWorker():
+    """
+    Start the job worker of this process, configured from the
+    ``[challenge]`` section of the Girder configuration. Setting
+    ``job_workers`` to 0 leaves the queue to other processes. The scoring
+    processes are only forked by the first scoring job, so processes that
+    run no such job never fork them.
+    """
+    global _worker
+    with _workerLock:
+        if _worker is None:
+            conf = getConfig().get('challenge', {})
+            threads = int(conf.get('job_workers', 1))
+            _worker = JobWorker(
+                HANDLERS, threads=threads,
+                pollInterval=float(conf.get('job_poll_interval', 5)))
+            _worker.start()
+        return _worker